@@ -0,0 +1,128 @@
+import json
+import multiprocessing
+import os
+import time
+from multiprocessing.connection import wait
+from tqdm import tqdm
+
+# Runs extraction jobs in forked worker processes and watches them. Every worker reports the files it works on and
+# until when in a heartbeat, a slot of shared memory per worker. A worker that is past that deadline or that dies is
+# killed and restarted on its job from the last checkpoint:
+#   - if the heartbeat covered a batch of files, e.g. their segmentation, the batch is retried one file at a time to
+#     find the file that is over the budget
+#   - a single file is added to the quarantine list, which the restarted worker and later runs skip
+# A worker that dies outside of a file fails the run, restarting it would fail again.
+
+poll_seconds = 1
+
+# heartbeat of the worker process: position of the first file in the job, number of files, deadline as time.time()
+# or 0 without a deadline. a position of -1 means the worker is not in a file
+heartbeats = None
+heartbeat_slot = None
+heartbeat_size = 3
+
+
+def set_heartbeat(position, num_files, budget=None):
+    if heartbeats is None:
+        return
+
+    offset = heartbeat_slot * heartbeat_size
+    # the deadline is cleared first, the watchdog never reads a past deadline together with the new files
+    heartbeats[offset + 2] = 0
+    heartbeats[offset] = position
+    heartbeats[offset + 1] = num_files
+    heartbeats[offset + 2] = time.time() + budget if budget is not None else 0
+
+
+def clear_heartbeat():
+    set_heartbeat(-1, 0)
+
+
+def read_quarantine(quarantine_path):
+    # the quarantine list has a [file, reason] line per file
+    if quarantine_path is None or not os.path.exists(quarantine_path):
+        return set()
+
+    with open(quarantine_path, 'r') as f:
+        return {json.loads(line)[0] for line in f if line.strip() != ''}
+
+
+def add_to_quarantine(quarantine_path, file, reason):
+    if quarantine_path is None:
+        return
+
+    with open(quarantine_path, 'a') as f:
+        f.write(json.dumps([file, reason]) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def run_worker(run_job, job, slot):
+    global heartbeat_slot
+
+    heartbeat_slot = slot
+    clear_heartbeat()
+    run_job(job)
+
+
+def run_watched(jobs, run_job, workers, quarantine, show_progress=True):
+    # jobs: dicts with the 'files' and the 'output_dir' of the job, run_job(job) runs in a forked worker and continues from the last
+    # checkpoint when job['resume'] is set. a restarted job gets 'resume' and 'unbatched_until', the position up to
+    # which its files are processed one at a time. quarantine(file, reason) is called before a restart with the
+    # offending file, it has to make the restarted worker skip the file
+    global heartbeats
+
+    context = multiprocessing.get_context('fork')
+    heartbeats = context.RawArray('d', heartbeat_size * workers)
+    for slot in range(workers):
+        heartbeats[slot * heartbeat_size] = -1
+
+    pending = list(range(len(jobs)))
+    running = {}
+    progress = tqdm(total=len(jobs), disable=not show_progress)
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            for slot in range(workers):
+                if slot not in running and len(pending) > 0:
+                    job_idx = pending.pop(0)
+                    heartbeats[slot * heartbeat_size:(slot + 1) * heartbeat_size] = [-1, 0, 0]
+                    process = context.Process(target=run_worker, args=(run_job, jobs[job_idx], slot))
+                    process.start()
+                    running[slot] = (process, job_idx)
+
+            deadlines = [heartbeats[slot * heartbeat_size + 2] for slot in running if heartbeats[slot * heartbeat_size + 2] > 0]
+            timeout = min([poll_seconds] + [max(0, deadline - time.time()) for deadline in deadlines])
+            wait([process.sentinel for process, _ in running.values()], timeout=timeout)
+
+            for slot, (process, job_idx) in list(running.items()):
+                deadline = heartbeats[slot * heartbeat_size + 2]
+                timed_out = process.exitcode is None
+                if timed_out and not 0 < deadline < time.time():
+                    continue
+
+                if timed_out:
+                    process.kill()
+                process.join()
+                del running[slot]
+                if not timed_out and process.exitcode == 0:
+                    progress.update(1)
+                    continue
+
+                job = jobs[job_idx]
+                reason = 'timeout' if timed_out else 'exit code ' + str(process.exitcode)
+                position, num_files = int(heartbeats[slot * heartbeat_size]), int(heartbeats[slot * heartbeat_size + 1])
+                if position < 0:
+                    raise RuntimeError('worker of ' + job['output_dir'] + ' failed with exit code ' + str(process.exitcode))
+
+                if num_files > 1:
+                    job['unbatched_until'] = max(job.get('unbatched_until', 0), position + num_files)
+                else:
+                    quarantine(job['files'][position], reason)
+                job['resume'] = True
+                pending.insert(0, job_idx)
+    finally:
+        for process, _ in running.values():
+            process.kill()
+            process.join()
+        progress.close()
+        heartbeats = None
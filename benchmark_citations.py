@@ -0,0 +1,128 @@
+import argparse
+import json
+import re
+import sys
+import time
+from lxml import etree
+from citations import get_paragraph_markup, cleanse_sentence, split_sentence_at_citations, tokenize_citations, split_citations, parse_xref_attrib
+
+# Checks that the single pass citation tokenizer produces the same parts and xref attributes as the original
+# split_sentence_at_citations and etree.fromstring on real sentences and measures the speedup.
+# Sentences are read from PMC files, split at sentence ends with a regex since the exact boundaries do not matter
+# here, or from a jsonl file with one sentence string per line, e.g. test_data/citation_sentences.jsonl. Exits with
+# status 1 if any sentence gives different results, test_citations.py runs the same comparison under pytest.
+
+
+def read_pmc_sentences(file_paths):
+    sentences = []
+    for file_path in file_paths:
+        try:
+            paper = etree.parse(file_path)
+        except Exception:
+            continue
+
+        for paragraph in paper.xpath('//body//p'):
+            sentences.extend(re.split(r'(?<=[.!?])\s+(?=[A-Z(\[<])', get_paragraph_markup(paragraph)))
+
+    return sentences
+
+
+def citation_attribs(split_text, parse):
+    # the attributes handle_split_text reads from every citation, or the exception it would log
+    attribs = []
+    for part in split_text:
+        if '</xref>' not in part:
+            continue
+        for citation in part.split(',') if '</xref>,<xref' in part else [part]:
+            try:
+                attrib = parse(citation)
+                attribs.append((attrib.get('ref-type'), attrib.get('rid')))
+            except Exception as e:
+                attribs.append(repr(e))
+
+    return attribs
+
+
+def legacy_split(sent):
+    return [part for part in split_sentence_at_citations(sent) if part]
+
+
+def new_split(sent):
+    return [part for part in split_citations(sent) if part]
+
+
+def time_per_sentence(function, sentences, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for sent in sentences:
+            function(sent)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best / len(sentences) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        '--file_list_path',
+        type=str,
+        help='file with one PMC xml path per line, e.g. random_file_samples_50k'
+    )
+    parser.add_argument(
+        '--sentences_path',
+        type=str,
+        help='jsonl file with one sentence per line'
+    )
+    parser.add_argument(
+        '--num_files',
+        type=int,
+        default=1000
+    )
+    parser.add_argument(
+        '--repeats',
+        type=int,
+        default=5
+    )
+
+    args = parser.parse_args()
+
+    if args.sentences_path is not None:
+        with open(args.sentences_path, 'r') as f:
+            sentences = [json.loads(line) for line in f]
+    else:
+        with open(args.file_list_path, 'r') as f:
+            file_paths = [line.strip() for line in f if line.strip()][:args.num_files]
+        sentences = read_pmc_sentences(file_paths)
+
+    sentences = [cleanse_sentence(sent) for sent in sentences if 'ref-type="bibr"' in sent]
+    print('sentences with citations', len(sentences))
+
+    mismatches = 0
+    fallbacks = 0
+    for sent in sentences:
+        if tokenize_citations(sent) is None:
+            fallbacks += 1
+
+        legacy_parts = legacy_split(sent)
+        new_parts = new_split(sent)
+        if legacy_parts != new_parts or citation_attribs(legacy_parts, lambda c: etree.fromstring(c).attrib) != citation_attribs(new_parts, parse_xref_attrib):
+            mismatches += 1
+            print('mismatch:', sent)
+
+    print('mismatches', mismatches)
+    print('fallbacks to split_sentence_at_citations', fallbacks)
+
+    legacy_time = time_per_sentence(lambda sent: citation_attribs(split_sentence_at_citations(sent), lambda c: etree.fromstring(c).attrib), sentences, args.repeats)
+    new_time = time_per_sentence(lambda sent: citation_attribs(split_citations(sent), parse_xref_attrib), sentences, args.repeats)
+    print('split and xref parsing, legacy: %.2f us/sentence' % legacy_time)
+    print('split and xref parsing, new: %.2f us/sentence' % new_time)
+    print('speedup %.2fx' % (legacy_time / new_time))
+
+    sys.exit(1 if mismatches > 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
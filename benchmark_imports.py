@@ -0,0 +1,64 @@
+import argparse
+import json
+import subprocess
+import sys
+
+# Measures how long importing the scripts takes in a fresh interpreter and checks it against a budget. Importing them
+# must not load the models, tokenizers or indexes, they are loaded on first use. Exits with status 1 if a module takes
+# longer than the budget or imports one of the heavy modules.
+
+modules = ('parse_pmc_data', 'parse_pubmed_data', 'utils', 'citations', 'segmenters', 'token_cache')
+heavy_modules = ('spacy', 'transformers', 'torch', 'pubmed_parser')
+
+measure_import = '''
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps([seconds, [name for name in {heavy_modules!r} if name in sys.modules]]))
+'''
+
+
+def import_seconds(module, repeats):
+    # best of repeats, every import runs in its own interpreter so nothing is imported already
+    best = None
+    loaded = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', measure_import.format(module=module, heavy_modules=heavy_modules)],
+                                check=True, capture_output=True, text=True).stdout
+        seconds, loaded = json.loads(output.splitlines()[-1])
+        best = seconds if best is None else min(best, seconds)
+
+    return best, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        '--budget',
+        type=float,
+        default=1.0,
+        help='maximum import time of a module in seconds'
+    )
+    parser.add_argument(
+        '--repeats',
+        type=int,
+        default=3
+    )
+
+    args = parser.parse_args()
+
+    failed = False
+    for module in modules:
+        seconds, loaded = import_seconds(module, args.repeats)
+        print('%s: %.3f s' % (module, seconds) + (', imports ' + ', '.join(loaded) if loaded else ''))
+        if seconds > args.budget or loaded:
+            failed = True
+
+    print('over budget' if failed else 'within budget of %.2f s' % args.budget)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+import argparse
+import json
+import time
+from lxml import etree
+from segmenters import load_segmenter, segmenter_loaders
+from citations import get_paragraph_markup, get_paragraph_citations, cleanse_sentence, citation_only_sentence, split_citations, \
+    get_citation_pairs, get_span_citation_pairs
+
+# Runs the sentence segmenters over the paragraphs of a fixed sample of PMC files and reports their throughput and
+# how many of the (query, cited reference ids) pairs they produce agree with the pairs of the reference segmenter.
+
+
+def read_paragraphs(file_paths, paragraph_mode):
+    # per paragraph the file it belongs to, its text and, in tree mode, its citation spans
+    paragraphs = []
+    for file_path in file_paths:
+        try:
+            paper = etree.parse(file_path)
+        except Exception:
+            continue
+
+        for paragraph in paper.xpath('//body//p'):
+            if paragraph_mode == 'tree':
+                paragraph_text, citations = get_paragraph_citations(paragraph)
+            else:
+                paragraph_text, citations = get_paragraph_markup(paragraph), None
+            paragraphs.append((file_path, paragraph_text, citations))
+
+    return paragraphs
+
+
+def segment(segmenter, paragraphs, batch_size):
+    start = time.perf_counter()
+    docs = segmenter.pipe([paragraph_text for _, paragraph_text, _ in paragraphs], batch_size=batch_size)
+    sentence_spans = [[(sentence.start_char, sentence.end_char) for sentence in doc.sents] for doc in docs]
+
+    return sentence_spans, time.perf_counter() - start
+
+
+def get_pairs(paragraphs, sentence_spans, method):
+    # (file, query, cited reference ids) of all pairs, like get_query_article_pairs but without the corpus filter
+    pairs = set()
+    for (file_path, paragraph_text, citations), spans in zip(paragraphs, sentence_spans):
+        if citations is not None:
+            citation_pairs = get_span_citation_pairs(paragraph_text, citations, spans, method=method)
+        else:
+            citation_pairs = []
+            for start, end in spans:
+                sent = paragraph_text[start:end]
+                if 'ref-type="bibr"' not in sent:
+                    continue
+
+                sent = cleanse_sentence(sent)
+                if citation_only_sentence.match(sent):
+                    continue
+
+                sentence_pairs, error = get_citation_pairs(split_citations(sent), method=method)
+                if error is None or method == 'iterative':
+                    citation_pairs.extend(sentence_pairs)
+
+        pairs.update((file_path, query, tuple(xref_ids)) for query, xref_ids in citation_pairs if len(xref_ids) > 0)
+
+    return pairs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        '--file_list_path',
+        type=str,
+        required=True,
+        help='file with one PMC xml path per line, e.g. random_file_samples_50k'
+    )
+    parser.add_argument(
+        '--num_files',
+        type=int,
+        default=200
+    )
+    parser.add_argument(
+        '--segmenters',
+        nargs='+',
+        choices=tuple(segmenter_loaders),
+        default=list(segmenter_loaders)
+    )
+    parser.add_argument(
+        '--reference_segmenter',
+        choices=tuple(segmenter_loaders),
+        default='scibert',
+        help='the pairs of the other segmenters are compared with the pairs of this one'
+    )
+    parser.add_argument(
+        '--paragraph_mode',
+        choices=('markup', 'tree'),
+        default='markup'
+    )
+    parser.add_argument(
+        '--extract_method',
+        choices=('iterative', 'total'),
+        default='iterative'
+    )
+    parser.add_argument(
+        '--device',
+        choices=('gpu', 'cpu'),
+        default='cpu'
+    )
+    parser.add_argument(
+        '--batch_size',
+        type=int,
+        default=64
+    )
+    parser.add_argument(
+        '--output_path',
+        type=str,
+        help='also write the results as json'
+    )
+
+    args = parser.parse_args()
+
+    with open(args.file_list_path, 'r') as f:
+        file_paths = [line.strip() for line in f if line.strip()][:args.num_files]
+    paragraphs = read_paragraphs(file_paths, args.paragraph_mode)
+    num_chars = sum(len(paragraph_text) for _, paragraph_text, _ in paragraphs)
+    print('files', len(file_paths), 'paragraphs', len(paragraphs), 'characters', num_chars)
+
+    segmenter_names = [args.reference_segmenter] + [name for name in args.segmenters if name != args.reference_segmenter]
+    results = {}
+    reference_pairs = None
+    for name in segmenter_names:
+        segmenter = load_segmenter(name, args.device)
+        # the first batch also initializes the pipeline, keep it out of the measurement
+        segment(segmenter, paragraphs[:args.batch_size], args.batch_size)
+
+        sentence_spans, elapsed = segment(segmenter, paragraphs, args.batch_size)
+        num_sentences = sum(len(spans) for spans in sentence_spans)
+        pairs = get_pairs(paragraphs, sentence_spans, args.extract_method)
+        if reference_pairs is None:
+            reference_pairs = pairs
+
+        num_agreeing = len(pairs & reference_pairs)
+        results[name] = {
+            'seconds': elapsed,
+            'sentences': num_sentences,
+            'sentences_per_second': num_sentences / elapsed if elapsed > 0 else None,
+            'characters_per_second': num_chars / elapsed if elapsed > 0 else None,
+            'pairs': len(pairs),
+            'pairs_agreeing_with_' + args.reference_segmenter: num_agreeing,
+            'pair_precision': num_agreeing / len(pairs) if len(pairs) > 0 else None,
+            'pair_recall': num_agreeing / len(reference_pairs) if len(reference_pairs) > 0 else None,
+        }
+        print(name, json.dumps(results[name]))
+
+    if args.output_path is not None:
+        with open(args.output_path, 'w') as f:
+            json.dump({'num_files': len(file_paths), 'num_paragraphs': len(paragraphs), 'paragraph_mode': args.paragraph_mode,
+                       'extract_method': args.extract_method, 'reference_segmenter': args.reference_segmenter, 'results': results}, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
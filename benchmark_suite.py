@@ -0,0 +1,244 @@
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+from lxml import etree
+import parse_pmc_data
+from synthetic_data import default_config, write_pmc_articles, write_medline_files
+from citations import get_paragraph_markup, cleanse_sentence, split_sentence_at_citations, split_citations
+
+# Offline benchmarks of the hot paths on synthetic articles and MEDLINE files from synthetic_data.py:
+# microbenchmarks of cleanse_sentence, split_sentence_at_citations, split_citations, handle_split_text and
+# get_reference_dict, the end-to-end throughput of parse_pmc_data.py in both paragraph modes with the rule-based
+# segmenter in place of the scispaCy model, and parsing MEDLINE baseline files with parse_pubmed_data.py.
+# The results are written as json, --compare_path prints the change against the results of an earlier commit.
+
+
+def time_calls(function, inputs, repeats):
+    # best of repeats in microseconds per call
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for item in inputs:
+            function(item)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return {'us_per_call': best / len(inputs) * 1e6, 'calls': len(inputs)}
+
+
+def read_papers(file_paths):
+    # per article its tree, pmc id and the sentences with citations, split at sentence ends with a regex
+    papers = []
+    for file_path in file_paths:
+        paper = etree.parse(file_path)
+        sentences = []
+        for paragraph in paper.xpath('//body//p'):
+            sentences.extend(sent for sent in re.split(r'(?<=[.!?])\s+(?=[A-Z(\[<])', get_paragraph_markup(paragraph)) if 'ref-type="bibr"' in sent)
+        papers.append((paper, parse_pmc_data.get_pmc_id(paper, file_path), sentences))
+
+    return papers
+
+
+def run_microbenchmarks(papers, pmid2info, repeats):
+    parse_pmc_data.init_run_state()
+
+    sentences = [sent for _, _, paper_sentences in papers for sent in paper_sentences]
+    cleansed = [cleanse_sentence(sent) for sent in sentences]
+
+    ref_dicts = [parse_pmc_data.get_reference_dict(paper, pmc_id) or {} for paper, pmc_id, _ in papers]
+    split_sentences = [(split_citations(sent), pmc_id, sent, ref_dict)
+                       for (_, pmc_id, paper_sentences), ref_dict in zip(papers, ref_dicts)
+                       for sent in (cleanse_sentence(sent) for sent in paper_sentences)]
+
+    results = {
+        'cleanse_sentence': time_calls(cleanse_sentence, sentences, repeats),
+        'split_sentence_at_citations': time_calls(split_sentence_at_citations, cleansed, repeats),
+        'split_citations': time_calls(split_citations, cleansed, repeats),
+        'handle_split_text': time_calls(lambda item: parse_pmc_data.handle_split_text(*item, pmid2info=pmid2info, methods=('iterative', 'total')),
+                                        split_sentences, repeats),
+        'get_reference_dict': time_calls(lambda item: parse_pmc_data.get_reference_dict(*item), [(paper, pmc_id) for paper, pmc_id, _ in papers], repeats),
+    }
+    # the run state collected by the calls above is not needed
+    parse_pmc_data.init_run_state()
+
+    return results
+
+
+def run_end_to_end(file_paths, pmid2info, output_dir, paragraph_mode):
+    # files/sec and pairs/sec of a serial run, taken from the metrics.json of the run
+    parse_pmc_data.segmenter_name = 'rules'
+    parse_pmc_data.device = 'cpu'
+    parse_pmc_data.paragraph_mode = paragraph_mode
+    parse_pmc_data.pmid2info = pmid2info
+
+    start = time.perf_counter()
+    parse_pmc_data.run_extraction(file_paths, output_dir, ['iterative'])
+    elapsed = time.perf_counter() - start
+
+    with open(os.path.join(output_dir, 'metrics.json'), 'r') as f:
+        metrics = json.load(f)
+
+    return {
+        'files_per_second': len(file_paths) / elapsed,
+        'pairs_per_second': metrics['num_pairs'] / elapsed,
+        'num_pairs': metrics['num_pairs'],
+        'stage_seconds': {name: stage['seconds'] for name, stage in metrics['stages'].items()},
+    }
+
+
+def run_medline(medline_paths, shard_dir):
+    # articles/sec of parse_baseline_file, which needs pubmed_parser
+    try:
+        import pubmed_parser  # noqa: F401
+    except ImportError:
+        return {'skipped': 'pubmed_parser is not installed'}
+    from parse_pubmed_data import parse_baseline_file
+
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+
+    num_articles = 0
+    start = time.perf_counter()
+    for path in medline_paths:
+        _, stats = parse_baseline_file((path, os.path.join(shard_dir, os.path.basename(path) + '.jsonl')))
+        num_articles += sum(stats.values())
+    elapsed = time.perf_counter() - start
+
+    return {'articles_per_second': num_articles / elapsed, 'num_articles': num_articles}
+
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(results, prefix=''):
+    # 'section.name.metric' -> value of the numeric results
+    values = {}
+    for name, value in results.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, prefix + name + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[prefix + name] = value
+
+    return values
+
+
+def compare(old_results, new_results, tolerance):
+    # microseconds per call are better when lower, everything per second when higher
+    old_values = flatten({name: old_results[name] for name in ('micro', 'end_to_end', 'medline') if name in old_results})
+    new_values = flatten({name: new_results[name] for name in ('micro', 'end_to_end', 'medline') if name in new_results})
+
+    regressions = 0
+    for name, new_value in new_values.items():
+        old_value = old_values.get(name)
+        if old_value is None or old_value == 0 or not (name.endswith('us_per_call') or name.endswith('_per_second')):
+            continue
+
+        change = new_value / old_value - 1
+        regressed = change > tolerance if name.endswith('us_per_call') else change < -tolerance
+        regressions += regressed
+        print('%-60s %12.2f %12.2f %+7.1f%%%s' % (name, old_value, new_value, change * 100, '  REGRESSION' if regressed else ''))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        '--output_path',
+        type=str,
+        default='benchmark_results.json'
+    )
+    parser.add_argument(
+        '--compare_path',
+        type=str,
+        help='results of an earlier run, changes beyond --tolerance are reported as regressions'
+    )
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=0.1
+    )
+    parser.add_argument(
+        '--fixture_dir',
+        type=str,
+        help='where the synthetic files are written, a temporary directory by default'
+    )
+    parser.add_argument(
+        '--num_articles',
+        type=int,
+        default=500
+    )
+    parser.add_argument(
+        '--num_medline_files',
+        type=int,
+        default=2
+    )
+    parser.add_argument(
+        '--num_pmids',
+        type=int,
+        default=20000,
+        help='pmids cited by the articles and stored in the MEDLINE files'
+    )
+    parser.add_argument(
+        '--repeats',
+        type=int,
+        default=5
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=42
+    )
+
+    args = parser.parse_args()
+
+    fixture_dir = args.fixture_dir or tempfile.mkdtemp(prefix='benchmark_')
+    config = dict(default_config, num_pmids=args.num_pmids)
+    file_paths = write_pmc_articles(os.path.join(fixture_dir, 'pmc'), args.num_articles, seed=args.seed, config=config)
+    medline_paths = write_medline_files(os.path.join(fixture_dir, 'medline'), args.num_medline_files, seed=args.seed, config=config)
+    # the same pmids the MEDLINE files hold
+    pmid2info = {str(pmid): None for pmid in range(1, int(config['num_pmids'] * config['corpus_share']) + 1)}
+
+    results = {
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': {'num_articles': args.num_articles, 'num_medline_files': args.num_medline_files, 'num_pmids': args.num_pmids,
+                   'repeats': args.repeats, 'seed': args.seed},
+        'micro': run_microbenchmarks(read_papers(file_paths), pmid2info, args.repeats),
+        'end_to_end': {paragraph_mode: run_end_to_end(file_paths, pmid2info, os.path.join(fixture_dir, 'output_' + paragraph_mode), paragraph_mode)
+                       for paragraph_mode in ('markup', 'tree')},
+        'medline': run_medline(medline_paths, os.path.join(fixture_dir, 'medline_shards')),
+    }
+
+    with open(args.output_path, 'w') as f:
+        json.dump(results, f, indent=4)
+
+    for name, result in results['micro'].items():
+        print('%s: %.2f us/call' % (name, result['us_per_call']))
+    for paragraph_mode, result in results['end_to_end'].items():
+        print('end to end %s: %.1f files/s, %.1f pairs/s' % (paragraph_mode, result['files_per_second'], result['pairs_per_second']))
+    print('medline:', results['medline'])
+
+    if args.compare_path is not None:
+        with open(args.compare_path, 'r') as f:
+            print('regressions', compare(json.load(f), results, args.tolerance))
+
+    if args.fixture_dir is None:
+        shutil.rmtree(fixture_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,416 @@
+import re
+from html import unescape
+from lxml import etree
+
+# Citation handling for the sentences of a paragraph. split_sentence_at_citations is the original multi pass
+# implementation, tokenize_citations produces the same parts in a single scan over the xref tags of a sentence and
+# falls back to split_sentence_at_citations for the few sentences where the passes interact in ways it does not model.
+
+non_xref_tag = re.compile(r'<(?![/]?xref)[^<]*?>')
+citation_range = re.compile(r'</xref>[^-;,]?[-;,][^-;,]?<xref')
+sub_citation = re.compile(r'</xref>\w{0,2}\)')
+
+# an xref tag as it appears in the tostring output of a paragraph, the attributes can not contain '<' or '>' and the
+# content is not empty. every pattern of split_sentence_at_citations matches such a tag as a whole
+xref_token = re.compile(r'(<xref [^<>\n]+>[^<\n]+</xref>)')
+# separators between citations that the last pass of split_sentence_at_citations removes
+citation_separator = re.compile(r'[-;,]?\s?')
+
+# an xref tag that lxml parses to exactly these attributes, everything else is left to etree.fromstring
+xref_element = re.compile(r'<xref((?: [A-Za-z_][A-Za-z0-9_.-]*="[^"<&\t\n\r]*")+)>[^<&]*</xref>')
+xref_attribute = re.compile(r' ([A-Za-z_][A-Za-z0-9_.-]*)="([^"]*)"')
+# sentences that only consist of a citation and no query
+citation_only_sentence = re.compile(r'^[\[(]?<xref .*?>.+?</xref>[\])]?$')
+# non-bibr "citations" that do not make a pair
+skipped_ref_types = ('fig', 'table', 'supplementary-material')
+
+invalid_xml_char = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]')
+xref_attrib_cache = {}
+max_cached_xrefs = 100000
+
+
+def get_paragraph_markup(paragraph):
+    paragraph_text = etree.tostring(paragraph).decode('us-ascii')
+
+    # remove opening and closing p-tag
+    paragraph_text = paragraph_text.replace('</p>', '')
+    paragraph_text = re.sub(r'<p xmlns.+?>', '', paragraph_text)  # remove xml declaration
+
+    return paragraph_text
+
+
+def cleanse_sentence(sent):
+    sent = unescape(sent)  # unescape html
+
+    sent = non_xref_tag.sub('', sent)  # remove non-xref tags
+    sent = citation_range.sub('</xref>,<xref', sent)  # replace citation ranges by comma separation
+    sent = sub_citation.sub('</xref>)', sent)  # remove sub-citation e.g. ""<ref>A"
+
+    sent = sent.replace('(e.g., <xref', '(<xref')
+    sent = sent.replace('(see <xref', '(<xref')
+    sent = sent.replace('</xref> and <xref', '</xref>,<xref')
+    sent = sent.replace('</xref>, and <xref', '</xref>,<xref')
+
+    return sent
+
+
+def split_sentence_at_citations(sent):
+    # split citations by delimiter [<xref, (<xref or white-space
+    sent_array = re.split(r'\[(<xref .+?>.+?</xref>)\]', sent)
+
+    first_partial_split_text = []
+    for part in sent_array:
+        first_partial_split_text.extend(re.split(r'\((<xref .+?>.+?</xref>)\)', part))
+
+    second_partial_split_text = []
+    for part in first_partial_split_text:
+        second_partial_split_text.extend(re.split(r' (<xref .+?>.+?</xref>)', part))
+
+    # handle cases, where spacy split sentences mid citation enumeration, this captures the first part
+    third_partial_split_text = []
+    for part in second_partial_split_text:
+        third_partial_split_text.extend(re.split(r'[([](<xref[^>]+>[^<]+</xref>(?:,<xref[^>]+>[^<]+</xref>)*)[;,]', part))
+
+    final_split_text = []
+    for part in third_partial_split_text:
+        # make sure to only split unprocessed sentences, i.e. they dont start with <xref
+        if not part.startswith('<xref') and '<xref' in part:
+            part = re.sub(r'</xref>[-;,]?\s?<xref', '</xref><xref', part)
+            final_split_text.extend(re.split(r'(<xref[^>]+>[^<]+</xref>)', part))
+        else:
+            final_split_text.append(part)
+
+    return final_split_text
+
+
+def find_bracket_groups(tokens, num_xrefs, opening, closing, group_end):
+    # adds the groups of one bracket pattern of split_sentence_at_citations to group_end, first xref -> last xref.
+    # the lazy match stops at the first citation followed by the closing bracket. returns False if a group would
+    # be split again by the later passes, i.e. a citation inside it follows white-space or a bracket
+    idx = 0
+    while idx < num_xrefs:
+        if idx in group_end:
+            idx = group_end[idx] + 1
+            continue
+        if not tokens[2 * idx].endswith(opening):
+            idx += 1
+            continue
+
+        end = idx
+        while end < num_xrefs and not tokens[2 * end + 2].startswith(closing):
+            end += 1
+            # the round brackets are only searched up to the next square bracket group
+            if end in group_end:
+                end = num_xrefs
+        if end == num_xrefs:
+            idx += 1
+            continue
+
+        for text_idx in range(idx + 1, end + 1):
+            if tokens[2 * text_idx].endswith((' ', '(', '[')):
+                return False
+
+        group_end[idx] = end
+        idx = end + 1
+
+    return True
+
+
+def tokenize_citations(sent):
+    # returns the non-empty parts of split_sentence_at_citations(sent) in one scan over its xref tags or None if
+    # the sentence has to go through split_sentence_at_citations
+    if '\n' in sent:
+        return None
+
+    # text and xref tags alternate, tokens[2 * i] is the text in front of the i-th tag
+    tokens = xref_token.split(sent)
+    num_xrefs = len(tokens) // 2
+    # every '<' has to belong to one of the tags, each tag contains two of them
+    if sent.count('<') != 2 * num_xrefs:
+        return None
+
+    group_end = {}
+    if '[<xref' in sent and not find_bracket_groups(tokens, num_xrefs, '[', ']', group_end):
+        return None
+    if '(<xref' in sent and not find_bracket_groups(tokens, num_xrefs, '(', ')', group_end):
+        return None
+
+    parts = []
+    # text and tags between the captured groups
+    piece = []
+    # characters at the start of the current text that were consumed with the previous group
+    skip = 0
+    idx = 0
+    while idx < num_xrefs:
+        text = tokens[2 * idx]
+        end = group_end.get(idx)
+        next_skip = 1
+        if end is not None:
+            # [<xref ...>...</xref>] or (<xref ...>...</xref>)
+            text = text[skip:-1]
+        elif text.endswith(' '):
+            # white-space followed by a citation
+            end = idx
+            text = text[skip:-1]
+            next_skip = 0
+        elif text.endswith(('(', '[')) and len(text) > skip:
+            # enumeration after an opening bracket that spacy split off before the closing one
+            end = idx
+            while end + 1 < num_xrefs and tokens[2 * end + 2] == ',':
+                end += 1
+            if not tokens[2 * end + 2].startswith((';', ',')):
+                # the pattern backtracks to the comma in front of the last citation
+                end = end - 1 if end > idx else None
+            if end is not None:
+                text = text[skip:-1]
+
+        if end is None:
+            text = text[skip:]
+            if text:
+                piece.append(text)
+            piece.append(tokens[2 * idx + 1])
+            skip = 0
+            idx += 1
+            continue
+
+        if text:
+            piece.append(text)
+        add_piece(parts, piece)
+        piece = []
+
+        parts.append(''.join(tokens[2 * idx + 1:2 * end + 2]))
+        skip = next_skip
+        idx = end + 1
+
+    text = tokens[-1][skip:]
+    if text:
+        piece.append(text)
+    add_piece(parts, piece)
+
+    return parts
+
+
+def add_piece(parts, piece):
+    # the last pass of split_sentence_at_citations, pieces starting with a citation stay as they are
+    if len(piece) < 2:
+        parts.extend(piece)
+        return
+
+    if not piece[0].startswith('<xref') and any(item.startswith('<xref') for item in piece):
+        previous_xref = False
+        for item_idx, item in enumerate(piece):
+            if item.startswith('<xref'):
+                parts.append(item)
+                previous_xref = True
+                continue
+
+            # separators between two citations are dropped
+            if previous_xref and item_idx + 1 < len(piece) and citation_separator.fullmatch(item):
+                continue
+            parts.append(item)
+            previous_xref = False
+    else:
+        parts.append(''.join(piece))
+
+
+def split_citations(sent):
+    split_text = tokenize_citations(sent)
+    if split_text is None:
+        split_text = split_sentence_at_citations(sent)
+
+    return split_text
+
+
+def get_citation_pairs(split_text, method='iterative'):
+    # (query, rids) pairs of a sentence split at its citations. iterative makes a pair at every citation with the
+    # query up to it, total one pair with the whole query and all citations. returns the pairs and, if a citation
+    # could not be parsed, the citation and its exception. iterative keeps the pairs before such a citation
+    query = ''
+    xref_ids = []
+    citation_pairs = []
+    for part in split_text:
+        if '</xref>' not in part:
+            query += part.rstrip()
+            continue
+
+        # filter out citations for empty queries
+        if query == '':
+            continue
+
+        # handle citation enumeration
+        if '</xref>,<xref' in part:
+            for citation in part.split(','):
+                try:
+                    xref_attrib = parse_xref_attrib(citation)
+                except Exception as e:
+                    return citation_pairs, (citation, e)
+
+                if xref_attrib['ref-type'] in skipped_ref_types:
+                    continue
+
+                xref_ids.append(xref_attrib['rid'])
+        else:
+            try:
+                xref_attrib = parse_xref_attrib(part)
+            except Exception as e:
+                return citation_pairs, (part, e)
+
+            if xref_attrib['ref-type'] in skipped_ref_types:
+                continue
+
+            xref_ids.append(xref_attrib['rid'])
+
+        if method == 'iterative':
+            citation_pairs.append((query, xref_ids))
+            xref_ids = []
+
+    if method == 'total':
+        citation_pairs.append((query, xref_ids))
+
+    return citation_pairs, None
+
+
+def parse_xref_attrib(citation):
+    # attributes of a single xref tag, same result or exception as etree.fromstring(citation).attrib.
+    # the same tags come up again and again within a paper, parsed tags are cached and must not be modified
+    attrib = xref_attrib_cache.get(citation)
+    if attrib is not None:
+        return attrib
+    if len(xref_attrib_cache) >= max_cached_xrefs:
+        xref_attrib_cache.clear()
+
+    attrib = parse_xref_tag(citation)
+    xref_attrib_cache[citation] = attrib
+
+    return attrib
+
+
+def parse_xref_tag(citation):
+    match = xref_element.fullmatch(citation)
+    if match is not None and ']]>' not in citation and not invalid_xml_char.search(citation):
+        attributes = xref_attribute.findall(match.group(1))
+        attrib = dict(attributes)
+        # duplicate attributes and namespace declarations are left to lxml
+        if len(attrib) == len(attributes) and not any(name.lower().startswith('xml') for name in attrib):
+            return attrib
+
+    return etree.fromstring(citation).attrib
+
+
+# Citations on the plain text of a paragraph, used when the paragraphs are taken from the element tree instead of
+# their markup. A citation is the character span of an xref element in the text, (start, end, ref-type, rid).
+
+# text between citations of one enumeration or range, e.g. "1, 2", "1-3" or "1 and 2"
+citation_delimiter = re.compile(r'\s*(?:[-\u2013\u2014;,]|,? and)?\s*')
+# brackets around an enumeration, the cue words are the ones cleanse_sentence removes
+citation_opening = re.compile(r'[(\[](?:e\.g\., |see )?$')
+citation_closing = re.compile(r'[)\]]')
+
+
+def get_paragraph_citations(paragraph):
+    # plain text of a paragraph element and the spans of its xref elements, the text of every other element is
+    # kept, comments and processing instructions are dropped
+    texts = []
+    citations = []
+    collect_text(paragraph, texts, citations, 0, False)
+
+    return ''.join(texts), citations
+
+
+def collect_text(element, texts, citations, length, in_xref):
+    # appends the text inside element to texts and returns the new text length, xrefs inside xrefs are not citations
+    if element.text:
+        texts.append(element.text)
+        length += len(element.text)
+
+    for child in element:
+        if isinstance(child.tag, str):
+            start = length
+            is_xref = child.tag == 'xref' and not in_xref
+            length = collect_text(child, texts, citations, length, in_xref or is_xref)
+            if is_xref:
+                citations.append((start, length, child.get('ref-type'), child.get('rid')))
+
+        if child.tail:
+            texts.append(child.tail)
+            length += len(child.tail)
+
+    return length
+
+
+def group_citations(text, start, end, citations):
+    # splits the sentence text[start:end] into (text, citations) segments, every segment holds the text in front
+    # of an enumeration of citations and the enumeration itself. brackets around an enumeration and the
+    # delimiters inside it are dropped, the last segment holds the rest of the sentence and no citations
+    segments = []
+    position = start
+    idx = 0
+    while idx < len(citations):
+        group_start, group_end = citations[idx][:2]
+        last = idx
+        while last + 1 < len(citations) and citation_delimiter.fullmatch(text, group_end, citations[last + 1][0]):
+            last += 1
+            group_end = citations[last][1]
+
+        segment_text = text[position:group_start]
+        closing = citation_closing.match(text, group_end, end)
+        opening = citation_opening.search(segment_text)
+        if opening is not None and closing is not None:
+            segment_text = segment_text[:opening.start()]
+            group_end = closing.end()
+
+        segments.append((segment_text, citations[idx:last + 1]))
+        position = group_end
+        idx = last + 1
+
+    segments.append((text[position:end], []))
+
+    return segments
+
+
+def get_span_citation_pairs(paragraph_text, citations, sentence_spans, method='iterative'):
+    # same pairs as get_citation_pairs for the sentences of a plain paragraph text, its citations are spans
+    citation_pairs = []
+    citation_idx = 0
+    sentence_start = None
+    for sentence_idx, (start, end) in enumerate(sentence_spans):
+        if sentence_start is None:
+            sentence_start = start
+
+        # citations are sorted by their offsets, take the ones that start inside the sentence
+        last_idx = citation_idx
+        while last_idx < len(citations) and citations[last_idx][0] < end:
+            last_idx += 1
+
+        # a sentence boundary inside a citation is ignored, the sentence continues with the next one
+        if last_idx > citation_idx and citations[last_idx - 1][1] > end and sentence_idx + 1 < len(sentence_spans):
+            continue
+
+        sentence_citations = citations[citation_idx:last_idx]
+        citation_idx = last_idx
+        start = sentence_start
+        sentence_start = None
+
+        # skip sentences without bibr citations
+        if not any(ref_type == 'bibr' for _, _, ref_type, _ in sentence_citations):
+            continue
+
+        query = ''
+        xref_ids = []
+        for segment_text, segment_citations in group_citations(paragraph_text, start, end, sentence_citations):
+            query += segment_text.rstrip()
+
+            # filter out citations for empty queries
+            if query == '' or len(segment_citations) == 0:
+                continue
+
+            xref_ids.extend(rid for _, _, ref_type, rid in segment_citations if ref_type not in skipped_ref_types)
+
+            if method == 'iterative':
+                citation_pairs.append((query, xref_ids))
+                xref_ids = []
+
+        if method == 'total':
+            citation_pairs.append((query, xref_ids))
+
+    return citation_pairs
@@ -0,0 +1,239 @@
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from tqdm import tqdm
+
+# A corpus store is a directory with
+#   texts.bin    utf-8 titles and abstracts, one record after the other
+#   records.bin  per record: pmid, offset into texts.bin, title length and abstract length in bytes
+#   table.bin    uint32 per pmid, number of its record + 1 or 0 if the pmid is not in the corpus
+#   meta.json    number of pmids, the byte order of table.bin and the applied pubmed update files
+# Lookups are two array reads, opening only maps the files.
+
+record_struct = struct.Struct('<IQII')
+
+
+def map_file(path):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class CorpusStore:
+    # read-only, dict-like view of pmid2info: store[pmid] -> [title, abstract], keys are pmid strings
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+
+        with open(os.path.join(store_dir, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        if self.meta['byteorder'] != sys.byteorder:
+            raise ValueError('corpus store was written with byte order ' + self.meta['byteorder'])
+
+        self.texts = map_file(os.path.join(store_dir, 'texts.bin'))
+        self.records = map_file(os.path.join(store_dir, 'records.bin'))
+        self.table = memoryview(map_file(os.path.join(store_dir, 'table.bin'))).cast('I')
+
+    def record_idx(self, pmid):
+        if isinstance(pmid, str):
+            if not pmid.isascii() or not pmid.isdigit() or pmid.startswith('0'):
+                return -1
+            pmid = int(pmid)
+
+        if pmid < 0 or pmid >= len(self.table):
+            return -1
+
+        return self.table[pmid] - 1
+
+    def read_record(self, record_idx):
+        _, offset, title_len, abstract_len = record_struct.unpack_from(self.records, record_idx * record_struct.size)
+        title = self.texts[offset:offset + title_len].decode('utf-8')
+        abstract = self.texts[offset + title_len:offset + title_len + abstract_len].decode('utf-8')
+
+        return [title, abstract]
+
+    def __contains__(self, pmid):
+        return self.record_idx(pmid) >= 0
+
+    def __getitem__(self, pmid):
+        record_idx = self.record_idx(pmid)
+        if record_idx < 0:
+            raise KeyError(pmid)
+
+        return self.read_record(record_idx)
+
+    def get(self, pmid, default=None):
+        record_idx = self.record_idx(pmid)
+        if record_idx < 0:
+            return default
+
+        return self.read_record(record_idx)
+
+    def get_many(self, pmids, default=None):
+        # reads the records in file order, which keeps the disk access sequential for large batches
+        record_idxs = [self.record_idx(pmid) for pmid in pmids]
+        infos = [default] * len(record_idxs)
+        for idx in sorted(range(len(record_idxs)), key=record_idxs.__getitem__):
+            if record_idxs[idx] >= 0:
+                infos[idx] = self.read_record(record_idxs[idx])
+
+        return infos
+
+    def __len__(self):
+        return self.meta['num_pmids']
+
+    def __iter__(self):
+        # pmids in ascending order
+        for pmid, record_idx in enumerate(self.table):
+            if record_idx != 0:
+                yield str(pmid)
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        for pmid, record_idx in enumerate(self.table):
+            if record_idx != 0:
+                yield str(pmid), self.read_record(record_idx - 1)
+
+
+class CorpusStoreWriter:
+    # appends records to a new store, a pmid that is added again replaces its earlier record.
+    # with append=True the records are appended to an existing store instead, e.g. for the pubmed update files
+
+    def __init__(self, store_dir, append=False):
+        self.store_dir = store_dir
+        self.append = append
+        self.applied_updates = []
+
+        if append:
+            with open(os.path.join(store_dir, 'meta.json'), 'r') as f:
+                self.applied_updates = json.load(f).get('applied_updates', [])
+
+            # an interrupted update can leave a partially written record behind, the table never points to it
+            records_path = os.path.join(store_dir, 'records.bin')
+            self.num_records = os.path.getsize(records_path) // record_struct.size
+            os.truncate(records_path, self.num_records * record_struct.size)
+
+            self.texts = open(os.path.join(store_dir, 'texts.bin'), 'ab')
+            self.records = open(records_path, 'ab')
+            self.text_offset = self.texts.tell()
+
+            self.table = array('I')
+            with open(os.path.join(store_dir, 'table.bin'), 'rb') as f:
+                self.table.frombytes(f.read())
+            self.num_pmids = len(self.table) - self.table.count(0)
+            return
+
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        if os.path.exists(os.path.join(store_dir, 'meta.json')):
+            os.remove(os.path.join(store_dir, 'meta.json'))
+
+        self.texts = open(os.path.join(store_dir, 'texts.bin.tmp'), 'wb')
+        self.records = open(os.path.join(store_dir, 'records.bin.tmp'), 'wb')
+        self.table = array('I')
+        self.text_offset = 0
+        self.num_records = 0
+        self.num_pmids = 0
+
+    def add(self, pmid, title, abstract):
+        pmid = int(pmid)
+        title = title.encode('utf-8')
+        abstract = abstract.encode('utf-8')
+
+        self.texts.write(title)
+        self.texts.write(abstract)
+        self.records.write(record_struct.pack(pmid, self.text_offset, len(title), len(abstract)))
+        self.text_offset += len(title) + len(abstract)
+
+        if pmid >= len(self.table):
+            self.table.frombytes(bytes(4 * (pmid + 1 - len(self.table))))
+        if self.table[pmid] == 0:
+            self.num_pmids += 1
+        self.num_records += 1
+        self.table[pmid] = self.num_records
+
+    def delete(self, pmid):
+        # the text stays in texts.bin, only the table entry is removed
+        pmid = int(pmid)
+        if pmid < len(self.table) and self.table[pmid] != 0:
+            self.table[pmid] = 0
+            self.num_pmids -= 1
+
+    def write_table_and_meta(self):
+        with open(os.path.join(self.store_dir, 'table.bin.tmp'), 'wb') as f:
+            self.table.tofile(f)
+        os.replace(os.path.join(self.store_dir, 'table.bin.tmp'), os.path.join(self.store_dir, 'table.bin'))
+
+        # meta.json is written last, a store without it is incomplete
+        meta = {'num_pmids': self.num_pmids, 'num_records': self.num_records, 'byteorder': sys.byteorder, 'applied_updates': self.applied_updates}
+        with open(os.path.join(self.store_dir, 'meta.json.tmp'), 'w') as f:
+            json.dump(meta, f, indent=4)
+        os.replace(os.path.join(self.store_dir, 'meta.json.tmp'), os.path.join(self.store_dir, 'meta.json'))
+
+    def checkpoint(self, applied_update=None):
+        # makes everything added so far visible to newly opened stores, only possible when appending
+        self.texts.flush()
+        os.fsync(self.texts.fileno())
+        self.records.flush()
+        os.fsync(self.records.fileno())
+
+        if applied_update is not None:
+            self.applied_updates.append(applied_update)
+        self.write_table_and_meta()
+
+    def close(self):
+        if self.append:
+            self.checkpoint()
+            self.texts.close()
+            self.records.close()
+            return
+
+        self.texts.close()
+        self.records.close()
+        for name in ['texts.bin', 'records.bin']:
+            os.replace(os.path.join(self.store_dir, name + '.tmp'), os.path.join(self.store_dir, name))
+
+        self.write_table_and_meta()
+
+
+def load_pmid2info(pmid2info_path):
+    # pmid2info can either be the json dict written by parse_pubmed_data.py or a corpus store directory
+    if os.path.isdir(pmid2info_path):
+        return CorpusStore(pmid2info_path)
+
+    with open(pmid2info_path, 'r') as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        '--pmid2info_path',
+        type=str,
+        required=True
+    )
+    parser.add_argument(
+        '--store_dir',
+        type=str,
+        required=True
+    )
+
+    args = parser.parse_args()
+
+    with open(args.pmid2info_path, 'r') as f:
+        pmid2info = json.load(f)
+
+    writer = CorpusStoreWriter(args.store_dir)
+    for pmid, (title, abstract) in tqdm(pmid2info.items()):
+        writer.add(pmid, title, abstract)
+    writer.close()
+
+    print('num pmids', len(CorpusStore(args.store_dir)))
@@ -0,0 +1,132 @@
+import hashlib
+import heapq
+import json
+import os
+import shutil
+
+# Memory-bounded diagnostics of an extraction run: an exact count and a fixed-size sample of the entries of every
+# category, e.g. the papers without reference list, and the size of the error log. Like the metrics they are a plain
+# dict, checkpointed in the run manifest and merged across shards.
+# The sample of a category holds the sample_size entries with the smallest hashes, a uniform sample of the distinct
+# entries. It does not depend on the order the entries come in, so the merged samples of the shards of a parallel run
+# are the samples a serial run keeps.
+
+default_sample_size = 10
+default_error_log_size = 100 * 2 ** 20
+
+
+def new_diagnostics(sample_size=default_sample_size, error_log_size=default_error_log_size):
+    return {
+        'sample_size': sample_size,
+        'counts': {},
+        # per category a max-heap of [-hash, entry] of the sampled entries
+        'samples': {},
+        # the error log is written up to error_log_size bytes, the entries beyond are only counted in error_log_entries
+        'error_log_size': error_log_size,
+        'error_log_bytes': 0,
+        'error_log_entries': 0,
+        'error_log_truncated': False,
+    }
+
+
+def entry_hash(entry):
+    return int.from_bytes(hashlib.blake2b(json.dumps(entry, ensure_ascii=False).encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def add_entry(diagnostics, category, entry):
+    diagnostics['counts'][category] = diagnostics['counts'].get(category, 0) + 1
+
+    sample = diagnostics['samples'].setdefault(category, [])
+    key = -entry_hash(entry)
+    if len(sample) < diagnostics['sample_size']:
+        heapq.heappush(sample, [key, entry])
+    elif key > sample[0][0] and all(sampled_key != key for sampled_key, _ in sample):
+        heapq.heapreplace(sample, [key, entry])
+
+
+def add_error_log_entry(diagnostics, entry, log_entries):
+    # counts an entry of the error log and keeps it in log_entries until the next write, unless the log is full
+    diagnostics['error_log_entries'] += 1
+    if not diagnostics['error_log_truncated']:
+        log_entries.append(entry)
+
+
+def fit_error_log_entries(diagnostics, log_entries):
+    # the entries that are written, in their order up to the size limit of the log
+    written = []
+    for entry in log_entries:
+        size = len(entry.encode('utf-8'))
+        if diagnostics['error_log_truncated'] or diagnostics['error_log_bytes'] + size > diagnostics['error_log_size']:
+            diagnostics['error_log_truncated'] = True
+            break
+        diagnostics['error_log_bytes'] += size
+        written.append(entry)
+
+    return written
+
+
+def get_count(diagnostics, category):
+    return diagnostics['counts'].get(category, 0)
+
+
+def get_sample(diagnostics, category):
+    # the sampled entries in hash order, json turns tuples into lists, they are restored so they print like tuples
+    return [tuple(entry) if isinstance(entry, list) else entry for _, entry in sorted(diagnostics['samples'].get(category, []), reverse=True)]
+
+
+def merge_diagnostics(diagnostics_list, sample_size=default_sample_size, error_log_size=default_error_log_size):
+    # the error log counts of the shards are summed, the caller copies the shard logs with copy_error_log and sets
+    # error_log_bytes
+    merged = new_diagnostics(sample_size, error_log_size)
+    samples = {}
+    for diagnostics in diagnostics_list:
+        for category, count in diagnostics['counts'].items():
+            merged['counts'][category] = merged['counts'].get(category, 0) + count
+        for category, sample in diagnostics['samples'].items():
+            for key, entry in sample:
+                samples.setdefault(category, {})[key] = entry
+        merged['error_log_entries'] += diagnostics['error_log_entries']
+        merged['error_log_truncated'] = merged['error_log_truncated'] or diagnostics['error_log_truncated']
+
+    for category, entries in samples.items():
+        merged['samples'][category] = [[key, entries[key]] for key in heapq.nlargest(sample_size, entries)]
+        heapq.heapify(merged['samples'][category])
+
+    return merged
+
+
+def find_entry_end(f, size, budget, window=2 ** 20):
+    # end of the last whole entry in the first budget bytes of the log, entries end with an empty line
+    end = min(size, budget)
+    while end > 0:
+        start = max(0, end - window)
+        f.seek(start)
+        position = f.read(end - start).rfind(b'\n\n')
+        if position >= 0:
+            return start + position + 2
+        if start == 0:
+            break
+        # the windows overlap by a byte, so an empty line across their border is found
+        end = start + 1
+
+    return 0
+
+
+def copy_error_log(source_path, target, budget):
+    # appends the error log of a shard to the merged log, at most budget bytes cut after an empty line, returns the
+    # number of bytes copied and whether the log was cut. an entry with an empty line in its text may be cut within
+    size = os.path.getsize(source_path)
+    with open(source_path, 'rb') as f:
+        if size <= budget:
+            shutil.copyfileobj(f, target)
+            return size, False
+
+        end = find_entry_end(f, size, budget)
+        f.seek(0)
+        remaining = end
+        while remaining > 0:
+            chunk = f.read(min(remaining, 2 ** 20))
+            target.write(chunk)
+            remaining -= len(chunk)
+
+    return end, True
@@ -0,0 +1,176 @@
+import argparse
+import hashlib
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+# A doi index maps the normalized dois of the pubmed articles to their pmids. It is an open addressing hash table of
+# 64 bit doi hashes and uint32 pmids, with at most half of the slots used, written in little endian:
+#   header  b'doi2pmid', number of slots, number of dois
+#   keys    uint64 per slot, blake2b hash of the doi or 0 for an empty slot
+#   pmids   uint32 per slot
+# A lookup hashes the doi and probes a few slots of the memory-mapped file, the dois themselves are not stored.
+
+header_struct = struct.Struct('<8sQQ')
+index_magic = b'doi2pmid'
+
+doi_prefixes = ('https://doi.org/', 'http://doi.org/', 'https://dx.doi.org/', 'http://dx.doi.org/', 'doi:')
+
+
+def normalize_doi(doi):
+    # dois are case insensitive, references often write them as urls or with a "doi:" prefix
+    if doi is None:
+        return ''
+
+    doi = doi.strip().lower()
+    for prefix in doi_prefixes:
+        if doi.startswith(prefix):
+            doi = doi[len(prefix):].strip()
+            break
+
+    return doi if doi.startswith('10.') else ''
+
+
+def hash_doi(doi):
+    # 0 marks an empty slot
+    return int.from_bytes(hashlib.blake2b(doi.encode('utf-8'), digest_size=8).digest(), 'little') or 1
+
+
+class DoiIndex:
+    # read-only doi -> pmid lookup backed by a memory-mapped doi index, forked workers share the pages
+
+    def __init__(self, index_path):
+        if sys.byteorder != 'little':
+            raise ValueError('doi index is little endian, it cannot be mapped on a ' + sys.byteorder + ' endian machine')
+
+        self.index_path = index_path
+        with open(index_path, 'rb') as f:
+            self.index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.num_slots, self.num_dois = header_struct.unpack_from(self.index, 0)
+        if magic != index_magic:
+            raise ValueError(index_path + ' is not a doi index')
+
+        keys_offset = header_struct.size
+        pmids_offset = keys_offset + 8 * self.num_slots
+        self.keys = memoryview(self.index)[keys_offset:pmids_offset].cast('Q')
+        self.pmids = memoryview(self.index)[pmids_offset:pmids_offset + 4 * self.num_slots].cast('I')
+
+    def get(self, doi, default=None):
+        doi = normalize_doi(doi)
+        if doi == '':
+            return default
+
+        key = hash_doi(doi)
+        slot = key & (self.num_slots - 1)
+        while self.keys[slot] != 0:
+            if self.keys[slot] == key:
+                return self.pmids[slot]
+            slot = (slot + 1) & (self.num_slots - 1)
+
+        return default
+
+    def __contains__(self, doi):
+        return self.get(doi) is not None
+
+    def __len__(self):
+        return self.num_dois
+
+
+class DoiIndexWriter:
+    # builds the hash table in memory, a doi that is added again is mapped to the pmid it was added with last
+
+    def __init__(self, num_dois=0):
+        self.num_slots = 1024
+        while self.num_slots < 2 * num_dois:
+            self.num_slots *= 2
+        self.keys = array('Q', bytes(8 * self.num_slots))
+        self.pmids = array('I', bytes(4 * self.num_slots))
+        self.num_dois = 0
+
+    @classmethod
+    def from_index(cls, index_path):
+        # loads an existing index to add the dois of the pubmed update files
+        index = DoiIndex(index_path)
+        writer = cls()
+        writer.num_slots = index.num_slots
+        # frombytes copies the mapped tables at once, array() would read them element by element
+        writer.keys = array('Q')
+        writer.keys.frombytes(index.keys.cast('B'))
+        writer.pmids = array('I')
+        writer.pmids.frombytes(index.pmids.cast('B'))
+        writer.num_dois = index.num_dois
+        index.keys.release()
+        index.pmids.release()
+        index.index.close()
+
+        return writer
+
+    def add(self, doi, pmid):
+        doi = normalize_doi(doi)
+        if doi == '':
+            return
+
+        if 2 * (self.num_dois + 1) > self.num_slots:
+            self.grow()
+        self.insert(hash_doi(doi), int(pmid))
+
+    def insert(self, key, pmid):
+        slot = key & (self.num_slots - 1)
+        while self.keys[slot] != 0 and self.keys[slot] != key:
+            slot = (slot + 1) & (self.num_slots - 1)
+
+        if self.keys[slot] == 0:
+            self.keys[slot] = key
+            self.num_dois += 1
+        self.pmids[slot] = pmid
+
+    def grow(self):
+        keys, pmids = self.keys, self.pmids
+        self.num_slots *= 2
+        self.keys = array('Q', bytes(8 * self.num_slots))
+        self.pmids = array('I', bytes(4 * self.num_slots))
+        self.num_dois = 0
+        for key, pmid in zip(keys, pmids):
+            if key != 0:
+                self.insert(key, pmid)
+
+    def write(self, index_path):
+        # write to a temporary file first, so processes that have the old index mapped are not affected
+        keys, pmids = self.keys, self.pmids
+        if sys.byteorder != 'little':
+            keys, pmids = array('Q', keys), array('I', pmids)
+            keys.byteswap()
+            pmids.byteswap()
+
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(header_struct.pack(index_magic, self.num_slots, self.num_dois))
+            keys.tofile(f)
+            pmids.tofile(f)
+        os.replace(tmp_path, index_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        '--index_path',
+        type=str,
+        required=True,
+        help='doi index written by parse_pubmed_data.py'
+    )
+    parser.add_argument(
+        'dois',
+        nargs='*',
+        help='dois to look up'
+    )
+
+    args = parser.parse_args()
+
+    doi2pmid = DoiIndex(args.index_path)
+    print('num dois', len(doi2pmid))
+    for doi in args.dois:
+        print(doi, doi2pmid.get(doi))
@@ -0,0 +1,88 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tqdm import tqdm
+
+# Verifies files against the md5 sums pubmed publishes next to them in <file>.md5. Files are read in chunks and hashed
+# by a thread pool, hashlib releases the GIL while it hashes a chunk. The md5, size and mtime of every hashed file are
+# recorded in a manifest, files whose size and mtime did not change are not read again on later runs.
+
+chunk_size = 8 * 2 ** 20
+
+
+def md5_file(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            md5.update(chunk)
+
+    return md5.hexdigest()
+
+
+def read_md5_sum(md5_path):
+    # e.g. "MD5(pubmed24n0001.xml.gz)= 0123456789abcdef0123456789abcdef"
+    if not os.path.exists(md5_path):
+        return None
+
+    with open(md5_path, 'r') as f:
+        return f.read().split()[-1].lower()
+
+
+def load_verification_manifest(manifest_path):
+    if manifest_path is None or not os.path.exists(manifest_path):
+        return {}
+
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def write_verification_manifest(manifest_path, manifest):
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def hash_file(path):
+    # size and mtime are taken before reading, a file that changes while it is hashed is hashed again next time
+    stat = os.stat(path)
+    return path, {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'md5': md5_file(path)}
+
+
+def verify_files(file_paths, manifest_path=None, threads=8, show_progress=True):
+    # returns 'correct', 'corrupted' or 'no md5 file' for every path
+    manifest = load_verification_manifest(manifest_path)
+
+    to_hash = []
+    for path in file_paths:
+        entry = manifest.get(os.path.abspath(path))
+        stat = os.stat(path)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime_ns:
+            to_hash.append(path)
+
+    with ThreadPoolExecutor(threads) as pool:
+        futures = [pool.submit(hash_file, path) for path in to_hash]
+        for num_hashed, future in enumerate(tqdm(as_completed(futures), total=len(futures), disable=not show_progress)):
+            path, entry = future.result()
+            manifest[os.path.abspath(path)] = entry
+            # an interrupted verification keeps the files hashed so far
+            if manifest_path is not None and num_hashed % 100 == 99:
+                write_verification_manifest(manifest_path, manifest)
+
+    if manifest_path is not None:
+        write_verification_manifest(manifest_path, manifest)
+
+    statuses = {}
+    for path in file_paths:
+        md5_sum = read_md5_sum(path + '.md5')
+        if md5_sum is None:
+            statuses[path] = 'no md5 file'
+        elif manifest[os.path.abspath(path)]['md5'] == md5_sum:
+            statuses[path] = 'correct'
+        else:
+            statuses[path] = 'corrupted'
+
+    return statuses
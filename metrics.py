@@ -0,0 +1,181 @@
+import cProfile
+import heapq
+import math
+import os
+import pstats
+import tracemalloc
+
+# Per stage and per file timings of an extraction run. The metrics are a plain dict, so they are checkpointed in the
+# manifest with the run stats and the metrics of shards are merged like the run stats. summarize_metrics turns them
+# into the metrics.json report. Every extract method keeps its own metrics in its manifest, the stage timings are those
+# of the shared processing, num_pairs counts the pairs of the method.
+
+# parse: xml parsing and paragraph extraction, refmap: pmc id and reference dict, segmentation: sentence splitting of
+# the paragraphs, citation_split: cleansing and splitting the sentences at their citations, pair_generation: reading the
+# cited reference ids and looking up their pmids, output: writing the pairs of all extract methods
+stage_names = ('parse', 'refmap', 'segmentation', 'citation_split', 'pair_generation', 'output')
+
+# histogram bucket i counts the durations in [2^(i-1), 2^i) microseconds, the last bucket everything longer
+num_histogram_buckets = 40
+num_slowest_files = 20
+num_top_allocations = 25
+
+
+def new_metrics():
+    return {
+        'num_files': 0,
+        'num_pairs': 0,
+        'wall_seconds': 0,
+        'stages': {name: {'seconds': 0, 'max_seconds': 0, 'histogram': [0] * num_histogram_buckets} for name in stage_names},
+        'file_histogram': [0] * num_histogram_buckets,
+        # min-heap of [seconds, file, seconds per stage] of the slowest files
+        'slowest_files': [],
+    }
+
+
+def histogram_bucket(seconds):
+    microseconds = seconds * 1e6
+    if microseconds < 1:
+        return 0
+    return min(int(math.log2(microseconds)) + 1, num_histogram_buckets - 1)
+
+
+def add_file_metrics(metrics, file, stage_seconds, num_pairs):
+    # stage_seconds: seconds per stage spent on the file, stages the file did not reach are missing
+    file_seconds = 0
+    for name, seconds in stage_seconds.items():
+        stage = metrics['stages'][name]
+        stage['seconds'] += seconds
+        stage['max_seconds'] = max(stage['max_seconds'], seconds)
+        stage['histogram'][histogram_bucket(seconds)] += 1
+        file_seconds += seconds
+
+    metrics['num_files'] += 1
+    metrics['num_pairs'] += num_pairs
+    metrics['file_histogram'][histogram_bucket(file_seconds)] += 1
+
+    entry = [file_seconds, file, stage_seconds]
+    if len(metrics['slowest_files']) < num_slowest_files:
+        heapq.heappush(metrics['slowest_files'], entry)
+    elif file_seconds > metrics['slowest_files'][0][0]:
+        heapq.heapreplace(metrics['slowest_files'], entry)
+
+
+def merge_metrics(metrics_list):
+    # wall_seconds is summed, a parallel run replaces it with its own wall time
+    merged = new_metrics()
+    for metrics in metrics_list:
+        merged['num_files'] += metrics['num_files']
+        merged['num_pairs'] += metrics['num_pairs']
+        merged['wall_seconds'] += metrics['wall_seconds']
+        for name in stage_names:
+            stage = metrics['stages'][name]
+            merged_stage = merged['stages'][name]
+            merged_stage['seconds'] += stage['seconds']
+            merged_stage['max_seconds'] = max(merged_stage['max_seconds'], stage['max_seconds'])
+            merged_stage['histogram'] = [a + b for a, b in zip(merged_stage['histogram'], stage['histogram'])]
+        merged['file_histogram'] = [a + b for a, b in zip(merged['file_histogram'], metrics['file_histogram'])]
+        merged['slowest_files'].extend(metrics['slowest_files'])
+
+        # with tracemalloc the shard with the highest peak is kept
+        if 'tracemalloc' in metrics and metrics['tracemalloc']['peak_bytes'] > merged.get('tracemalloc', {'peak_bytes': -1})['peak_bytes']:
+            merged['tracemalloc'] = metrics['tracemalloc']
+
+    merged['slowest_files'] = heapq.nlargest(num_slowest_files, merged['slowest_files'], key=lambda entry: entry[0])
+    heapq.heapify(merged['slowest_files'])
+
+    return merged
+
+
+def histogram_percentile(histogram, fraction):
+    # upper bound in seconds of the bucket that holds the percentile
+    total = sum(histogram)
+    if total == 0:
+        return None
+
+    count = 0
+    for bucket, bucket_count in enumerate(histogram):
+        count += bucket_count
+        if count >= fraction * total:
+            return 2 ** bucket / 1e6
+
+
+def summarize_histogram(histogram):
+    return {
+        'p50_seconds_upper_bound': histogram_percentile(histogram, 0.5),
+        'p90_seconds_upper_bound': histogram_percentile(histogram, 0.9),
+        'p99_seconds_upper_bound': histogram_percentile(histogram, 0.99),
+        # upper bound in microseconds of every non-empty bucket and its count
+        'buckets_us': {str(2 ** bucket): count for bucket, count in enumerate(histogram) if count > 0},
+    }
+
+
+def summarize_metrics(metrics):
+    wall_seconds = metrics['wall_seconds']
+    total_stage_seconds = sum(metrics['stages'][name]['seconds'] for name in stage_names)
+
+    stages = {}
+    for name in stage_names:
+        stage = metrics['stages'][name]
+        stages[name] = {
+            'seconds': stage['seconds'],
+            'share': stage['seconds'] / total_stage_seconds if total_stage_seconds > 0 else None,
+            'mean_seconds_per_file': stage['seconds'] / metrics['num_files'] if metrics['num_files'] > 0 else None,
+            'max_seconds': stage['max_seconds'],
+            'histogram': summarize_histogram(stage['histogram']),
+        }
+
+    summary = {
+        'num_files': metrics['num_files'],
+        'num_pairs': metrics['num_pairs'],
+        'wall_seconds': wall_seconds,
+        'files_per_second': metrics['num_files'] / wall_seconds if wall_seconds > 0 else None,
+        'pairs_per_second': metrics['num_pairs'] / wall_seconds if wall_seconds > 0 else None,
+        'stages': stages,
+        'file_histogram': summarize_histogram(metrics['file_histogram']),
+        'slowest_files': [{'file': file, 'seconds': seconds, 'stage_seconds': stage_seconds}
+                          for seconds, file, stage_seconds in sorted(metrics['slowest_files'], key=lambda entry: -entry[0])],
+    }
+    if 'tracemalloc' in metrics:
+        summary['tracemalloc'] = metrics['tracemalloc']
+
+    return summary
+
+
+def start_profiling(profile_modes):
+    # profile_modes: 'cprofile' and/or 'tracemalloc', returns the profiler for stop_profiling
+    profiler = None
+    if 'cprofile' in profile_modes:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if 'tracemalloc' in profile_modes:
+        tracemalloc.start()
+
+    return profiler
+
+
+def stop_profiling(profile_modes, profiler, metrics_list, profile_paths):
+    # the cProfile stats are written to profile_paths, the tracemalloc peak and top allocations go into every metrics of
+    # metrics_list
+    if profiler is not None:
+        profiler.disable()
+        for profile_path in profile_paths:
+            profiler.dump_stats(profile_path)
+
+    if 'tracemalloc' in profile_modes:
+        snapshot = tracemalloc.take_snapshot()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        tracemalloc_stats = {
+            'peak_bytes': peak_bytes,
+            'top_allocations': [{'location': str(stat.traceback), 'bytes': stat.size, 'count': stat.count}
+                                for stat in snapshot.statistics('lineno')[:num_top_allocations]],
+        }
+        for metrics in metrics_list:
+            metrics['tracemalloc'] = tracemalloc_stats
+
+
+def merge_profiles(profile_paths, output_path):
+    profile_paths = [profile_path for profile_path in profile_paths if os.path.exists(profile_path)]
+    if len(profile_paths) > 0:
+        pstats.Stats(*profile_paths).dump_stats(output_path)
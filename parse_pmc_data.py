@@ -1,18 +1,110 @@
 from lxml import etree
 from tqdm import tqdm
-from html import unescape
-import spacy
 import json
 import os
-import re
 import time
 import argparse
+import shutil
+from io import BytesIO
+from segmenters import load_segmenter, segmenter_loaders
+from segmentation_cache import SegmentationCache, get_segmenter_id
+from pmid_index import PmidSet
+from doi_index import DoiIndex
+from pmc_packages import PackageReader, is_package_article, list_package_articles
+from diagnostics import new_diagnostics, add_entry, add_error_log_entry, fit_error_log_entries, get_count, get_sample, merge_diagnostics, copy_error_log, \
+    default_sample_size, default_error_log_size
+from metrics import new_metrics, add_file_metrics, merge_metrics, summarize_metrics, start_profiling, stop_profiling, merge_profiles
+from corpus_store import load_pmid2info
+from article_watchdog import set_heartbeat, clear_heartbeat, read_quarantine, add_to_quarantine, run_watched
+from query_dedup import dedup_queries, format_dedup_stats, default_threshold, default_memory_size
+from citations import get_paragraph_markup, cleanse_sentence, citation_only_sentence, split_citations, get_citation_pairs, get_paragraph_citations, get_span_citation_pairs
+
+
+# Settings of the extraction, main() sets them from the command line. The defaults are those of the command line, so
+# the functions can be imported and used without main().
+file_batch_size = 32
+segment_batch_size = 64
+segment_n_process = 1
+paragraph_mode = 'markup'
+segmenter_name = 'scibert'
+device = 'gpu'
+profile_modes = []
+diagnostic_sample_size = default_sample_size
+error_log_size = default_error_log_size
+segmentation_cache_dir = None
+segmentation_cache_size = 10 * 2 ** 30
+dedup_mode = None
+dedup_threshold = default_threshold
+dedup_memory_size = default_memory_size
+article_timeout = None
+max_paragraph_chars = 100000
+quarantine_path = None
+quarantined_files = set()
+pmid2info_path = None
+pmid_index_path = None
+doi_index_path = None
+package_reader = PackageReader()
+
+# The segmenter, the segmentation cache, pmid2info and the doi index are loaded on first use by their get_ functions and
+# kept for the lifetime of the process. run_parallel_extraction loads them before forking, so the workers share them.
+sentence_segmenter = None
+segmentation_cache = None
+pmid2info = None
+pmid2info_load = 0
+doi2pmid = None
+
+
+def load_sentence_segmenter(segmenter='scibert', device='gpu'):
+    global sentence_segmenter
+
+    print('Start loading sentence splitter')
+    sentence_segmenter = load_segmenter(segmenter, device)
+    print('Finished loading sentence splitter')
+
+
+def get_sentence_segmenter():
+    if sentence_segmenter is None:
+        load_sentence_segmenter(segmenter_name, device)
+
+    return sentence_segmenter
+
+
+def get_segmentation_cache():
+    # None without a segmentation_cache_dir, the entries are keyed by the id of the segmenter
+    global segmentation_cache
+
+    if segmentation_cache is None and segmentation_cache_dir is not None:
+        segmentation_cache = SegmentationCache(segmentation_cache_dir, get_segmenter_id(get_sentence_segmenter()), segmentation_cache_size)
+
+    return segmentation_cache
+
+
+def get_pmid2info():
+    # pmid2info is only used to test if a cited pmid is in our corpus
+    global pmid2info, pmid2info_load
+
+    if pmid2info is None:
+        print("Start loading pmid2info dict")
+        start = time.time()
+        if pmid_index_path is not None:
+            pmid2info = PmidSet(pmid_index_path)
+        else:
+            pmid2info = load_pmid2info(pmid2info_path)
+        end = time.time()
+        pmid2info_load = end-start
+        print("Finished loading pmid2info dict")
+
+    return pmid2info
+
+
+def get_doi2pmid():
+    # None without a doi_index_path
+    global doi2pmid
 
-spacy.require_gpu()
+    if doi2pmid is None and doi_index_path is not None:
+        doi2pmid = DoiIndex(doi_index_path)
 
-print('Start loading sentence splitter')
-sentence_segmenter = spacy.load('en_core_sci_scibert')
-print('Finished loading sentence splitter')
+    return doi2pmid
 
 
 def get_reference_content_id(reference_content):
@@ -21,31 +113,40 @@ def get_reference_content_id(reference_content):
     if reference_content.find('pub-id[@pub-id-type="pmid"]') is not None:
         num_pubmed_refs += 1
         return reference_content.find('pub-id[@pub-id-type="pmid"]').text
-    # ToDo look up cited documents by doi ID
-    # elif reference_content.find('pub-id[@pub-id-type="doi"]') is not None:
-    #    num_doi_refs += 1
-    #    return reference_content.find('pub-id[@pub-id-type="doi"]').text
+    # references without pmid are looked up by their doi in the doi index of parse_pubmed_data.py
+    elif doi_index_path is not None and reference_content.find('pub-id[@pub-id-type="doi"]') is not None:
+        pubmed_id = get_doi2pmid().get(reference_content.find('pub-id[@pub-id-type="doi"]').text)
+        if pubmed_id is not None:
+            num_doi_refs += 1
+            return str(pubmed_id)
 
     return None
 
 
-def get_reference_dict(file_path):
-    global non_usable_reflist, papers_wo_reflist, num_doi_refs, num_pubmed_refs, cit_wo_pubid_doiid, successful_reflist, unsuccesful_papers
-
+def parse_paper(file_path):
     try:
-        paper = etree.parse(file_path)
+        # articles in PMC bulk packages are parsed from memory
+        if is_package_article(file_path):
+            return etree.parse(BytesIO(package_reader.read(file_path)))
+        return etree.parse(file_path)
     except Exception as e:
-        unsuccesful_papers.append((file_path, 'etree parse failed in get_reference_dict', repr(e)))
+        add_entry(diagnostics, 'unsuccesful_papers', (file_path, 'etree parse failed in parse_paper', repr(e)))
         return
 
+
+def get_pmc_id(paper, file_path):
     try:
-        pmc_id = paper.xpath('.//front//article-meta//article-id[@pub-id-type="pmc"]')[0].text
+        return paper.xpath('.//front//article-meta//article-id[@pub-id-type="pmc"]')[0].text
     except IndexError:
-        pmc_id = file_path.split('/')[-1].split('.')[0]
+        return file_path.split('/')[-1].split('.')[0]
+
+
+def get_reference_dict(paper, pmc_id):
+    global successful_reflist
 
     ref_list = paper.xpath('.//ref-list//ref[@id]')
     if len(ref_list) == 0:
-        papers_wo_reflist.append(pmc_id)
+        add_entry(diagnostics, 'papers_wo_reflist', pmc_id)
         return
 
     paper_ref_dict = {}
@@ -79,175 +180,125 @@ def get_reference_dict(file_path):
                     paper_ref_dict[ref_id] = pubmed_id
                     continue
 
-            cit_wo_pubid_doiid.append((pmc_id, ref_id))
+            add_entry(diagnostics, 'cit_wo_pubid_doiid', (pmc_id, ref_id))
             continue
 
     if len(paper_ref_dict.keys()) == 0:
-        non_usable_reflist.append(pmc_id)
+        add_entry(diagnostics, 'non_usable_reflist', pmc_id)
     else:
         successful_reflist += 1
         return paper_ref_dict
 
 
-def cleanse_sentence(sent):
-    sent = unescape(sent)  # unescape html
+def handle_split_text(split_text, pmc_id, sent, ref_dict, pmid2info, methods=('iterative',)):
+    # the pairs of every extract method from the same split sentence
+    query_article_pairs = {}
+    for method in methods:
+        citation_pairs, error = get_citation_pairs(split_text, method=method)
+        # the error does not depend on the method, it is logged once
+        if error is not None and len(query_article_pairs) == 0:
+            citation, e = error
+            log_error(pmc_id, '\nsentence: ' + sent, '\npart: ' + citation, '\nerror: ' + str(repr(e)))
 
-    sent = re.sub(r'<(?![/]?xref)[^<]*?>', '', sent)  # remove non-xref tags
-    sent = re.sub(r'</xref>[^-;,]?[-;,][^-;,]?<xref', '</xref>,<xref', sent)  # replace citation ranges by comma separation
-    sent = re.sub(r'</xref>\w{0,2}\)', '</xref>)', sent)  # remove sub-citation e.g. ""<ref>A"
+        if error is not None and method != 'iterative':
+            # skip whole sentence
+            query_article_pairs[method] = []
+            continue
 
-    sent = sent.replace('(e.g., <xref', '(<xref')
-    sent = sent.replace('(see <xref', '(<xref')
-    sent = sent.replace('</xref> and <xref', '</xref>,<xref')
-    sent = sent.replace('</xref>, and <xref', '</xref>,<xref')
+        # iterative keeps the pairs generated before the error
+        query_article_pairs[method] = [generate_query_article_pairs_from_lists(pmid2info, ref_dict, query, xref_ids) for query, xref_ids in citation_pairs]
 
-    return sent
+    return query_article_pairs
 
 
-def split_sentence_at_citations(sent):
-    # split citations by delimiter [<xref, (<xref or white-space
-    sent_array = re.split(r'\[(<xref .+?>.+?</xref>)\]', sent)
+def generate_query_article_pairs_from_lists(pmid2info, ref_dict, query, xref_ids):
+    return query, [ref_dict[xref_id] for xref_id in xref_ids if xref_id in ref_dict and str(ref_dict[xref_id]) in pmid2info]
 
-    first_partial_split_text = []
-    for part in sent_array:
-        first_partial_split_text.extend(re.split(r'\((<xref .+?>.+?</xref>)\)', part))
 
-    second_partial_split_text = []
-    for part in first_partial_split_text:
-        second_partial_split_text.extend(re.split(r' (<xref .+?>.+?</xref>)', part))
+def get_paragraph_texts(paper):
+    return [get_paragraph_markup(paragraph) for paragraph in paper.xpath('//body//p')]
 
-    # handle cases, where spacy split sentences mid citation enumeration, this captures the first part
-    third_partial_split_text = []
-    for part in second_partial_split_text:
-        third_partial_split_text.extend(re.split(r'[([](<xref[^>]+>[^<]+</xref>(?:,<xref[^>]+>[^<]+</xref>)*)[;,]', part))
 
-    final_split_text = []
-    for part in third_partial_split_text:
-        # make sure to only split unprocessed sentences, i.e. they dont start with <xref
-        if not part.startswith('<xref') and '<xref' in part:
-            part = re.sub(r'</xref>[-;,]?\s?<xref', '</xref><xref', part)
-            final_split_text.extend(re.split(r'(<xref[^>]+>[^<]+</xref>)', part))
-        else:
-            final_split_text.append(part)
+def get_paragraph_texts_and_citations(paper):
+    # plain paragraph texts taken from the element tree, the citations are kept as character spans
+    paragraph_texts = []
+    paragraph_citations = []
+    for paragraph in paper.xpath('//body//p'):
+        paragraph_text, citations = get_paragraph_citations(paragraph)
+        paragraph_texts.append(paragraph_text)
+        paragraph_citations.append(citations)
 
-    return final_split_text
+    return paragraph_texts, paragraph_citations
 
 
-def handle_split_text(split_text, pmc_id, sent, ref_dict, pmid2info, method='iterative'):
-    global lines_for_json
+def segment_paragraphs(paragraph_texts_per_paper):
+    # segment the paragraphs of several papers in one nlp.pipe call, returns per paper and paragraph
+    # either the list of sentence spans (start, end) or the exception raised while segmenting that paragraph
+    global segmented_paragraphs, cached_paragraphs
 
-    query = ''
-    xref_ids = []
-    query_article_pairs_in_sent = []
-    for part in split_text:
-        if '</xref>' not in part:
-            query += part.rstrip()
-        else:
-            # filter out citations for empty queries
-            if query == '':
-                continue
+    sentence_segmenter = get_sentence_segmenter()
+    segmentation_cache = get_segmentation_cache()
+    paragraph_sentences = [[None] * len(paragraph_texts) for paragraph_texts in paragraph_texts_per_paper]
+    paragraphs = [(paragraph_text, (paper_idx, paragraph_idx))
+                  for paper_idx, paragraph_texts in enumerate(paragraph_texts_per_paper)
+                  for paragraph_idx, paragraph_text in enumerate(paragraph_texts)]
 
-            # handle citation enumeration
-            if '</xref>,<xref' in part:
-                cit_list = part.split(',')
-                for citation in cit_list:
-                    try:
-                        xref = etree.fromstring(citation)
-                    except Exception as e:
-                        # print(part, repr(e))
-                        lines_for_json.append(pmc_id)
-                        lines_for_json.append('\nsentence: ' + sent)
-                        lines_for_json.append('\npart: ' + citation)
-                        lines_for_json.append('\nerror: ' + str(repr(e)))
-                        lines_for_json.append('\n\n')
-
-                        if method == 'iterative':
-                            # return already generated pairs
-                            return query_article_pairs_in_sent
-                        else:
-                            # skip whole sentence
-                            return
-
-                            # skip non-bibr "citations"
-                    ref_type = xref.attrib['ref-type']
-                    if ref_type == 'fig' or ref_type == 'table' or ref_type == 'supplementary-material':
-                        continue
-
-                    xref_ids.append(xref.attrib['rid'])
+    # paragraphs segmented in an earlier run are taken from the cache
+    if segmentation_cache is not None:
+        cached_sentences = segmentation_cache.get_many([paragraph_text for paragraph_text, _ in paragraphs])
+        uncached_paragraphs = []
+        for paragraph, sentences in zip(paragraphs, cached_sentences):
+            if sentences is None:
+                uncached_paragraphs.append(paragraph)
             else:
-                try:
-                    xref = etree.fromstring(part)
-                except Exception as e:
-                    lines_for_json.append(pmc_id)
-                    lines_for_json.append('\nsentence: ' + sent)
-                    lines_for_json.append('\npart: ' + part)
-                    lines_for_json.append('\nerror: ' + str(repr(e)))
-                    lines_for_json.append('\n\n')
-
-                    if method == 'iterative':
-                        # return already generated pairs
-                        return query_article_pairs_in_sent
-                    else:
-                        # skip whole sentence
-                        return
-
-                # skip non-bibr "citations"
-                ref_type = xref.attrib['ref-type']
-                if ref_type == 'fig' or ref_type == 'table' or ref_type == 'supplementary-material':
-                    continue
-
-                xref_ids.append(xref.attrib['rid'])
+                paper_idx, paragraph_idx = paragraph[1]
+                paragraph_sentences[paper_idx][paragraph_idx] = sentences
 
-            if method == 'iterative':
-                query_article_pairs_in_sent.append(generate_query_article_pairs_from_lists(pmid2info, ref_dict, query, xref_ids))
+        cached_paragraphs += len(paragraphs) - len(uncached_paragraphs)
+        paragraphs = uncached_paragraphs
+    segmented_paragraphs += len(paragraphs)
 
-                xref_ids = []
-
-    if method == 'total':
-        query_article_pairs_in_sent.append(generate_query_article_pairs_from_lists(pmid2info, ref_dict, query, xref_ids))
-
-    return query_article_pairs_in_sent
+    try:
+        docs = sentence_segmenter.pipe(paragraphs, as_tuples=True, batch_size=segment_batch_size, n_process=segment_n_process)
+        for doc, (paper_idx, paragraph_idx) in docs:
+            paragraph_sentences[paper_idx][paragraph_idx] = [(sentence.start_char, sentence.end_char) for sentence in doc.sents]
+    except Exception:
+        # one broken paragraph fails the whole batch, segment the rest one by one to find it
+        for paragraph_text, (paper_idx, paragraph_idx) in paragraphs:
+            if paragraph_sentences[paper_idx][paragraph_idx] is not None:
+                continue
 
+            try:
+                paragraph_sentences[paper_idx][paragraph_idx] = [(sentence.start_char, sentence.end_char) for sentence in sentence_segmenter(paragraph_text).sents]
+            except Exception as e:
+                paragraph_sentences[paper_idx][paragraph_idx] = e
 
-def generate_query_article_pairs_from_lists(pmid2info, ref_dict, query, xref_ids):
-    return query, [ref_dict[xref_id] for xref_id in xref_ids if xref_id in ref_dict and str(ref_dict[xref_id]) in pmid2info]
+    if segmentation_cache is not None:
+        segmented = [(paragraph_text, paragraph_sentences[paper_idx][paragraph_idx]) for paragraph_text, (paper_idx, paragraph_idx) in paragraphs
+                     if not isinstance(paragraph_sentences[paper_idx][paragraph_idx], Exception)]
+        segmentation_cache.put_many([paragraph_text for paragraph_text, _ in segmented], [sentences for _, sentences in segmented])
 
+    return paragraph_sentences
 
-def get_query_article_pairs(file_path, ref_dict, pmid2info, method='iterative'):
-    global unsuccesful_papers, lines_for_json
 
-    try:
-        paper = etree.parse(file_path)
-    except Exception as e:
-        unsuccesful_papers.append((file_path, 'etree parse failed in get_query_article_pairs', repr(e)))
-        return
+def get_query_article_pairs(pmc_id, paragraph_texts, paragraph_citations, paragraph_sentences, ref_dict, pmid2info, methods=('iterative',)):
+    # the pairs of every extract method, the sentences are segmented and split at their citations only once
+    query_article_pairs = {method: [] for method in methods}
+    for paragraph_idx, (paragraph_text, paragraph_spacy_sentences) in enumerate(zip(paragraph_texts, paragraph_sentences)):
+        # paragraphs that spacy could not split
+        if isinstance(paragraph_spacy_sentences, Exception):
+            log_error(pmc_id, '\nparagraph: ' + paragraph_text, '\nparagrapherror: ' + str(repr(paragraph_spacy_sentences)))
+            continue
 
-    try:
-        pmc_id = paper.xpath('.//front//article-meta//article-id[@pub-id-type="pmc"]')[0].text
-    except IndexError:
-        pmc_id = file_path.split('/')[-1].split('.')[0]
-
-    paragraphs = paper.xpath('//body//p')
-
-    query_article_pairs = []
-    for paragraph in paragraphs:
-        paragraph_text = etree.tostring(paragraph).decode('us-ascii')
-
-        # remove opening and closing p-tag
-        paragraph_text = paragraph_text.replace('</p>', '')
-        paragraph_text = re.sub(r'<p xmlns.+?>', '', paragraph_text)  # remove xml declaration
-
-        # split paragraph into sentences using spacy
-        try:
-            paragraph_spacy_sentences = [str(sentence) for sentence in sentence_segmenter(paragraph_text).sents]
-        except Exception as e:
-            lines_for_json.append(pmc_id)
-            lines_for_json.append('\nparagraph: ' + paragraph_text)
-            lines_for_json.append('\nparagrapherror: ' + str(repr(e)))
-            lines_for_json.append('\n\n')
+        if paragraph_citations is not None:
+            for method in methods:
+                query_article_pairs[method].extend(get_query_article_pairs_from_spans(paragraph_text, paragraph_citations[paragraph_idx], paragraph_spacy_sentences,
+                                                                                      ref_dict, pmid2info, method=method))
             continue
 
-        for sent in paragraph_spacy_sentences:
+        for start, end in paragraph_spacy_sentences:
+            t0 = time.perf_counter()
+            sent = paragraph_text[start:end]
 
             # skip sentences without bibr citations
             if 'ref-type="bibr"' not in sent:
@@ -256,112 +307,213 @@ def get_query_article_pairs(file_path, ref_dict, pmid2info, method='iterative'):
             sent = cleanse_sentence(sent)
 
             # filter out sentences that only consist of a citation and no query
-            if re.match(r'^[\[(]?<xref .*?>.+?</xref>[\])]?$', sent):
+            if citation_only_sentence.match(sent):
                 # print(sent)
                 continue
 
-            split_text = split_sentence_at_citations(sent)
+            split_text = split_citations(sent)
+            t1 = time.perf_counter()
+
+            qa_pairs_in_sent = handle_split_text(split_text, pmc_id, sent, ref_dict=ref_dict, pmid2info=pmid2info, methods=methods)
 
-            qa_pairs_in_sent = handle_split_text(split_text, pmc_id, sent, ref_dict=ref_dict, pmid2info=pmid2info, method=method)
+            file_stage_seconds['citation_split'] += t1 - t0
+            file_stage_seconds['pair_generation'] += time.perf_counter() - t1
 
-            if qa_pairs_in_sent is not None:
-                query_article_pairs.extend(qa_pairs_in_sent)
+            for method in methods:
+                query_article_pairs[method].extend(qa_pairs_in_sent[method])
 
     return query_article_pairs
 
 
-parser = argparse.ArgumentParser()
-
-parser.add_argument(
-    '--pmid2info_path',
-    type=str,
-    required=True
-)
-parser.add_argument(
-    '--output_dir',
-    type=str,
-    required=True
-)
-parser.add_argument(
-    '--extract_method',
-    choices=('iterative', 'total'),
-    required=True
-)
-
-args = parser.parse_args()
-
-if not os.path.exists(args.output_dir):
-    os.makedirs(args.output_dir)
-
-non_usable_reflist = []  # papers with references list but no usable ref-list i.e. no references with any kind of ref id
-papers_wo_reflist = []  # papers without reference list
-non_pm_id_citations = []  # papers that have a references that is not pubmed or doi
-num_doi_refs = 0  # number of references that only have doi
-num_pubmed_refs = 0  # number of references that have pubmed id
-cit_wo_pubid_doiid = []  # number of references that do not have pub-id tag
-successful_reflist = 0  # paper that could be parsed til finish
-unsuccesful_papers = [] # paper file which couldnt be read
-
-lines_for_json = []
-
-# pmc_dir = '/vol/tmp/lethanhd/pmc/oa_comm/xml/PMC000xxxxxx'
-# files = [os.path.join(pmc_dir, file) for file in os.listdir(pmc_dir)]
-
-with open('random_file_samples_50k', 'r') as f:
-    files = f.read().splitlines()
-
-reference_time = 0
-query_article_time = 0
-qid2info_write_time = 0
-train2jsonl_time = 0
-
-successful_get_qa_pairs = 0
-num_fully_parsed = 0
-
-print("Start loading pmid2info dict")
-start = time.time()
-with open(os.path.join(args.pmid2info_path), 'r') as f:
-    pmid2info = json.load(f)
-end = time.time()
-pmid2info_load = end-start
-print("Finished loading pmid2info dict")
-
-qid2info = {}
-train2jsonl = []
-
-num_qa_pairs_in_files = {}
-for file in tqdm(files):
-    t0 = time.time()
+def get_query_article_pairs_from_spans(paragraph_text, citations, sentence_spans, ref_dict, pmid2info, method='iterative'):
+    t0 = time.perf_counter()
+    citation_pairs = get_span_citation_pairs(paragraph_text, citations, sentence_spans, method=method)
+    t1 = time.perf_counter()
+    query_article_pairs = [generate_query_article_pairs_from_lists(pmid2info, ref_dict, query, xref_ids) for query, xref_ids in citation_pairs]
+
+    file_stage_seconds['citation_split'] += t1 - t0
+    file_stage_seconds['pair_generation'] += time.perf_counter() - t1
+
+    return query_article_pairs
+
+
+def log_error(*lines):
+    # one entry of the error log parse_full_text, entries beyond its size limit are only counted
+    add_error_log_entry(diagnostics, ''.join(lines) + '\n\n', lines_for_json)
+
+
+def init_run_state():
+    global num_doi_refs, num_pubmed_refs, successful_reflist, diagnostics
+    global lines_for_json, successful_get_qa_pairs, segmented_paragraphs, cached_paragraphs, file_stage_seconds
+
+    num_doi_refs = 0  # number of references that only have doi and were resolved through the doi index
+    num_pubmed_refs = 0  # number of references that have pubmed id
+    successful_reflist = 0  # paper that could be parsed til finish
+
+    # counts and samples of the diagnostics categories, see run_diagnostics_names, and the size of the error log
+    diagnostics = new_diagnostics(diagnostic_sample_size, error_log_size)
+    lines_for_json = []  # error log entries since the last checkpoint, one string per entry
+
+    successful_get_qa_pairs = 0
+
+    segmented_paragraphs = 0  # paragraphs that went through the sentence splitter
+    cached_paragraphs = 0  # paragraphs whose sentences were taken from the segmentation cache
+
+    file_stage_seconds = {}  # seconds per stage of the file that is processed
+
+
+def prepare_paper(file):
+    # every file is parsed once, the reference map and the paragraphs are both taken from this tree
+    t0 = time.perf_counter()
+    paper = parse_paper(file)
+    t1 = time.perf_counter()
+    file_stage_seconds['parse'] = t1 - t0
+
+    if paper is None:
+        return
+
     try:
-        ref_dict = get_reference_dict(file)
+        pmc_id = get_pmc_id(paper, file)
+        ref_dict = get_reference_dict(paper, pmc_id)
     except Exception as e:
-        lines_for_json.append(file)
-        lines_for_json.append('\nrefdicterror: ' + str(repr(e)))
-        lines_for_json.append('\n\n')
+        log_error(file, '\nrefdicterror: ' + str(repr(e)))
 
-        continue
-    t1 = time.time()
-    reference_time += t1 - t0
+        return
+    t2 = time.perf_counter()
+    file_stage_seconds['refmap'] = t2 - t1
 
     if ref_dict is None or len(ref_dict) == 0:
-        continue
+        return
 
-    t3 = time.time()
     try:
-        query_article_pairs = get_query_article_pairs(file, ref_dict, pmid2info, method=args.extract_method)
+        if paragraph_mode == 'tree':
+            paragraph_texts, paragraph_citations = get_paragraph_texts_and_citations(paper)
+        else:
+            paragraph_texts = get_paragraph_texts(paper)
+            paragraph_citations = None
     except Exception as e:
-        lines_for_json.append(file)
-        lines_for_json.append('\npapererror: ' + str(repr(e)))
-        lines_for_json.append('\n\n')
+        log_error(file, '\npapererror: ' + str(repr(e)))
 
-        continue
-    t4 = time.time()
-    successful_get_qa_pairs += 1
+        return
+    file_stage_seconds['parse'] += time.perf_counter() - t2
+
+    paragraph_texts, paragraph_citations = drop_long_paragraphs(pmc_id, paragraph_texts, paragraph_citations)
+
+    return pmc_id, ref_dict, paragraph_texts, paragraph_citations
+
+
+def drop_long_paragraphs(pmc_id, paragraph_texts, paragraph_citations):
+    # the segmenter and the citation regexes take very long on giant paragraphs, paragraphs beyond max_paragraph_chars
+    # are left out
+    kept = [paragraph_idx for paragraph_idx, paragraph_text in enumerate(paragraph_texts) if len(paragraph_text) <= max_paragraph_chars]
+    if len(kept) == len(paragraph_texts):
+        return paragraph_texts, paragraph_citations
+
+    for paragraph_idx, paragraph_text in enumerate(paragraph_texts):
+        if len(paragraph_text) > max_paragraph_chars:
+            add_entry(diagnostics, 'long_paragraphs', (pmc_id, paragraph_idx, len(paragraph_text)))
+
+    if paragraph_citations is not None:
+        paragraph_citations = [paragraph_citations[paragraph_idx] for paragraph_idx in kept]
+
+    return [paragraph_texts[paragraph_idx] for paragraph_idx in kept], paragraph_citations
+
+
+def process_files(files, pmid2info, runs, show_progress=True, unbatched_until=0):
+    # runs: output_dir, outputs and manifest per extract method, all methods share parsing, segmentation and citation splitting.
+    # the files before unbatched_until are processed one at a time, the watchdog sets it after it killed a worker on a batch
+    global lines_for_json, successful_get_qa_pairs, file_stage_seconds
+
+    num_finished_files = min(run['manifest']['num_finished_files'] for run in runs)
+    progress = tqdm(total=len(files), initial=num_finished_files, disable=not show_progress)
+    batch_start = num_finished_files
+    while batch_start < len(files):
+        batch_t0 = time.perf_counter()
+        batch_files = files[batch_start:batch_start + (1 if batch_start < unbatched_until else file_batch_size)]
+        # a crash between the manifests of two methods leaves one of them a batch ahead, it skips the batch on resume
+        batch_runs = [run for run in runs if run['manifest']['num_finished_files'] <= batch_start]
+
+        # the trees are freed in prepare_paper, only the paragraph strings of the batch are kept until segmentation
+        prepared_papers = []
+        for file_idx, file in enumerate(batch_files):
+            # collect the log lines per file, so parse_full_text keeps the file order of an unbatched run
+            run_lines_for_json = lines_for_json
+            lines_for_json = []
+            file_stage_seconds = {}
+            if file in quarantined_files:
+                add_entry(diagnostics, 'quarantined_papers', file)
+                paper_info = None
+            else:
+                set_heartbeat(batch_start + file_idx, 1, article_timeout)
+                paper_info = prepare_paper(file)
+            prepared_papers.append((file, lines_for_json, paper_info, file_stage_seconds))
+            lines_for_json = run_lines_for_json
+
+        # the segmentation of the batch gets the budget of all its files
+        set_heartbeat(batch_start, len(batch_files), article_timeout * len(batch_files) if article_timeout is not None else None)
+        t0 = time.perf_counter()
+        paragraph_texts_per_paper = [paper_info[2] for _, _, paper_info, _ in prepared_papers if paper_info is not None]
+        paragraph_sentences_per_paper = iter(segment_paragraphs(paragraph_texts_per_paper))
+        segmentation_seconds = time.perf_counter() - t0
+        # the papers of a batch are segmented together, every paper gets the share of its characters
+        num_batch_chars = sum(len(paragraph_text) for paragraph_texts in paragraph_texts_per_paper for paragraph_text in paragraph_texts)
+
+        for file_idx, (file, file_lines_for_json, paper_info, file_stage_seconds) in enumerate(prepared_papers):
+            lines_for_json.extend(file_lines_for_json)
+
+            if paper_info is None:
+                for run in batch_runs:
+                    add_file_metrics(run['manifest']['metrics'], file, file_stage_seconds, 0)
+                continue
+
+            # the file has the rest of its budget, the time it took to parse counts
+            set_heartbeat(batch_start + file_idx, 1,
+                          article_timeout - file_stage_seconds['parse'] - file_stage_seconds['refmap'] if article_timeout is not None else None)
+            pmc_id, ref_dict, paragraph_texts, paragraph_citations = paper_info
+            paragraph_sentences = next(paragraph_sentences_per_paper)
+            num_chars = sum(len(paragraph_text) for paragraph_text in paragraph_texts)
+            file_stage_seconds['segmentation'] = segmentation_seconds * num_chars / num_batch_chars if num_batch_chars > 0 else 0
+            file_stage_seconds['citation_split'] = 0
+            file_stage_seconds['pair_generation'] = 0
+
+            try:
+                query_article_pairs_per_method = get_query_article_pairs(pmc_id, paragraph_texts, paragraph_citations, paragraph_sentences, ref_dict, pmid2info,
+                                                                         methods=[run['method'] for run in runs])
+            except Exception as e:
+                log_error(file, '\npapererror: ' + str(repr(e)))
+
+                for run in batch_runs:
+                    add_file_metrics(run['manifest']['metrics'], file, file_stage_seconds, 0)
+                continue
+            successful_get_qa_pairs += 1
+
+            t1 = time.perf_counter()
+            num_pairs_per_method = {}
+            for run in batch_runs:
+                num_pairs_per_method[run['method']] = write_query_article_pairs(file, query_article_pairs_per_method[run['method']], run['outputs'],
+                                                                                run['manifest'])
+            file_stage_seconds['output'] = time.perf_counter() - t1
+
+            # the timings are shared, the pairs are counted in the metrics of each method
+            for run in batch_runs:
+                add_file_metrics(run['manifest']['metrics'], file, file_stage_seconds, num_pairs_per_method[run['method']])
+
+        clear_heartbeat()
+        for run in batch_runs:
+            run['manifest']['num_finished_files'] = batch_start + len(batch_files)
+            run['manifest']['last_finished_file'] = batch_files[-1]
+            run['manifest']['metrics']['wall_seconds'] += time.perf_counter() - batch_t0
+        write_checkpoint(batch_runs)
 
-    query_article_time += t4 - t3
+        progress.update(len(batch_files))
+        batch_start += len(batch_files)
+    progress.close()
 
+
+def write_query_article_pairs(file, query_article_pairs, outputs, manifest):
+    # returns the number of written query-article pairs
     if query_article_pairs is None or len(query_article_pairs) == 0:
-        continue
+        return 0
 
     could_generate_qa_pair = False
     num_qa_pairs = 0
@@ -372,64 +524,680 @@ for file in tqdm(files):
         could_generate_qa_pair = True
         num_qa_pairs += len(articles)
 
-        next_query_id = len(qid2info)
-        qid2info[next_query_id] = query
+        next_query_id = manifest['num_qid2info']
+        manifest['num_qid2info'] += 1
+        outputs['qid2info.jsonl.part'].write(json.dumps([next_query_id, query], ensure_ascii=False) + '\n')
 
         for article in articles:
-            train2jsonl.append({"qid": str(next_query_id), "pmid": str(article), "click": 1})
+            json.dump({"qid": str(next_query_id), "pmid": str(article), "click": 1}, outputs['train.jsonl'])
+            outputs['train.jsonl'].write('\n')
+            manifest['num_train2jsonl'] += 1
 
     if could_generate_qa_pair:
-        num_fully_parsed += 1
-        num_qa_pairs_in_files[file] = num_qa_pairs
-
-t6 = time.time()
-with open(os.path.join(args.output_dir, 'qid2info.json'), 'w') as f:
-    json.dump(qid2info, f, ensure_ascii=False, indent=4)
-t7 = time.time()
-qid2info_write_time = t7 - t6
-
-t9 = time.time()
-with open(os.path.join(args.output_dir, 'train.jsonl'), 'w') as f:
-    for entry in train2jsonl:
-        json.dump(entry, f)
-        f.write('\n')
-t10 = time.time()
-train2jsonl_time = t10 - t9
-
-lines = ['method ' + str(args.extract_method),
-         '\nnum qid2info ' + str(len(qid2info)),
-         '\nnum train2jsonl ' + str(len(train2jsonl)),
-         '\nnum successful_get_qa_pairs ' + str(successful_get_qa_pairs),
-         '\nnum num_fully_parsed ' + str(num_fully_parsed),
-         '\ntime pmid2info_size ' + str(len(pmid2info)),
-         '\ntime pmid2info_load_time ' + str(pmid2info_load),
-         '\ntime reference_time ' + str(reference_time),
-         '\ntime query_article_time ' + str(query_article_time),
-         '\ntime qid2info_write_time ' + str(qid2info_write_time),
-         '\ntime train2jsonl_time ' + str(train2jsonl_time),
-         '\nnum faulty papers ' + str(len(non_usable_reflist)),
-         '\npapers_wo_reflist ' + str(len(papers_wo_reflist)),
-         '\nnum_pm_refs ' + str(num_pubmed_refs),
-         '\nnum_doi_refs ' + str(num_doi_refs),
-         '\nnum_cit_wo_pubid ' + str(len(cit_wo_pubid_doiid)),
-         '\nsuccessful_reflist ' + str(successful_reflist),
-         '\nunsuccesful_papers ' + str(len(unsuccesful_papers))]
-
-if len(non_usable_reflist) > 0:
-    lines.append('\nfaulty papers ' + str([non_usable_reflist[x] for x in [0, len(non_usable_reflist) // 2, -1]]))
-if len(papers_wo_reflist) > 0:
-    lines.append('\npapers_wo_reflist ' + str([papers_wo_reflist[x] for x in [0, len(papers_wo_reflist) // 2, -1]]))
-if len(cit_wo_pubid_doiid) > 0:
-    lines.append('\nnum_cit_wo_pubid ' + str([cit_wo_pubid_doiid[x] for x in [0, len(cit_wo_pubid_doiid) // 2, -1]]))
-if len(unsuccesful_papers) > 0:
-    lines.append('\nunsuccesfull_papers' + str([unsuccesful_papers[x] for x in [0, len(unsuccesful_papers) // 2, -1]]))
-
-with open(os.path.join(args.output_dir, 'fullrun_stats'), 'w') as f:
-    f.writelines(lines)
-
-with open(os.path.join(args.output_dir, 'parse_full_text'), 'w') as f:
-    f.writelines(lines_for_json)
-
-with open(os.path.join(args.output_dir, 'citation_in_paper_stats'), 'w') as f:
-    json.dump(num_qa_pairs_in_files, f, indent=4)
+        # counted per method, the other run stats are shared by all methods
+        manifest['run_stats']['num_fully_parsed'] += 1
+        outputs['citation_in_paper_stats.jsonl.part'].write(json.dumps([file, num_qa_pairs]) + '\n')
+
+    return num_qa_pairs
+
+
+# counters that are summed up over a run and its shards
+run_stat_names = ('successful_get_qa_pairs', 'num_fully_parsed', 'num_pubmed_refs', 'num_doi_refs', 'successful_reflist', 'segmented_paragraphs',
+                  'cached_paragraphs')
+# diagnostics categories, counted and sampled by diagnostics.py
+# non_usable_reflist: papers with references list but no usable ref-list i.e. no references with any kind of ref id
+# papers_wo_reflist: papers without reference list, cit_wo_pubid_doiid: references that do not have a usable pub-id tag
+# unsuccesful_papers: paper files which couldnt be read, long_paragraphs: paragraphs left out for their length
+# quarantined_papers: files of the quarantine list that were skipped
+run_diagnostics_names = ('non_usable_reflist', 'papers_wo_reflist', 'cit_wo_pubid_doiid', 'unsuccesful_papers', 'long_paragraphs', 'quarantined_papers')
+# outputs that are appended to during a run, the manifest keeps their sizes at the last checkpoint
+output_part_files = ('train.jsonl', 'qid2info.jsonl.part', 'citation_in_paper_stats.jsonl.part', 'parse_full_text')
+
+
+# run stats that differ between the extract methods of a run, they are kept in the manifest of each method
+method_run_stat_names = ('num_fully_parsed',)
+
+
+def collect_run_stats():
+    return {name: globals()[name] for name in run_stat_names if name not in method_run_stat_names}
+
+
+def merge_run_stats(run_stats_list):
+    merged = dict.fromkeys(run_stat_names, 0)
+    for run_stats in run_stats_list:
+        for name in run_stat_names:
+            merged[name] += run_stats.get(name, 0)
+
+    return merged
+
+
+def new_manifest(files, method):
+    return {
+        'method': method,
+        'paragraph_mode': paragraph_mode,
+        'segmenter': segmenter_name,
+        'resolve_dois': doi_index_path is not None,
+        'num_files': len(files),
+        'num_finished_files': 0,
+        'last_finished_file': None,
+        'num_qid2info': 0,
+        'num_train2jsonl': 0,
+        'run_stats': dict.fromkeys(run_stat_names, 0),
+        'diagnostics': new_diagnostics(diagnostic_sample_size, error_log_size),
+        'metrics': new_metrics(),
+        'checkpoint_time': 0,
+        'offsets': dict.fromkeys(output_part_files, 0),
+        'finished': False,
+    }
+
+
+def write_manifest(output_dir, manifest):
+    with open(os.path.join(output_dir, 'manifest.json.tmp'), 'w') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(os.path.join(output_dir, 'manifest.json.tmp'), os.path.join(output_dir, 'manifest.json'))
+
+
+def open_run_outputs(output_dir, files, method, resume):
+    manifest_path = os.path.join(output_dir, 'manifest.json')
+
+    if resume and os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        # manifests written before the metrics were added start with empty metrics
+        manifest.setdefault('metrics', new_metrics())
+
+        num_finished_files = manifest['num_finished_files']
+        if manifest['method'] != method or manifest.get('paragraph_mode', 'markup') != paragraph_mode or \
+                manifest.get('segmenter', 'scibert') != segmenter_name or manifest.get('resolve_dois', False) != (doi_index_path is not None) or \
+                manifest['num_files'] != len(files) or \
+                (num_finished_files > 0 and files[num_finished_files - 1] != manifest['last_finished_file']):
+            raise ValueError('cannot resume from ' + manifest_path + ', it was written for another file list, extract method, paragraph mode, segmenter or doi index setting')
+
+        if manifest['finished']:
+            remove_finished_parts(output_dir)
+            return manifest, None
+
+        # drop everything that was written after the last checkpoint
+        for name in output_part_files:
+            os.truncate(os.path.join(output_dir, name), manifest['offsets'][name])
+    else:
+        manifest = new_manifest(files, method)
+        for name in output_part_files:
+            open(os.path.join(output_dir, name), 'w').close()
+
+    outputs = {name: open(os.path.join(output_dir, name), 'a') for name in output_part_files}
+
+    return manifest, outputs
+
+
+def write_checkpoint(runs):
+    # makes the outputs durable and records how far the run got, a crash loses at most the files since the last checkpoint
+    global lines_for_json
+
+    t0 = time.time()
+    log_entries = fit_error_log_entries(diagnostics, lines_for_json)
+    for run in runs:
+        run['outputs']['parse_full_text'].writelines(log_entries)
+    lines_for_json.clear()
+
+    # all outputs are durable before the first manifest is replaced
+    for run in runs:
+        for name, f in run['outputs'].items():
+            f.flush()
+            os.fsync(f.fileno())
+            run['manifest']['offsets'][name] = os.path.getsize(os.path.join(run['output_dir'], name))
+
+    checkpoint_time = time.time() - t0
+    for run in runs:
+        run['manifest']['run_stats'].update(collect_run_stats())
+        run['manifest']['diagnostics'] = diagnostics
+        run['manifest']['checkpoint_time'] += checkpoint_time
+        write_manifest(run['output_dir'], run['manifest'])
+
+
+def write_json_dict(path, items, ensure_ascii=True):
+    # writes the same bytes as json.dump(dict(items), f, indent=4) without building the dict
+    with open(path, 'w') as f:
+        num_items = 0
+        for key, value in items:
+            f.write(('{\n    ' if num_items == 0 else ',\n    ')
+                    + json.dumps(str(key), ensure_ascii=ensure_ascii) + ': ' + json.dumps(value, ensure_ascii=ensure_ascii))
+            num_items += 1
+        f.write('{}' if num_items == 0 else '\n}')
+
+
+def read_jsonl(path):
+    with open(path, 'r') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def write_run_stats(output_dir, method, manifest, qid2info_write_time):
+    run_stats = manifest['run_stats']
+    diagnostics = manifest['diagnostics']
+    stages = manifest['metrics']['stages']
+
+    lines = ['method ' + str(method),
+             '\nnum qid2info ' + str(manifest['num_qid2info']),
+             '\nnum train2jsonl ' + str(manifest['num_train2jsonl']),
+             '\nnum successful_get_qa_pairs ' + str(run_stats['successful_get_qa_pairs']),
+             '\nnum num_fully_parsed ' + str(run_stats['num_fully_parsed']),
+             '\ntime pmid2info_size ' + str(len(get_pmid2info())),
+             '\ntime pmid2info_load_time ' + str(pmid2info_load),
+             '\ntime parse_time ' + str(stages['parse']['seconds']),
+             '\ntime reference_time ' + str(stages['refmap']['seconds']),
+             '\ntime segmentation_time ' + str(stages['segmentation']['seconds']),
+             '\nnum segmented_paragraphs ' + str(run_stats.get('segmented_paragraphs', 0)),
+             '\nnum cached_paragraphs ' + str(run_stats.get('cached_paragraphs', 0)),
+             '\ntime query_article_time ' + str(stages['citation_split']['seconds'] + stages['pair_generation']['seconds']),
+             '\ntime output_time ' + str(stages['output']['seconds']),
+             '\ntime qid2info_write_time ' + str(qid2info_write_time),
+             '\ntime checkpoint_time ' + str(manifest['checkpoint_time']),
+             '\nnum faulty papers ' + str(get_count(diagnostics, 'non_usable_reflist')),
+             '\npapers_wo_reflist ' + str(get_count(diagnostics, 'papers_wo_reflist')),
+             '\nnum_pm_refs ' + str(run_stats['num_pubmed_refs']),
+             '\nnum_doi_refs ' + str(run_stats['num_doi_refs']),
+             '\nnum_cit_wo_pubid ' + str(get_count(diagnostics, 'cit_wo_pubid_doiid')),
+             '\nsuccessful_reflist ' + str(run_stats['successful_reflist']),
+             '\nunsuccesful_papers ' + str(get_count(diagnostics, 'unsuccesful_papers')),
+             '\nnum long_paragraphs ' + str(get_count(diagnostics, 'long_paragraphs')),
+             '\nnum quarantined_papers ' + str(get_count(diagnostics, 'quarantined_papers')),
+             '\nnum error_log_entries ' + str(diagnostics['error_log_entries'])]
+
+    if diagnostics['error_log_truncated']:
+        lines.append('\nerror_log truncated at ' + str(diagnostics['error_log_bytes']) + ' bytes')
+    if 'dedup' in manifest:
+        lines.extend(format_dedup_stats(manifest['dedup']))
+    # samples of the diagnostics
+    if get_count(diagnostics, 'non_usable_reflist') > 0:
+        lines.append('\nfaulty papers ' + str(get_sample(diagnostics, 'non_usable_reflist')))
+    if get_count(diagnostics, 'papers_wo_reflist') > 0:
+        lines.append('\npapers_wo_reflist ' + str(get_sample(diagnostics, 'papers_wo_reflist')))
+    if get_count(diagnostics, 'cit_wo_pubid_doiid') > 0:
+        lines.append('\nnum_cit_wo_pubid ' + str(get_sample(diagnostics, 'cit_wo_pubid_doiid')))
+    if get_count(diagnostics, 'unsuccesful_papers') > 0:
+        lines.append('\nunsuccesfull_papers' + str(get_sample(diagnostics, 'unsuccesful_papers')))
+    if get_count(diagnostics, 'long_paragraphs') > 0:
+        lines.append('\nlong_paragraphs ' + str(get_sample(diagnostics, 'long_paragraphs')))
+    if get_count(diagnostics, 'quarantined_papers') > 0:
+        lines.append('\nquarantined_papers ' + str(get_sample(diagnostics, 'quarantined_papers')))
+
+    with open(os.path.join(output_dir, 'fullrun_stats'), 'w') as f:
+        f.writelines(lines)
+
+
+def dedup_run_outputs(output_dir, manifest):
+    # collapses the duplicate queries into qid2info.dedup.jsonl.part and train.dedup.jsonl, see query_dedup.py. the
+    # appended outputs are left as they are until the manifest is finished, so an interrupted finalization is resumed
+    with open(os.path.join(output_dir, 'qid2info.dedup.jsonl.part'), 'w') as qid2info_file, \
+            open(os.path.join(output_dir, 'train.dedup.jsonl'), 'w') as train_file:
+        def write_query(qid, query):
+            qid2info_file.write(json.dumps([qid, query], ensure_ascii=False) + '\n')
+
+        def write_train_row(row):
+            json.dump(row, train_file)
+            train_file.write('\n')
+
+        dedup_stats = dedup_queries(read_jsonl(os.path.join(output_dir, 'qid2info.jsonl.part')), read_jsonl(os.path.join(output_dir, 'train.jsonl')),
+                                    write_query, write_train_row, dedup_mode, dedup_threshold, dedup_memory_size)
+
+    manifest['dedup'] = dedup_stats
+    manifest['num_qid2info'] -= dedup_stats['num_exact_duplicates'] + dedup_stats['num_near_duplicates']
+    manifest['num_train2jsonl'] -= dedup_stats['num_duplicate_pairs']
+
+
+def remove_finished_parts(output_dir):
+    # once the manifest is finished the deduplicated train.jsonl replaces the appended one and the parts are removed,
+    # a resumed run repeats this if it was interrupted
+    if os.path.exists(os.path.join(output_dir, 'train.dedup.jsonl')):
+        os.replace(os.path.join(output_dir, 'train.dedup.jsonl'), os.path.join(output_dir, 'train.jsonl'))
+
+    for name in output_part_files + ('qid2info.dedup.jsonl.part',):
+        if name.endswith('.part') and os.path.exists(os.path.join(output_dir, name)):
+            os.remove(os.path.join(output_dir, name))
+
+
+def finalize_run_outputs(output_dir, method, manifest):
+    # turns the appended parts into the final qid2info.json, citation_in_paper_stats and fullrun_stats
+    qid2info_part = 'qid2info.jsonl.part'
+    if dedup_mode is not None:
+        dedup_run_outputs(output_dir, manifest)
+        qid2info_part = 'qid2info.dedup.jsonl.part'
+
+    t0 = time.time()
+    write_json_dict(os.path.join(output_dir, 'qid2info.json'), read_jsonl(os.path.join(output_dir, qid2info_part)), ensure_ascii=False)
+    qid2info_write_time = time.time() - t0
+
+    write_json_dict(os.path.join(output_dir, 'citation_in_paper_stats'), read_jsonl(os.path.join(output_dir, 'citation_in_paper_stats.jsonl.part')))
+
+    write_run_stats(output_dir, method, manifest, qid2info_write_time)
+
+    with open(os.path.join(output_dir, 'metrics.json'), 'w') as f:
+        json.dump(summarize_metrics(manifest['metrics']), f, indent=4)
+
+    manifest['finished'] = True
+    write_manifest(output_dir, manifest)
+
+    remove_finished_parts(output_dir)
+
+
+def get_method_output_dirs(output_dir, methods):
+    # a single method writes to output_dir like before, several methods get a directory each
+    if len(methods) == 1:
+        return {methods[0]: output_dir}
+
+    return {method: os.path.join(output_dir, method) for method in methods}
+
+
+def extract_to_dirs(files, method_output_dirs, resume, show_progress=True, unbatched_until=0):
+    # runs the extraction with outputs appended after every batch of files, returns the manifest of every method
+    global diagnostics
+
+    runs = []
+    manifests = {}
+    for method, output_dir in method_output_dirs.items():
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        manifests[method], outputs = open_run_outputs(output_dir, files, method, resume)
+        if outputs is not None:
+            runs.append({'method': method, 'output_dir': output_dir, 'outputs': outputs, 'manifest': manifests[method]})
+
+    if len(runs) == 0:
+        return manifests
+
+    init_run_state()
+    # the counters and diagnostics continue from the last checkpoint of the method that is furthest behind
+    last_manifest = min((run['manifest'] for run in runs), key=lambda manifest: manifest['num_finished_files'])
+    globals().update({name: value for name, value in last_manifest['run_stats'].items() if name not in method_run_stat_names})
+    diagnostics = last_manifest.get('diagnostics', diagnostics)
+
+    # the cProfile stats of the run are written to every method, they profile the same processing
+    profiler = start_profiling(profile_modes)
+    process_files(files, get_pmid2info(), runs, show_progress=show_progress, unbatched_until=unbatched_until)
+    stop_profiling(profile_modes, profiler, [run['manifest']['metrics'] for run in runs], [os.path.join(run['output_dir'], 'profile.pstats') for run in runs])
+    if 'tracemalloc' in profile_modes:
+        for run in runs:
+            write_manifest(run['output_dir'], run['manifest'])
+
+    for run in runs:
+        for f in run['outputs'].values():
+            f.close()
+
+    return manifests
+
+
+def read_manifest(output_dir):
+    with open(os.path.join(output_dir, 'manifest.json'), 'r') as f:
+        return json.load(f)
+
+
+def load_before_fork():
+    # fork so that workers share the segmenter, pmid2info and the doi index of the parent instead of loading their own
+    get_sentence_segmenter()
+    get_segmentation_cache()
+    get_pmid2info()
+    get_doi2pmid()
+
+
+def quarantine(file, reason):
+    # called by the watchdog before it restarts the worker, the restarted worker is forked with the file in quarantined_files
+    print('Quarantined ' + file + ' (' + reason + ')')
+    quarantined_files.add(file)
+    add_to_quarantine(quarantine_path, file, reason)
+
+
+def run_extraction(files, output_dir, methods, resume=False):
+    method_output_dirs = get_method_output_dirs(output_dir, methods)
+    if article_timeout is None:
+        manifests = extract_to_dirs(files, method_output_dirs, resume)
+    else:
+        # the extraction runs in a worker process, so the watchdog can kill it on a file that is over the budget
+        load_before_fork()
+        job = {'files': files, 'output_dir': output_dir, 'methods': methods, 'resume': resume, 'show_progress': True}
+        run_watched([job], run_shard, 1, quarantine, show_progress=False)
+        manifests = {method: read_manifest(method_output_dir) for method, method_output_dir in method_output_dirs.items()}
+
+    for method, method_output_dir in method_output_dirs.items():
+        if manifests[method]['finished']:
+            print('Extraction in ' + method_output_dir + ' is already finished')
+            continue
+
+        finalize_run_outputs(method_output_dir, method, manifests[method])
+
+
+def run_shard(job):
+    # runs in a worker of run_watched, see article_watchdog.py. shards are left unfinalized, merge_shards reads their
+    # parts directly
+    extract_to_dirs(job['files'], get_method_output_dirs(job['output_dir'], job['methods']), job['resume'],
+                    show_progress=job.get('show_progress', False), unbatched_until=job.get('unbatched_until', 0))
+
+
+def merge_shards(shard_dirs, output_dir, method, files, wall_seconds):
+    # shards hold contiguous slices of the file list, so concatenating them in order and
+    # shifting the qids by the number of queries before the shard reproduces the serial numbering.
+    # wall_seconds: elapsed time of the parallel run, the throughput is computed with it instead of the summed shard times
+    manifest = new_manifest(files, method)
+    run_stats_list = []
+    metrics_list = []
+    diagnostics_list = []
+    error_log_bytes = 0
+    error_log_cut = False
+
+    with open(os.path.join(output_dir, 'qid2info.jsonl.part'), 'w') as qid2info_file, \
+            open(os.path.join(output_dir, 'train.jsonl'), 'w') as train_file, \
+            open(os.path.join(output_dir, 'citation_in_paper_stats.jsonl.part'), 'w') as citation_file, \
+            open(os.path.join(output_dir, 'parse_full_text'), 'wb') as lines_file:
+        for shard_dir in shard_dirs:
+            with open(os.path.join(shard_dir, 'manifest.json'), 'r') as f:
+                shard_manifest = json.load(f)
+
+            qid_offset = manifest['num_qid2info']
+
+            for qid, query in read_jsonl(os.path.join(shard_dir, 'qid2info.jsonl.part')):
+                qid2info_file.write(json.dumps([qid + qid_offset, query], ensure_ascii=False) + '\n')
+
+            for entry in read_jsonl(os.path.join(shard_dir, 'train.jsonl')):
+                entry['qid'] = str(int(entry['qid']) + qid_offset)
+                json.dump(entry, train_file)
+                train_file.write('\n')
+
+            with open(os.path.join(shard_dir, 'citation_in_paper_stats.jsonl.part'), 'r') as f:
+                shutil.copyfileobj(f, citation_file)
+
+            # every shard logs up to the size limit, the merged log keeps the first entries up to the limit
+            num_bytes, cut = copy_error_log(os.path.join(shard_dir, 'parse_full_text'), lines_file, error_log_size - error_log_bytes)
+            error_log_bytes += num_bytes
+            error_log_cut = error_log_cut or cut
+
+            manifest['num_qid2info'] += shard_manifest['num_qid2info']
+            manifest['num_train2jsonl'] += shard_manifest['num_train2jsonl']
+            manifest['checkpoint_time'] += shard_manifest['checkpoint_time']
+            run_stats_list.append(shard_manifest['run_stats'])
+            metrics_list.append(shard_manifest['metrics'])
+            diagnostics_list.append(shard_manifest['diagnostics'])
+
+    manifest['run_stats'] = merge_run_stats(run_stats_list)
+    manifest['metrics'] = merge_metrics(metrics_list)
+    manifest['metrics']['wall_seconds'] = wall_seconds
+    manifest['diagnostics'] = merge_diagnostics(diagnostics_list, diagnostic_sample_size, error_log_size)
+    manifest['diagnostics']['error_log_bytes'] = error_log_bytes
+    manifest['diagnostics']['error_log_truncated'] = manifest['diagnostics']['error_log_truncated'] or error_log_cut
+    merge_profiles([os.path.join(shard_dir, 'profile.pstats') for shard_dir in shard_dirs], os.path.join(output_dir, 'profile.pstats'))
+    manifest['num_finished_files'] = len(files)
+    manifest['last_finished_file'] = files[-1] if len(files) > 0 else None
+
+    finalize_run_outputs(output_dir, method, manifest)
+
+
+def run_parallel_extraction(files, output_dir, methods, workers, keep_shards=False, resume=False):
+    method_output_dirs = get_method_output_dirs(output_dir, methods)
+
+    finished_methods = []
+    for method, method_output_dir in method_output_dirs.items():
+        manifest_path = os.path.join(method_output_dir, 'manifest.json')
+        if resume and os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as f:
+                if json.load(f)['finished']:
+                    remove_finished_parts(method_output_dir)
+                    print('Extraction in ' + method_output_dir + ' is already finished')
+                    finished_methods.append(method)
+    methods = [method for method in methods if method not in finished_methods]
+    if len(methods) == 0:
+        return
+
+    # a few shards per worker so that slow shards do not leave the other workers idle
+    num_shards = max(1, min(len(files), workers * 4))
+    shard_size = -(-len(files) // num_shards)
+    shard_root = os.path.join(output_dir, 'shards')
+
+    shard_jobs = []
+    for shard_idx, start in enumerate(range(0, len(files), shard_size)):
+        shard_dir = os.path.join(shard_root, 'shard_{:05d}'.format(shard_idx))
+        shard_jobs.append({'files': files[start:start + shard_size], 'output_dir': shard_dir, 'methods': methods, 'resume': resume})
+
+    # the watchdog restarts a worker that crashed or is over the budget of a file on its shard, a pool would wait for it forever
+    load_before_fork()
+    t0 = time.perf_counter()
+    run_watched(shard_jobs, run_shard, workers, quarantine)
+    shard_dirs = [shard_job['output_dir'] for shard_job in shard_jobs]
+    wall_seconds = time.perf_counter() - t0
+
+    for method in methods:
+        if not os.path.exists(method_output_dirs[method]):
+            os.makedirs(method_output_dirs[method])
+        shard_method_dirs = [get_method_output_dirs(shard_dir, methods)[method] for shard_dir in shard_dirs]
+        merge_shards(shard_method_dirs, method_output_dirs[method], method, files, wall_seconds)
+
+    if not keep_shards:
+        shutil.rmtree(shard_root)
+
+
+def main():
+    global file_batch_size, segment_batch_size, segment_n_process, paragraph_mode, segmenter_name, device, profile_modes, \
+        segmentation_cache_dir, segmentation_cache_size, pmid2info_path, pmid_index_path, doi_index_path, package_reader, \
+        diagnostic_sample_size, error_log_size, dedup_mode, dedup_threshold, dedup_memory_size, article_timeout, max_paragraph_chars, \
+        quarantine_path, quarantined_files
+
+    parser = argparse.ArgumentParser()
+
+    pmid_group = parser.add_mutually_exclusive_group(required=True)
+    pmid_group.add_argument(
+        '--pmid2info_path',
+        type=str,
+        help='pmid2info.json or a corpus store directory'
+    )
+    pmid_group.add_argument(
+        '--pmid_index_path',
+        type=str,
+        help='pmid bitmap written by pmid_index.py or parse_pubmed_data.py, used instead of loading the whole pmid2info.json'
+    )
+    parser.add_argument(
+        '--doi_index_path',
+        type=str,
+        help='doi index written by parse_pubmed_data.py, references that only have a doi are resolved to their pmid with it'
+    )
+    parser.add_argument(
+        '--output_dir',
+        type=str,
+        required=True
+    )
+    parser.add_argument(
+        '--extract_method',
+        nargs='+',
+        choices=('iterative', 'total'),
+        required=True,
+        help='one or more methods, they share parsing, segmentation and citation splitting. '
+             'with several methods every method writes to <output_dir>/<method>'
+    )
+    parser.add_argument(
+        '--pmc_packages',
+        nargs='+',
+        help='PMC OA bulk .tar.gz packages, their articles are read from the packages instead of the files in random_file_samples_50k'
+    )
+    parser.add_argument(
+        '--package_index_dir',
+        type=str,
+        help='member offsets of the packages written by pmc_packages.py, packages without offsets are indexed into it. '
+             'also used for package article ids ("<package>::<member>") in random_file_samples_50k'
+    )
+    parser.add_argument(
+        '--paragraph_mode',
+        choices=('markup', 'tree'),
+        default='markup',
+        help='markup: segment the paragraph markup and split the sentences at their xref tags, '
+             'tree: segment the plain paragraph text taken from the element tree and locate the citations by their character offsets'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='number of worker processes, each processes a shard of the files and the shards are merged afterwards'
+    )
+    parser.add_argument(
+        '--segmenter',
+        choices=tuple(segmenter_loaders),
+        default='scibert',
+        help='sentence splitter, scibert: en_core_sci_scibert, sci_sm/sci_md: the smaller scispacy pipelines with only their parser, '
+             'rules: rule-based splitter that knows biomedical abbreviations. benchmark_segmenters.py compares them'
+    )
+    parser.add_argument(
+        '--segmentation_cache_dir',
+        type=str,
+        help='directory of the on-disk cache of sentence boundaries, paragraphs that are in the cache are not segmented again'
+    )
+    parser.add_argument(
+        '--segmentation_cache_size',
+        type=float,
+        default=10,
+        help='maximum size of the segmentation cache on disk in GB, the database file and its write-ahead log. the least recently used '
+             'paragraphs are evicted beyond it and the file is shrunk, writes between two evictions can exceed it by a batch'
+    )
+    parser.add_argument(
+        '--device',
+        choices=('gpu', 'cpu'),
+        default='gpu',
+        help='run the sentence splitter on the gpu or on the cpu'
+    )
+    parser.add_argument(
+        '--file_batch_size',
+        type=int,
+        default=32,
+        help='number of files whose paragraphs are segmented together, outputs are checkpointed after every batch'
+    )
+    parser.add_argument(
+        '--segment_batch_size',
+        type=int,
+        default=64,
+        help='batch size of nlp.pipe'
+    )
+    parser.add_argument(
+        '--segment_n_process',
+        type=int,
+        default=1,
+        help='number of processes nlp.pipe uses on the cpu, cannot be combined with --workers'
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='continue an interrupted run in output_dir from its last checkpoint'
+    )
+    parser.add_argument(
+        '--keep_shards',
+        action='store_true',
+        help='keep the partial outputs of the workers in <output_dir>/shards'
+    )
+    parser.add_argument(
+        '--diagnostic_samples',
+        type=int,
+        default=default_sample_size,
+        help='number of sampled entries per diagnostics category in fullrun_stats, e.g. of the papers without reference list'
+    )
+    parser.add_argument(
+        '--error_log_size',
+        type=float,
+        default=default_error_log_size / 2 ** 20,
+        help='maximum size of the error log parse_full_text in MB, further errors are only counted'
+    )
+    parser.add_argument(
+        '--article_timeout',
+        type=float,
+        help='wall-clock budget of an article in seconds, requires --device cpu. the extraction runs in watched worker processes, '
+             'a worker that is over the budget of an article is killed and restarted from its last checkpoint with the article quarantined'
+    )
+    parser.add_argument(
+        '--max_paragraph_chars',
+        type=int,
+        default=100000,
+        help='paragraphs longer than this are left out, they can take the segmenter and the citation regexes very long'
+    )
+    parser.add_argument(
+        '--quarantine_path',
+        type=str,
+        default='quarantine_files',
+        help='list of the articles a worker was killed or crashed on, the articles in it are skipped by later runs'
+    )
+    parser.add_argument(
+        '--dedup',
+        choices=('exact', 'near'),
+        help='collapse duplicate queries into one qid when the outputs are written, the cited pmids are merged. exact: equal '
+             'after lowercasing and dropping punctuation, near: also queries with similar word 3-grams, see query_dedup.py'
+    )
+    parser.add_argument(
+        '--dedup_threshold',
+        type=float,
+        default=default_threshold,
+        help='minimum estimated jaccard similarity of the word 3-grams of near-duplicate queries'
+    )
+    parser.add_argument(
+        '--dedup_memory_size',
+        type=float,
+        default=default_memory_size / 2 ** 20,
+        help='maximum size of the dedup index in MB, queries beyond it are compared against the index but not added. the qid map '
+             'of the dedup is not counted, it grows with the number of queries, see query_dedup.py'
+    )
+    parser.add_argument(
+        '--profile',
+        nargs='+',
+        choices=('cprofile', 'tracemalloc'),
+        default=[],
+        help='cprofile: write the cProfile stats of the extraction to <output_dir>/profile.pstats, tracemalloc: add the peak '
+             'memory and the top allocations to metrics.json. both slow the extraction down'
+    )
+
+    args = parser.parse_args()
+
+    if args.workers > 1 and args.device == 'gpu':
+        parser.error('--workers requires --device cpu, the gpu context cannot be shared with forked workers')
+    if args.workers > 1 and args.segment_n_process > 1:
+        parser.error('--workers and --segment_n_process cannot be combined, pool workers cannot start their own processes')
+    if args.segment_n_process > 1 and args.device == 'gpu':
+        parser.error('--segment_n_process requires --device cpu')
+    if args.article_timeout is not None and args.device == 'gpu':
+        parser.error('--article_timeout requires --device cpu, the watched worker is forked and the gpu context cannot be shared with it')
+
+    file_batch_size = args.file_batch_size
+    segment_batch_size = args.segment_batch_size
+    segment_n_process = args.segment_n_process
+    paragraph_mode = args.paragraph_mode
+    segmenter_name = args.segmenter
+    profile_modes = args.profile
+    diagnostic_sample_size = args.diagnostic_samples
+    error_log_size = int(args.error_log_size * 2 ** 20)
+    dedup_mode = args.dedup
+    article_timeout = args.article_timeout
+    max_paragraph_chars = args.max_paragraph_chars
+    quarantine_path = args.quarantine_path
+    quarantined_files = read_quarantine(quarantine_path)
+    dedup_threshold = args.dedup_threshold
+    dedup_memory_size = int(args.dedup_memory_size * 2 ** 20)
+    # the order of the methods is kept, repeated methods are dropped
+    extract_methods = list(dict.fromkeys(args.extract_method))
+    device = args.device
+    segmentation_cache_dir = args.segmentation_cache_dir
+    segmentation_cache_size = int(args.segmentation_cache_size * 2 ** 30)
+    pmid2info_path = args.pmid2info_path
+    pmid_index_path = args.pmid_index_path
+    doi_index_path = args.doi_index_path
+
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    # pmc_dir = '/vol/tmp/lethanhd/pmc/oa_comm/xml/PMC000xxxxxx'
+    # files = [os.path.join(pmc_dir, file) for file in os.listdir(pmc_dir)]
+
+    package_reader = PackageReader(args.package_index_dir)
+    if args.pmc_packages is not None:
+        files = list_package_articles(args.pmc_packages, args.package_index_dir)
+    else:
+        with open('random_file_samples_50k', 'r') as f:
+            files = f.read().splitlines()
+
+    if args.workers > 1:
+        run_parallel_extraction(files, args.output_dir, extract_methods, args.workers, keep_shards=args.keep_shards, resume=args.resume)
+    else:
+        run_extraction(files, args.output_dir, extract_methods, resume=args.resume)
+
 
+if __name__ == '__main__':
+    main()
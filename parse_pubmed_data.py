@@ -1,62 +1,370 @@
 from tqdm import tqdm
 import os
-import pubmed_parser as pp
 import json
+import argparse
+import multiprocessing
+from array import array
 from html import unescape
+from pmid_index import write_pmid_bitmap, update_pmid_index
+from doi_index import DoiIndexWriter, normalize_doi
+from file_verification import verify_files
+from corpus_store import CorpusStoreWriter
 
 
-pubmed_dir = '/vol/tmp/lethanhd/pubmed/baseline'
-baseline_dict = {}
-
-id_title_abs = 0
-id_title = 0
-misc_case = 0
-authors_translations = 0
-titles_w_brackets = 0
-
-file_list = os.listdir(pubmed_dir)
-for filename in tqdm(file_list):
-    full_path = os.path.join(pubmed_dir, filename)
-    partial_baseline = pp.parse_medline_xml(full_path)
-
-    for article in partial_baseline:
-        pmid = article['pmid']
-
-        title = unescape(article['title'])
-        # remove brackets in titles like '[Serum immunoglobulin E level in bronchial asthma].'
-        # if title.startswith('[') and title.endswith('].'):
-        #     if title.endswith("(author's transl)]."):
-        #         title = title[1:-20] + '.'
-        #         authors_translations += 1
-        #     else:
-        #         title = title[1:-2] + '.'
-        #     titles_w_brackets += 1
-
-        abstract = unescape(article['abstract'])
-        # remove multiple white space characters
-        abstract = ' '.join(abstract.split())
-
-        # Skip articles without pmid, title or abstract
-        if pmid != '' and title != '' and abstract != '':
-            baseline_dict[pmid] = [title, abstract]
-            id_title_abs += 1
-        elif pmid != '' and title != '':
-            id_title += 1
-        else:
-            misc_case += 1
-
-
-with open('pmid2info.json', 'w') as pmid2info:
-    json.dump(baseline_dict, pmid2info, ensure_ascii=False, indent=4)
-
-lines = [
-    'paper with pm id, title and abstract ' + str(id_title_abs),
-    'paper with pm id and title ' + str(id_title),
-    'other cases ' + str(misc_case),
-    # 'titles with brackets ', str(titles_w_brackets),
-    # 'author translations ', str(authors_translations)
-]
-
-with open('pubmed_stats', 'w') as f:
-    f.write('\n'.join(lines))
+def get_article_info(article):
+    # returns pmid, title and abstract of a parsed medline article and whether all three are present
+    pmid = article['pmid']
 
+    title = unescape(article['title'])
+    # remove brackets in titles like '[Serum immunoglobulin E level in bronchial asthma].'
+    # if title.startswith('[') and title.endswith('].'):
+    #     if title.endswith("(author's transl)]."):
+    #         title = title[1:-20] + '.'
+    #         authors_translations += 1
+    #     else:
+    #         title = title[1:-2] + '.'
+    #     titles_w_brackets += 1
+
+    abstract = unescape(article['abstract'])
+    # remove multiple white space characters
+    abstract = ' '.join(abstract.split())
+
+    return pmid, title, abstract
+
+
+def get_article_doi(article):
+    # doi from the ArticleIdList, references in PMC articles that only have a doi are resolved through it
+    return normalize_doi(article.get('doi', ''))
+
+
+def count_article(stats, pmid, title, abstract):
+    # Skip articles without pmid, title or abstract
+    if pmid != '' and title != '' and abstract != '':
+        stats['id_title_abs'] += 1
+        return True
+    elif pmid != '' and title != '':
+        stats['id_title'] += 1
+    else:
+        stats['misc_case'] += 1
+
+    return False
+
+
+def parse_baseline_file(job):
+    # parses one baseline file and streams its usable articles to a jsonl shard, one [pmid, title, abstract] per line.
+    # the pmids are also written in line order to a binary side file, so the merge does not need to read the texts twice.
+    # the dois of these articles go to a third file, one "pmid<tab>doi" per line
+    import pubmed_parser as pp
+
+    full_path, shard_path = job
+
+    stats = {'id_title_abs': 0, 'id_title': 0, 'misc_case': 0}
+    pmids = array('I')
+
+    with open(shard_path + '.tmp', 'w') as f, open(shard_path + '.dois', 'w') as doi_file:
+        for article in pp.parse_medline_xml(full_path):
+            pmid, title, abstract = get_article_info(article)
+
+            if count_article(stats, pmid, title, abstract):
+                f.write(json.dumps([pmid, title, abstract], ensure_ascii=False) + '\n')
+                pmids.append(int(pmid))
+
+                doi = get_article_doi(article)
+                if doi != '':
+                    doi_file.write(pmid + '\t' + doi + '\n')
+
+    with open(shard_path + '.pmids', 'wb') as f:
+        pmids.tofile(f)
+    # the shard only gets its final name once it is complete
+    os.replace(shard_path + '.tmp', shard_path)
+
+    return shard_path, stats
+
+
+def parse_update_file(full_path):
+    # update files contain revised versions of existing articles, new articles and DeleteCitation entries
+    import pubmed_parser as pp
+
+    stats = {'id_title_abs': 0, 'id_title': 0, 'misc_case': 0}
+    articles = []
+    dois = []
+    deleted_pmids = []
+
+    for article in pp.parse_medline_xml(full_path):
+        # deleted citations only carry their pmid, the other fields are empty
+        if article.get('delete', False):
+            deleted_pmids.append(article['pmid'])
+            continue
+
+        pmid, title, abstract = get_article_info(article)
+        if count_article(stats, pmid, title, abstract):
+            articles.append((pmid, title, abstract))
+
+            doi = get_article_doi(article)
+            if doi != '':
+                dois.append((doi, pmid))
+
+    return full_path, articles, dois, deleted_pmids, stats
+
+
+def verify_input_files(full_paths, output_dir, corrupted_files, threads):
+    # checks the files against their .md5 sums before any time is spent parsing them, returns the files that failed
+    statuses = verify_files(full_paths, os.path.join(output_dir, 'verified_files.json'), threads=threads)
+    failed_paths = [full_path for full_path in full_paths if statuses[full_path] != 'correct']
+
+    for full_path in failed_paths:
+        print(statuses[full_path] + ': ' + full_path)
+    if len(failed_paths) > 0 and corrupted_files == 'refuse':
+        raise ValueError(str(len(failed_paths)) + ' input files failed the md5 check, e.g. ' + failed_paths[0])
+
+    return failed_paths
+
+
+def apply_update_files(update_dir, store_dir, index_path, doi_index_path, workers, corrupted_files=None, verify_threads=8):
+    # applies the update files that are not yet recorded in the store in file order, the store is checkpointed
+    # after every file, so an interrupted run continues with the first file that was not applied
+    store_writer = CorpusStoreWriter(store_dir, append=True)
+
+    update_files = sorted(filename for filename in os.listdir(update_dir) if filename.endswith('.xml.gz'))
+    update_files = [filename for filename in update_files if filename not in store_writer.applied_updates]
+
+    num_skipped_files = 0
+    if corrupted_files is not None:
+        failed_paths = verify_input_files([os.path.join(update_dir, filename) for filename in update_files],
+                                          os.path.dirname(store_dir), corrupted_files, verify_threads)
+        if len(failed_paths) > 0:
+            # updates have to be applied in order, stop before the first file that failed
+            first_failed = update_files.index(os.path.basename(failed_paths[0]))
+            num_skipped_files = len(update_files) - first_failed
+            update_files = update_files[:first_failed]
+
+    # dois of deleted articles stay in the doi index, their pmids are not in the pmid index anymore
+    doi_writer = DoiIndexWriter.from_index(doi_index_path) if os.path.exists(doi_index_path) else None
+
+    update_stats = {'id_title_abs': 0, 'id_title': 0, 'misc_case': 0, 'deleted': 0, 'applied_update_files': 0,
+                    'skipped_update_files': num_skipped_files}
+    with multiprocessing.get_context('fork').Pool(workers) as pool:
+        # imap parses ahead in parallel but returns the files in order
+        jobs = [os.path.join(update_dir, filename) for filename in update_files]
+        for full_path, articles, dois, deleted_pmids, stats in tqdm(pool.imap(parse_update_file, jobs), total=len(jobs)):
+            for pmid, title, abstract in articles:
+                store_writer.add(pmid, title, abstract)
+            for pmid in deleted_pmids:
+                store_writer.delete(pmid)
+
+            if os.path.exists(index_path):
+                update_pmid_index(index_path, [article[0] for article in articles], deleted_pmids)
+            if doi_writer is not None:
+                for doi, pmid in dois:
+                    doi_writer.add(doi, pmid)
+                # written before the store checkpoint, a file that is applied again adds the same dois
+                doi_writer.write(doi_index_path)
+
+            store_writer.checkpoint(applied_update=os.path.basename(full_path))
+
+            for key in stats:
+                update_stats[key] += stats[key]
+            update_stats['deleted'] += len(deleted_pmids)
+            update_stats['applied_update_files'] += 1
+
+    store_writer.close()
+
+    return update_stats, store_writer.num_pmids
+
+
+def read_shard_pmids(shard_path):
+    pmids = array('I')
+    with open(shard_path + '.pmids', 'rb') as f:
+        pmids.frombytes(f.read())
+
+    return pmids
+
+
+def write_baseline_doi_index(shard_paths, doi_index_path):
+    # dois in file order, a doi that occurs in a later file is mapped to the pmid of that file
+    num_dois = 0
+    for shard_path in shard_paths:
+        with open(shard_path + '.dois', 'r') as f:
+            num_dois += sum(1 for _ in f)
+
+    doi_writer = DoiIndexWriter(num_dois)
+    for shard_path in shard_paths:
+        with open(shard_path + '.dois', 'r') as f:
+            for line in f:
+                pmid, doi = line.rstrip('\n').split('\t', 1)
+                doi_writer.add(doi, pmid)
+    doi_writer.write(doi_index_path)
+
+    return doi_writer.num_dois
+
+
+def merge_baseline_shards(shard_paths, pmid2info_path, index_path, store_dir):
+    # a pmid can occur in several baseline files and the last version wins. walk the shards backwards keeping only
+    # the last occurrence of every pmid, then write the kept records in file order. apart from the current record
+    # only the pmid bitmap and one byte per record are held in memory
+    seen = bytearray(1)
+    keep_masks = [None] * len(shard_paths)
+    for shard_idx in reversed(range(len(shard_paths))):
+        pmids = read_shard_pmids(shard_paths[shard_idx])
+        keep = bytearray(len(pmids))
+
+        for line_idx in reversed(range(len(pmids))):
+            pmid = pmids[line_idx]
+            byte_idx = pmid >> 3
+            if byte_idx >= len(seen):
+                seen.extend(bytes(byte_idx + 1 - len(seen)))
+
+            if not (seen[byte_idx] >> (pmid & 7)) & 1:
+                seen[byte_idx] |= 1 << (pmid & 7)
+                keep[line_idx] = 1
+
+        keep_masks[shard_idx] = keep
+
+    num_pmids = 0
+    store_writer = CorpusStoreWriter(store_dir)
+    with open(pmid2info_path + '.tmp', 'w') as pmid2info:
+        pmid2info.write('{')
+        for shard_path, keep in zip(shard_paths, keep_masks):
+            with open(shard_path, 'r') as f:
+                for line, keep_line in zip(f, keep):
+                    if not keep_line:
+                        continue
+
+                    pmid, title, abstract = json.loads(line)
+                    pmid2info.write(('\n' if num_pmids == 0 else ',\n') + json.dumps(pmid) + ': ' + json.dumps([title, abstract], ensure_ascii=False))
+                    store_writer.add(pmid, title, abstract)
+                    num_pmids += 1
+        pmid2info.write('\n}')
+    os.replace(pmid2info_path + '.tmp', pmid2info_path)
+    store_writer.close()
+
+    # compact pmid set for the membership test in parse_pmc_data.py
+    write_pmid_bitmap(seen, index_path)
+
+    return num_pmids
+
+
+def build_baseline(pubmed_dir, output_dir, workers, corrupted_files=None, verify_threads=8):
+    shard_dir = os.path.join(output_dir, 'pubmed_shards')
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+
+    # baseline files are numbered, sorting them makes "later file wins" well defined
+    file_list = sorted(filename for filename in os.listdir(pubmed_dir) if filename.endswith('.xml.gz'))
+
+    failed_paths = []
+    if corrupted_files is not None:
+        failed_paths = verify_input_files([os.path.join(pubmed_dir, filename) for filename in file_list], output_dir, corrupted_files, verify_threads)
+        failed_files = set(os.path.basename(full_path) for full_path in failed_paths)
+        file_list = [filename for filename in file_list if filename not in failed_files]
+    jobs = [(os.path.join(pubmed_dir, filename), os.path.join(shard_dir, filename[:-len('.xml.gz')] + '.jsonl'))
+            for filename in file_list]
+
+    id_title_abs = 0
+    id_title = 0
+    misc_case = 0
+    authors_translations = 0
+    titles_w_brackets = 0
+
+    with multiprocessing.get_context('fork').Pool(workers) as pool:
+        for shard_path, stats in tqdm(pool.imap_unordered(parse_baseline_file, jobs), total=len(jobs)):
+            id_title_abs += stats['id_title_abs']
+            id_title += stats['id_title']
+            misc_case += stats['misc_case']
+
+    num_pmids = merge_baseline_shards([shard_path for _, shard_path in jobs],
+                                      os.path.join(output_dir, 'pmid2info.json'),
+                                      os.path.join(output_dir, 'pmid_index.bin'),
+                                      os.path.join(output_dir, 'pmid2info_store'))
+    num_dois = write_baseline_doi_index([shard_path for _, shard_path in jobs], os.path.join(output_dir, 'doi_index.bin'))
+
+    lines = [
+        'paper with pm id, title and abstract ' + str(id_title_abs),
+        'paper with pm id and title ' + str(id_title),
+        'other cases ' + str(misc_case),
+        'unique pm ids with title and abstract ' + str(num_pmids),
+        'unique dois of these papers ' + str(num_dois),
+        # 'titles with brackets ', str(titles_w_brackets),
+        # 'author translations ', str(authors_translations)
+    ]
+    if corrupted_files is not None:
+        lines.append('skipped files that failed the md5 check ' + str(len(failed_paths)))
+
+    with open(os.path.join(output_dir, 'pubmed_stats'), 'w') as f:
+        f.write('\n'.join(lines))
+
+
+def update_corpus(update_dir, output_dir, workers, corrupted_files=None, verify_threads=8):
+    update_stats, num_pmids = apply_update_files(update_dir,
+                                                 os.path.join(output_dir, 'pmid2info_store'),
+                                                 os.path.join(output_dir, 'pmid_index.bin'),
+                                                 os.path.join(output_dir, 'doi_index.bin'),
+                                                 workers,
+                                                 corrupted_files=corrupted_files,
+                                                 verify_threads=verify_threads)
+
+    lines = [
+        'applied update files ' + str(update_stats['applied_update_files']),
+        'added or revised paper with pm id, title and abstract ' + str(update_stats['id_title_abs']),
+        'paper with pm id and title ' + str(update_stats['id_title']),
+        'other cases ' + str(update_stats['misc_case']),
+        'deleted pm ids ' + str(update_stats['deleted']),
+        'unique pm ids with title and abstract ' + str(num_pmids),
+    ]
+    if corrupted_files is not None:
+        lines.append('update files not applied because of a failed md5 check ' + str(update_stats['skipped_update_files']))
+
+    with open(os.path.join(output_dir, 'pubmed_update_stats'), 'w') as f:
+        f.write('\n'.join(lines))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        '--pubmed_dir',
+        type=str,
+        default='/vol/tmp/lethanhd/pubmed/baseline'
+    )
+    parser.add_argument(
+        '--output_dir',
+        type=str,
+        default='.',
+        help='pmid2info.json, the pmid2info_store/ corpus store, pmid_index.bin, doi_index.bin, pubmed_stats and the per file shards in pubmed_shards/ are written here'
+    )
+    parser.add_argument(
+        '--update_dir',
+        type=str,
+        help='directory with the pubmed updatefiles, applies the files not applied yet to <output_dir>/pmid2info_store, '
+             '<output_dir>/pmid_index.bin and <output_dir>/doi_index.bin instead of parsing the baseline'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='number of baseline or update files parsed in parallel'
+    )
+    parser.add_argument(
+        '--corrupted_files',
+        choices=('skip', 'refuse'),
+        help='check the input files against their .md5 files first. skip: leave out the baseline files that fail, '
+             'or apply the update files before the first one that fails, refuse: stop if any file fails. '
+             'the md5 sums are kept in <output_dir>/verified_files.json, unchanged files are not hashed again'
+    )
+    parser.add_argument(
+        '--verify_threads',
+        type=int,
+        default=8,
+        help='number of files hashed in parallel for --corrupted_files'
+    )
+
+    args = parser.parse_args()
+
+    if args.update_dir is not None:
+        update_corpus(args.update_dir, args.output_dir, args.workers, corrupted_files=args.corrupted_files, verify_threads=args.verify_threads)
+    else:
+        build_baseline(args.pubmed_dir, args.output_dir, args.workers, corrupted_files=args.corrupted_files, verify_threads=args.verify_threads)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+import argparse
+import json
+import os
+import random
+from tqdm import tqdm
+
+# A PMC manifest is a directory with
+#   index.json     per scanned PMC directory: its mtime, license subset, number of files and its listing file
+#   dir_*.tsv      listing of one PMC directory, one "pmc id<tab>size<tab>file name" per article
+# The listings are written with os.scandir once. A refresh only lists the directories whose mtime changed and only
+# stats the files that are new in them. Sampling streams the listings, memory is bounded by the sample size.
+
+license_subsets = ('oa_comm', 'oa_noncomm', 'oa_other')
+article_extensions = ('.xml', '.nxml')
+
+
+def get_license_subset(pmc_dir):
+    # e.g. /vol/tmp/lethanhd/pmc/oa_comm/xml/PMC000xxxxxx -> oa_comm
+    for part in os.path.normpath(pmc_dir).split(os.sep):
+        if part in license_subsets:
+            return part
+
+    return 'unknown'
+
+
+def get_listing_name(pmc_dir):
+    return 'dir_' + os.path.normpath(os.path.abspath(pmc_dir)).strip(os.sep).replace(os.sep, '_') + '.tsv'
+
+
+def load_index(manifest_dir):
+    index_path = os.path.join(manifest_dir, 'index.json')
+    if not os.path.exists(index_path):
+        return {}
+
+    with open(index_path, 'r') as f:
+        return json.load(f)
+
+
+def write_index(manifest_dir, index):
+    with open(os.path.join(manifest_dir, 'index.json.tmp'), 'w') as f:
+        json.dump(index, f, indent=4)
+    os.replace(os.path.join(manifest_dir, 'index.json.tmp'), os.path.join(manifest_dir, 'index.json'))
+
+
+def read_listing(listing_path):
+    # (pmc id, size, file name) per article
+    with open(listing_path, 'r') as f:
+        for line in f:
+            pmc_id, size, name = line.rstrip('\n').split('\t', 2)
+            yield pmc_id, int(size), name
+
+
+def scan_dir(pmc_dir, listing_path, known_sizes):
+    # lists the articles of a directory, only files that are not in known_sizes are stat-ed
+    num_files = 0
+    with open(listing_path + '.tmp', 'w') as f:
+        with os.scandir(pmc_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith(article_extensions):
+                    continue
+
+                size = known_sizes.get(entry.name)
+                if size is None:
+                    if not entry.is_file():
+                        continue
+                    size = entry.stat().st_size
+
+                pmc_id = entry.name.rsplit('.', 1)[0]
+                f.write(pmc_id + '\t' + str(size) + '\t' + entry.name + '\n')
+                num_files += 1
+    os.replace(listing_path + '.tmp', listing_path)
+
+    return num_files
+
+
+def refresh_manifest(manifest_dir, pmc_dirs, full=False):
+    # lists new directories and directories that changed since the last refresh, full=True lists and stats everything
+    if not os.path.exists(manifest_dir):
+        os.makedirs(manifest_dir)
+
+    index = load_index(manifest_dir)
+    for pmc_dir in tqdm(pmc_dirs):
+        pmc_dir = os.path.normpath(os.path.abspath(pmc_dir))
+        mtime = os.stat(pmc_dir).st_mtime_ns
+        entry = index.get(pmc_dir)
+        if entry is not None and entry['mtime'] == mtime and not full:
+            continue
+
+        listing_path = os.path.join(manifest_dir, get_listing_name(pmc_dir))
+        known_sizes = {}
+        if entry is not None and not full:
+            known_sizes = {name: size for _, size, name in read_listing(listing_path)}
+
+        num_files = scan_dir(pmc_dir, listing_path, known_sizes)
+        index[pmc_dir] = {'mtime': mtime, 'subset': get_license_subset(pmc_dir), 'num_files': num_files,
+                          'listing': get_listing_name(pmc_dir)}
+        # written after every directory, an interrupted refresh keeps the directories listed so far
+        write_index(manifest_dir, index)
+
+    return index
+
+
+def iter_articles(manifest_dir, subset=None):
+    # (path, pmc id, size, license subset) of all articles, or of the articles of one license subset
+    for pmc_dir, entry in load_index(manifest_dir).items():
+        if subset is not None and entry['subset'] != subset:
+            continue
+
+        for pmc_id, size, name in read_listing(os.path.join(manifest_dir, entry['listing'])):
+            yield os.path.join(pmc_dir, name), pmc_id, size, entry['subset']
+
+
+def reservoir_sample(items, num_samples, rng):
+    # uniform sample of an iterable of unknown length in one pass, the sample is returned in random order
+    sample = []
+    for item_idx, item in enumerate(items):
+        if item_idx < num_samples:
+            sample.append(item)
+            continue
+
+        replaced_idx = rng.randrange(item_idx + 1)
+        if replaced_idx < num_samples:
+            sample[replaced_idx] = item
+    rng.shuffle(sample)
+
+    return sample
+
+
+def allocate_samples(subset_sizes, num_samples):
+    # samples per subset proportional to its size, the remainders go to the subsets with the largest fractions
+    total = sum(subset_sizes.values())
+    if total == 0:
+        return dict.fromkeys(subset_sizes, 0)
+
+    num_samples = min(num_samples, total)
+    allocation = {subset: num_samples * size // total for subset, size in subset_sizes.items()}
+    remainders = sorted(subset_sizes, key=lambda subset: num_samples * subset_sizes[subset] % total, reverse=True)
+    for subset in remainders[:num_samples - sum(allocation.values())]:
+        allocation[subset] += 1
+
+    return allocation
+
+
+def sample_articles(manifest_dir, num_samples, stratified=False, seed=42):
+    # paths of a uniform sample of the articles. stratified samples every license subset in proportion to its size,
+    # the subset sizes are taken from the index and every subset is sampled with its own reservoir
+    rng = random.Random(seed)
+
+    if not stratified:
+        return [path for path, _, _, _ in reservoir_sample(iter_articles(manifest_dir), num_samples, rng)]
+
+    subset_sizes = {}
+    for entry in load_index(manifest_dir).values():
+        subset_sizes[entry['subset']] = subset_sizes.get(entry['subset'], 0) + entry['num_files']
+
+    sample = []
+    for subset, subset_samples in sorted(allocate_samples(subset_sizes, num_samples).items()):
+        sample.extend(path for path, _, _, _ in reservoir_sample(iter_articles(manifest_dir, subset), subset_samples, rng))
+    rng.shuffle(sample)
+
+    return sample
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        '--manifest_dir',
+        type=str,
+        required=True
+    )
+    parser.add_argument(
+        '--pmc_dirs',
+        nargs='+',
+        help='PMC directories to list into the manifest, directories that did not change since the last run are skipped'
+    )
+    parser.add_argument(
+        '--full_refresh',
+        action='store_true',
+        help='list and stat all --pmc_dirs again'
+    )
+    parser.add_argument(
+        '--num_samples',
+        type=int,
+        help='write a random sample of this many article paths to --output_path'
+    )
+    parser.add_argument(
+        '--stratified',
+        action='store_true',
+        help='sample every license subset (oa_comm, oa_noncomm, oa_other) in proportion to its size'
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=42
+    )
+    parser.add_argument(
+        '--output_path',
+        type=str,
+        default='random_file_samples'
+    )
+
+    args = parser.parse_args()
+
+    if args.pmc_dirs is not None:
+        index = refresh_manifest(args.manifest_dir, args.pmc_dirs, full=args.full_refresh)
+        print('num articles', sum(entry['num_files'] for entry in index.values()))
+
+    if args.num_samples is not None:
+        sample = sample_articles(args.manifest_dir, args.num_samples, stratified=args.stratified, seed=args.seed)
+        with open(args.output_path, 'w') as f:
+            f.write('\n'.join(sample))
+        print('num samples', len(sample))
@@ -0,0 +1,300 @@
+import argparse
+import bisect
+import os
+import tarfile
+import zlib
+from collections import OrderedDict
+
+# Reads PMC articles straight out of the PMC OA bulk packages (e.g. oa_comm_xml.PMC000xxxxxx.baseline.<date>.tar.gz)
+# instead of extracted xml files. An article is addressed as "<package path>::<member name>", these ids take the place
+# of file paths in the file list of parse_pmc_data.py.
+# A package index is a directory with one "<package file name>.tsv" per package, one "member name<tab>data offset<tab>
+# size" per article, the offsets are positions in the uncompressed tar stream. With an index a member is read by seeking
+# to its offset, without it the tar headers are scanned up to the member.
+# A gzip stream can only be decompressed from its start, so the reader of a package keeps seek points, copies of the
+# decompressor state every seek_point_spacing bytes of the part of the package decompressed so far. A seek decompresses
+# from the nearest seek point before the offset, so articles in random order, e.g. a shuffled sample, cost at most
+# seek_point_spacing bytes of decompression each instead of everything up to their offset. The seek points are kept in
+# memory, about 40 KB each, for the lifetime of the PackageReader.
+
+article_extensions = ('.xml', '.nxml')
+package_separator = '::'
+
+seek_point_spacing = 4 * 2 ** 20
+read_size = 2 ** 20
+
+
+def is_package_article(file):
+    return package_separator in file
+
+
+def get_index_path(index_dir, package_path):
+    return os.path.join(index_dir, os.path.basename(package_path) + '.tsv')
+
+
+def read_package_index(index_path):
+    members = OrderedDict()
+    with open(index_path, 'r') as f:
+        for line in f:
+            name, offset, size = line.rstrip('\n').split('\t')
+            members[name] = (int(offset), int(size))
+
+    return members
+
+
+def scan_package(package_path, index_dir=None):
+    # (member name, data offset, size) of the articles of a package in one streaming pass, also written to the index
+    members = OrderedDict()
+    with tarfile.open(package_path, 'r|*') as tar:
+        for member in tar:
+            if member.isfile() and member.name.endswith(article_extensions):
+                members[member.name] = (member.offset_data, member.size)
+
+    if index_dir is not None:
+        if not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+        # the index only gets its final name once it is complete
+        index_path = get_index_path(index_dir, package_path)
+        with open(index_path + '.tmp', 'w') as f:
+            for name, (offset, size) in members.items():
+                f.write(name + '\t' + str(offset) + '\t' + str(size) + '\n')
+        os.replace(index_path + '.tmp', index_path)
+
+    return members
+
+
+def get_package_members(package_path, index_dir=None):
+    if index_dir is not None and os.path.exists(get_index_path(index_dir, package_path)):
+        return read_package_index(get_index_path(index_dir, package_path))
+
+    return scan_package(package_path, index_dir)
+
+
+def list_package_articles(package_paths, index_dir=None):
+    # article ids of all articles of the packages in member order, packages without index are scanned once
+    article_ids = []
+    for package_path in package_paths:
+        article_ids.extend(package_path + package_separator + name for name in get_package_members(package_path, index_dir))
+
+    return article_ids
+
+
+class SeekPoints:
+    # uncompressed offsets of a gzip stream and the state to continue decompressing from each of them:
+    # (position of the next compressed byte in the gzip file, decompressor)
+
+    def __init__(self):
+        self.offsets = [0]
+        self.states = [(0, zlib.decompressobj(zlib.MAX_WBITS | 16))]
+
+    def is_due(self, offset):
+        # points are added in the order a package is decompressed, only beyond the last one
+        return offset >= self.offsets[-1] + seek_point_spacing
+
+    def add(self, offset, state):
+        self.offsets.append(offset)
+        self.states.append(state)
+
+    def find(self, offset):
+        # the last point at or before offset
+        idx = bisect.bisect_right(self.offsets, offset) - 1
+        return self.offsets[idx], self.states[idx]
+
+
+class GzipReader:
+    # read-only, seekable file object of the decompressed content of a gzip file, see SeekPoints
+
+    def __init__(self, path, seek_points):
+        self.file = open(path, 'rb')
+        self.seek_points = seek_points
+        self.restore(0, seek_points.states[0])
+
+    def restore(self, offset, state):
+        file_position, decompressor = state
+        self.decompressor = decompressor.copy()
+        self.file.seek(file_position)
+        self.pending = b''
+        self.offset = offset
+
+    def inflate(self, max_length):
+        # up to max_length decompressed bytes from the current offset, b'' at the end of the file
+        while True:
+            if self.pending == b'':
+                self.pending = self.file.read(read_size)
+                if self.pending == b'':
+                    return b''
+
+            if self.decompressor.eof:
+                # a further gzip member, the end of the file may be padded with zeros
+                self.pending = self.pending.lstrip(b'\0')
+                if self.pending == b'':
+                    continue
+                self.decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+
+            data = self.decompressor.decompress(self.pending, max_length)
+            self.pending = self.decompressor.unused_data if self.decompressor.eof else self.decompressor.unconsumed_tail
+            if len(data) > 0:
+                self.offset += len(data)
+                if self.seek_points.is_due(self.offset):
+                    self.seek_points.add(self.offset, (self.file.tell() - len(self.pending), self.decompressor.copy()))
+                return data
+
+    def read(self, size=-1):
+        chunks = []
+        while size != 0:
+            data = self.inflate(read_size if size < 0 else min(size, read_size))
+            if data == b'':
+                break
+            chunks.append(data)
+            if size > 0:
+                size -= len(data)
+
+        return b''.join(chunks)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.offset
+        elif whence != os.SEEK_SET:
+            raise OSError('a gzip package can only be seeked from its start or the current position')
+
+        point_offset, state = self.seek_points.find(offset)
+        if offset < self.offset or point_offset > self.offset:
+            self.restore(point_offset, state)
+        while self.offset < offset:
+            if self.inflate(min(offset - self.offset, read_size)) == b'':
+                break
+
+        return self.offset
+
+    def tell(self):
+        return self.offset
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def close(self):
+        self.file.close()
+
+
+def is_gzip_file(path):
+    with open(path, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+
+class OpenPackage:
+
+    def __init__(self, package_path, members, seek_points):
+        # gzip packages are read through a GzipReader with the seek points of the package, other packages are left to
+        # tarfile, e.g. uncompressed tar files, which it can seek directly
+        if is_gzip_file(package_path):
+            self.reader = GzipReader(package_path, seek_points)
+            self.tar = tarfile.open(fileobj=self.reader, mode='r:')
+        else:
+            self.reader = None
+            self.tar = tarfile.open(package_path, 'r:*')
+        self.members = members
+        self.scanned_all = False
+
+    def find_member(self, name):
+        if name in self.members:
+            return self.members[name]
+
+        # without index the headers are read up to the member, the members passed on the way are remembered
+        while not self.scanned_all:
+            member = self.tar.next()
+            if member is None:
+                self.scanned_all = True
+                break
+            if member.isfile():
+                self.members[member.name] = (member.offset_data, member.size)
+                if member.name == name:
+                    return self.members[name]
+
+        raise KeyError(name + ' is not in the package')
+
+    def read(self, name):
+        offset, size = self.find_member(name)
+        self.tar.fileobj.seek(offset)
+        return self.tar.fileobj.read(size)
+
+    def close(self):
+        self.tar.close()
+        if self.reader is not None:
+            self.reader.close()
+
+
+class PackageReader:
+    # returns the bytes of articles by article id, keeps a few packages open per process. the seek points of a package
+    # are kept when it is closed, so reopening it does not start decompressing from its start again
+
+    def __init__(self, index_dir=None, max_open_packages=4):
+        self.index_dir = index_dir
+        self.max_open_packages = max_open_packages
+        self.packages = OrderedDict()
+        self.packages_pid = None
+        self.seek_points = {}
+
+    def open_package(self, package_path):
+        # open packages are not shared with forked processes, every process opens its own
+        if self.packages_pid != os.getpid():
+            self.packages = OrderedDict()
+            self.packages_pid = os.getpid()
+            self.seek_points = {}
+
+        if package_path in self.packages:
+            self.packages.move_to_end(package_path)
+            return self.packages[package_path]
+
+        members = {}
+        if self.index_dir is not None and os.path.exists(get_index_path(self.index_dir, package_path)):
+            members = read_package_index(get_index_path(self.index_dir, package_path))
+        if package_path not in self.seek_points:
+            self.seek_points[package_path] = SeekPoints()
+        self.packages[package_path] = OpenPackage(package_path, members, self.seek_points[package_path])
+
+        if len(self.packages) > self.max_open_packages:
+            _, package = self.packages.popitem(last=False)
+            package.close()
+
+        return self.packages[package_path]
+
+    def read(self, article_id):
+        package_path, name = article_id.split(package_separator, 1)
+        return self.open_package(package_path).read(name)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        '--packages',
+        nargs='+',
+        required=True,
+        help='PMC OA bulk .tar.gz packages'
+    )
+    parser.add_argument(
+        '--index_dir',
+        type=str,
+        required=True,
+        help='the member offsets of every package are written here'
+    )
+    parser.add_argument(
+        '--file_list_path',
+        type=str,
+        help='also write the article ids of all packages, one per line, e.g. as input of pmc_manifest.py sampling or parse_pmc_data.py'
+    )
+
+    args = parser.parse_args()
+
+    article_ids = []
+    for package_path in args.packages:
+        members = scan_package(package_path, args.index_dir)
+        article_ids.extend(package_path + package_separator + name for name in members)
+        print(package_path, 'num articles', len(members))
+
+    if args.file_list_path is not None:
+        with open(args.file_list_path, 'w') as f:
+            f.write('\n'.join(article_ids))
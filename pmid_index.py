@@ -0,0 +1,100 @@
+import argparse
+import json
+import mmap
+import os
+
+
+class PmidSet:
+    # read-only set of pmids backed by a memory-mapped bitmap, bit i is set if pmid i is in the corpus.
+    # ~40M pmids take ~5MB, opening is a single mmap and forked workers share the pages.
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        with open(index_path, 'rb') as f:
+            self.bitmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.num_pmids = None
+
+    def __contains__(self, pmid):
+        if isinstance(pmid, str):
+            # same answer as a lookup in the pmid2info dict, whose keys are plain digit strings
+            if not pmid.isascii() or not pmid.isdigit() or pmid.startswith('0'):
+                return False
+            pmid = int(pmid)
+
+        byte_idx = pmid >> 3
+        if pmid < 0 or byte_idx >= len(self.bitmap):
+            return False
+
+        return (self.bitmap[byte_idx] >> (pmid & 7)) & 1 == 1
+
+    def __len__(self):
+        if self.num_pmids is None:
+            self.num_pmids = int.from_bytes(self.bitmap, 'little').bit_count()
+        return self.num_pmids
+
+
+def build_pmid_bitmap(pmids):
+    bitmap = bytearray(1)
+    for pmid in pmids:
+        pmid = int(pmid)
+        byte_idx = pmid >> 3
+        if byte_idx >= len(bitmap):
+            bitmap.extend(bytes(byte_idx + 1 - len(bitmap)))
+        bitmap[byte_idx] |= 1 << (pmid & 7)
+
+    return bitmap
+
+
+def write_pmid_index(pmids, index_path):
+    write_pmid_bitmap(build_pmid_bitmap(pmids), index_path)
+
+
+def update_pmid_index(index_path, added_pmids, removed_pmids):
+    with open(index_path, 'rb') as f:
+        bitmap = bytearray(f.read())
+
+    for pmid in added_pmids:
+        pmid = int(pmid)
+        byte_idx = pmid >> 3
+        if byte_idx >= len(bitmap):
+            bitmap.extend(bytes(byte_idx + 1 - len(bitmap)))
+        bitmap[byte_idx] |= 1 << (pmid & 7)
+
+    for pmid in removed_pmids:
+        pmid = int(pmid)
+        byte_idx = pmid >> 3
+        if byte_idx < len(bitmap):
+            bitmap[byte_idx] &= ~(1 << (pmid & 7)) & 0xff
+
+    write_pmid_bitmap(bitmap, index_path)
+
+
+def write_pmid_bitmap(bitmap, index_path):
+    # write to a temporary file first, so processes that have the old index mapped are not affected
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(bitmap)
+    os.replace(tmp_path, index_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        '--pmid2info_path',
+        type=str,
+        required=True
+    )
+    parser.add_argument(
+        '--index_path',
+        type=str,
+        required=True
+    )
+
+    args = parser.parse_args()
+
+    with open(args.pmid2info_path, 'r') as f:
+        pmid2info = json.load(f)
+
+    write_pmid_index(pmid2info.keys(), args.index_path)
+    print('num pmids', len(PmidSet(args.index_path)))
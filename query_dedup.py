@@ -0,0 +1,343 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import time
+from array import array
+
+# Collapses duplicate queries of an extraction run into one qid, the cited pmids of the collapsed queries are merged
+# into the train.jsonl rows of the qid that is kept. The queries are streamed once in qid order and the train.jsonl
+# rows once, so the whole output never has to fit into memory:
+#   exact: queries that are equal after lowercasing and dropping punctuation, found by a 64 bit hash of that text
+#   near:  additionally queries whose word 3-gram sets have an estimated jaccard similarity of at least the threshold,
+#          found with minhash signatures and a locality-sensitive hashing index of their bands
+# The index takes a fixed number of bytes per kept query and stops growing at memory_size, later queries are still
+# compared against it but are not added. The qid map is not part of memory_size, it grows linearly with the run: the
+# new qid of every query (4 bytes), a collapsed flag per kept query (1 byte) and a table of the pmids cited by the
+# collapsed queries (12 bytes per slot). The kept queries are renumbered from 0 in their order, so the qids stay
+# contiguous. parse_pmc_data.py --dedup runs it when it writes the final outputs, main() on finished output directories.
+
+dedup_modes = ('exact', 'near')
+default_threshold = 0.8
+default_memory_size = 2 ** 30
+
+shingle_size = 3
+num_permutations = 64
+# 16 bands of 4 rows make queries with a similarity of 0.8 candidates with a probability of 0.9998, the candidates are
+# then checked against the threshold with the stored signature
+num_bands = 16
+band_size = num_permutations // num_bands
+
+
+def normalize_query(query):
+    return ' '.join(re.findall(r'\w+', query.lower()))
+
+
+def hash_bytes(data):
+    # 0 marks an empty slot
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little') or 1
+
+
+def minhash_signature(normalized_query):
+    # every shingle is hashed to num_permutations uint32 values by one shake_256 digest, the signature is the minimum
+    # per position over all shingles
+    words = normalized_query.split(' ')
+    shingles = {' '.join(words[i:i + shingle_size]) for i in range(max(1, len(words) - shingle_size + 1))}
+
+    values = array('I')
+    for shingle in shingles:
+        values.frombytes(hashlib.shake_256(shingle.encode('utf-8')).digest(4 * num_permutations))
+
+    return array('I', [min(values[i::num_permutations]) for i in range(num_permutations)])
+
+
+class QidTable:
+    # open addressing hash table of 64 bit keys and uint32 qids like the doi index, at most half of the slots are used
+
+    def __init__(self):
+        self.num_slots = 1024
+        self.keys = array('Q', bytes(8 * self.num_slots))
+        self.qids = array('I', bytes(4 * self.num_slots))
+        self.num_keys = 0
+
+    def nbytes(self):
+        return 12 * self.num_slots
+
+    def get(self, key, default=None):
+        slot = key & (self.num_slots - 1)
+        while self.keys[slot] != 0:
+            if self.keys[slot] == key:
+                return self.qids[slot]
+            slot = (slot + 1) & (self.num_slots - 1)
+
+        return default
+
+    def grows_on_add(self):
+        return 2 * (self.num_keys + 1) > self.num_slots
+
+    def add(self, key, qid):
+        # a key that is in the table already keeps its qid
+        if self.grows_on_add():
+            self.grow()
+
+        slot = key & (self.num_slots - 1)
+        while self.keys[slot] != 0:
+            if self.keys[slot] == key:
+                return
+            slot = (slot + 1) & (self.num_slots - 1)
+
+        self.keys[slot] = key
+        self.qids[slot] = qid
+        self.num_keys += 1
+
+    def grow(self):
+        keys, qids = self.keys, self.qids
+        self.num_slots *= 2
+        self.keys = array('Q', bytes(8 * self.num_slots))
+        self.qids = array('I', bytes(4 * self.num_slots))
+        self.num_keys = 0
+        for key, qid in zip(keys, qids):
+            if key != 0:
+                self.add(key, qid)
+
+
+class QueryIndex:
+    # finds the kept query a query duplicates, queries are added with the qid they are kept under
+
+    def __init__(self, mode='exact', threshold=default_threshold, memory_size=default_memory_size):
+        if mode not in dedup_modes:
+            raise ValueError('unknown dedup mode ' + str(mode))
+
+        self.mode = mode
+        self.threshold = threshold
+        self.memory_size = memory_size
+        self.exact_table = QidTable()
+        # band hash -> qid of the first query with that band, and the lowest byte of every signature value of the
+        # indexed queries, a b-bit minhash signature that estimates the similarity of the candidates
+        self.band_table = QidTable() if mode == 'near' else None
+        self.signatures = bytearray()
+        self.full = False
+
+    def nbytes(self):
+        return self.exact_table.nbytes() + (self.band_table.nbytes() + len(self.signatures) if self.band_table is not None else 0)
+
+    def can_add(self):
+        # the tables double when they grow, an add that would take the index beyond memory_size is refused
+        growth = self.exact_table.nbytes() if self.exact_table.grows_on_add() else 0
+        if self.band_table is not None:
+            growth += num_permutations
+            if 2 * (self.band_table.num_keys + num_bands) > self.band_table.num_slots:
+                growth += self.band_table.nbytes()
+
+        return self.nbytes() + growth <= self.memory_size
+
+    def band_keys(self, signature):
+        return [hash_bytes(bytes([band]) + signature[band * band_size:(band + 1) * band_size].tobytes()) for band in range(num_bands)]
+
+    def find_near(self, band_keys, signature):
+        low_bytes = bytes(value & 0xff for value in signature)
+        checked = set()
+        for key in band_keys:
+            qid = self.band_table.get(key)
+            if qid is None or qid in checked:
+                continue
+            checked.add(qid)
+
+            stored = self.signatures[qid * num_permutations:(qid + 1) * num_permutations]
+            matches = sum(a == b for a, b in zip(low_bytes, stored)) / num_permutations
+            # two different values agree in their lowest byte with a probability of 1/256
+            if (matches - 1 / 256) / (1 - 1 / 256) >= self.threshold:
+                return qid
+
+        return None
+
+    def find_or_add(self, query, qid):
+        # returns the qid of the kept query and 'exact' or 'near' if query duplicates one, otherwise adds it under qid
+        # and returns qid, None
+        normalized = normalize_query(query)
+        exact_key = hash_bytes(normalized.encode('utf-8'))
+        duplicate_qid = self.exact_table.get(exact_key)
+        if duplicate_qid is not None:
+            return duplicate_qid, 'exact'
+
+        signature = band_keys = None
+        if self.band_table is not None and normalized != '':
+            signature = minhash_signature(normalized)
+            band_keys = self.band_keys(signature)
+            duplicate_qid = self.find_near(band_keys, signature)
+            if duplicate_qid is not None:
+                return duplicate_qid, 'near'
+
+        if not self.full and not self.can_add():
+            self.full = True
+        if not self.full:
+            self.exact_table.add(exact_key, qid)
+            # queries are added in qid order, the signature of qid starts at qid * num_permutations
+            if self.band_table is not None and len(self.signatures) == qid * num_permutations:
+                self.signatures.extend(bytes(value & 0xff for value in signature) if signature is not None else bytes(num_permutations))
+                if band_keys is not None:
+                    for key in band_keys:
+                        self.band_table.add(key, qid)
+
+        return qid, None
+
+
+def new_dedup_stats(mode):
+    return {
+        'mode': mode,
+        'num_queries': 0,
+        'num_exact_duplicates': 0,
+        'num_near_duplicates': 0,
+        'num_pairs': 0,
+        'num_duplicate_pairs': 0,
+        'index_bytes': 0,
+        'index_full': False,
+        'qid_map_bytes': 0,
+        'seconds': 0,
+    }
+
+
+def dedup_queries(queries, train_rows, write_query, write_train_row, mode='exact', threshold=default_threshold, memory_size=default_memory_size):
+    # queries: (qid, query) in qid order with qids from 0, train_rows: the train.jsonl rows of these qids.
+    # write_query(qid, query) gets the kept queries with their new qid, write_train_row(row) the rows with the new qid,
+    # a pmid that the kept query cites already is dropped. returns the dedup stats
+    t0 = time.time()
+    stats = new_dedup_stats(mode)
+    index = QueryIndex(mode, threshold, memory_size)
+
+    # new qid of every qid, and a flag per new qid whether duplicates were collapsed into it
+    new_qids = array('I')
+    collapsed = bytearray()
+    for qid, query in queries:
+        if int(qid) != len(new_qids):
+            raise ValueError('qids are not contiguous from 0, expected qid ' + str(len(new_qids)) + ' but got ' + str(qid))
+        stats['num_queries'] += 1
+
+        new_qid, duplicate = index.find_or_add(query, len(collapsed))
+        new_qids.append(new_qid)
+        if duplicate is None:
+            collapsed.append(0)
+            write_query(new_qid, query)
+        else:
+            collapsed[new_qid] = 1
+            stats['num_' + duplicate + '_duplicates'] += 1
+
+    # only the pmids of collapsed qids are remembered, the other qids cannot cite a pmid twice
+    cited = QidTable()
+    for row in train_rows:
+        stats['num_pairs'] += 1
+        new_qid = new_qids[int(row['qid'])]
+        if collapsed[new_qid]:
+            key = hash_bytes(str(new_qid).encode('utf-8') + b' ' + str(row['pmid']).encode('utf-8'))
+            if cited.get(key) is not None:
+                stats['num_duplicate_pairs'] += 1
+                continue
+            cited.add(key, new_qid)
+
+        row['qid'] = str(new_qid)
+        write_train_row(row)
+
+    stats['index_bytes'] = index.nbytes()
+    stats['index_full'] = index.full
+    stats['qid_map_bytes'] = new_qids.itemsize * len(new_qids) + len(collapsed) + cited.nbytes()
+    stats['seconds'] = time.time() - t0
+
+    return stats
+
+
+def get_dedup_rate(stats):
+    # share of the queries that were collapsed into another query
+    if stats['num_queries'] == 0:
+        return 0
+    return (stats['num_exact_duplicates'] + stats['num_near_duplicates']) / stats['num_queries']
+
+
+def format_dedup_stats(stats):
+    # lines in the format of fullrun_stats
+    lines = ['\ndedup ' + stats['mode'],
+             '\nnum dedup_queries ' + str(stats['num_queries']),
+             '\nnum exact_duplicate_queries ' + str(stats['num_exact_duplicates']),
+             '\nnum near_duplicate_queries ' + str(stats['num_near_duplicates']),
+             '\nnum duplicate_pairs ' + str(stats['num_duplicate_pairs']),
+             '\ndedup_rate ' + str(get_dedup_rate(stats)),
+             '\ndedup_index_bytes ' + str(stats['index_bytes']),
+             '\ndedup_qid_map_bytes ' + str(stats['qid_map_bytes']),
+             '\ntime dedup_time ' + str(stats['seconds'])]
+    if stats['index_full']:
+        lines.append('\ndedup index full, later queries were not indexed')
+
+    return lines
+
+
+def read_json_dict(path):
+    # the items of a dict written by parse_pmc_data.write_json_dict, one item per line
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line in ('{', '}', '{}', ''):
+                continue
+            yield from json.loads('{' + line.rstrip(',') + '}').items()
+
+
+def read_jsonl(path):
+    with open(path, 'r') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        '--output_dir',
+        type=str,
+        required=True,
+        help='finished output directory of parse_pmc_data.py, its qid2info.json and train.jsonl are replaced by the '
+             'deduplicated ones and the dedup stats are appended to fullrun_stats'
+    )
+    parser.add_argument(
+        '--dedup',
+        choices=dedup_modes,
+        default='near'
+    )
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=default_threshold,
+        help='minimum estimated jaccard similarity of the word 3-grams of near-duplicate queries'
+    )
+    parser.add_argument(
+        '--memory_size',
+        type=float,
+        default=default_memory_size / 2 ** 20,
+        help='maximum size of the dedup index in MB. the qid map is not counted, it grows with the number of queries, about 5 bytes '
+             'per query and 12 bytes per slot of the cited pmids of collapsed queries'
+    )
+
+    args = parser.parse_args()
+
+    qid2info_path = os.path.join(args.output_dir, 'qid2info.json')
+    train_path = os.path.join(args.output_dir, 'train.jsonl')
+
+    with open(qid2info_path + '.tmp', 'w') as qid2info_file, open(train_path + '.tmp', 'w') as train_file:
+        # the same format as parse_pmc_data.write_json_dict, the kept queries are numbered from 0
+        def write_query(qid, query):
+            qid2info_file.write(('{\n    ' if qid == 0 else ',\n    ') + json.dumps(str(qid), ensure_ascii=False) + ': ' + json.dumps(query, ensure_ascii=False))
+
+        def write_train_row(row):
+            json.dump(row, train_file)
+            train_file.write('\n')
+
+        dedup_stats = dedup_queries(read_json_dict(qid2info_path), read_jsonl(train_path), write_query, write_train_row,
+                                    args.dedup, args.threshold, int(args.memory_size * 2 ** 20))
+        qid2info_file.write('{}' if dedup_stats['num_queries'] == 0 else '\n}')
+
+    os.replace(qid2info_path + '.tmp', qid2info_path)
+    os.replace(train_path + '.tmp', train_path)
+
+    stats_lines = format_dedup_stats(dedup_stats)
+    if os.path.exists(os.path.join(args.output_dir, 'fullrun_stats')):
+        with open(os.path.join(args.output_dir, 'fullrun_stats'), 'a') as f:
+            f.writelines(stats_lines)
+    print(''.join(stats_lines).strip())
@@ -0,0 +1,157 @@
+import hashlib
+import os
+import sqlite3
+import time
+from array import array
+
+# On-disk cache of sentence boundaries, keyed by a hash of the segmenter id and the paragraph text. Reruns of
+# parse_pmc_data.py over the same files, e.g. with another --extract_method, only segment paragraphs they have not
+# seen yet. The cache is a sqlite database, so forked workers can share it. Once the database file and its write-ahead
+# log grow beyond max_size bytes on disk the least recently used paragraphs are evicted, the freed pages are given back
+# to the filesystem with an incremental vacuum and the log is truncated.
+
+
+def get_segmenter_id(segmenter):
+    # name and version of the model and the pipes that run, a new model version gets its own cache entries
+    if hasattr(segmenter, 'segmenter_id'):
+        return segmenter.segmenter_id
+
+    meta = segmenter.meta
+    return '%s_%s-%s:%s' % (meta.get('lang', ''), meta['name'], meta['version'], ','.join(segmenter.pipe_names))
+
+
+class SegmentationCache:
+
+    def __init__(self, cache_dir, segmenter_id, max_size):
+        self.cache_path = os.path.join(cache_dir, 'segmentation_cache.sqlite')
+        self.segmenter_id = segmenter_id
+        self.max_size = max_size
+        self.connection = None
+        self.connection_pid = None
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def connect(self):
+        # sqlite connections must not be shared with forked processes, every process opens its own on first use.
+        # the parent of forked workers must not open one before the fork
+        if self.connection is not None and self.connection_pid == os.getpid():
+            return self.connection
+
+        self.connection = sqlite3.connect(self.cache_path, timeout=600)
+        self.connection_pid = os.getpid()
+        # auto_vacuum only takes effect before the first table is created or with a vacuum, caches written without it
+        # are converted once
+        if self.connection.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            self.connection.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            self.connection.execute('VACUUM')
+        with self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS sentences (key BLOB PRIMARY KEY, spans BLOB, size INTEGER, last_used REAL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS sentences_last_used ON sentences (last_used)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)')
+            self.connection.execute("INSERT OR IGNORE INTO meta VALUES ('size', 0)")
+
+        return self.connection
+
+    def key(self, paragraph_text):
+        return hashlib.blake2b((self.segmenter_id + '\0' + paragraph_text).encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+    def get_many(self, paragraph_texts):
+        # sentence spans of the cached paragraphs, None for the others
+        connection = self.connect()
+        keys = [self.key(paragraph_text) for paragraph_text in paragraph_texts]
+
+        cached = {}
+        # sqlite limits the number of query parameters
+        for batch_start in range(0, len(keys), 500):
+            batch_keys = keys[batch_start:batch_start + 500]
+            query = 'SELECT key, spans FROM sentences WHERE key IN (' + ','.join('?' * len(batch_keys)) + ')'
+            for key, spans in connection.execute(query, batch_keys):
+                cached[key] = spans
+
+        if len(cached) > 0:
+            with connection:
+                connection.executemany('UPDATE sentences SET last_used = ? WHERE key = ?', [(time.time(), key) for key in cached])
+
+        sentence_spans = []
+        for key in keys:
+            if key not in cached:
+                sentence_spans.append(None)
+                continue
+
+            offsets = array('I')
+            offsets.frombytes(cached[key])
+            sentence_spans.append(list(zip(offsets[0::2], offsets[1::2])))
+
+        return sentence_spans
+
+    def put_many(self, paragraph_texts, sentence_spans):
+        connection = self.connect()
+
+        # a paragraph can occur several times in a batch
+        rows = {}
+        for paragraph_text, spans in zip(paragraph_texts, sentence_spans):
+            offsets = array('I', [offset for span in spans for offset in span]).tobytes()
+            key = self.key(paragraph_text)
+            rows[key] = (key, offsets, len(offsets) + len(key), time.time())
+        rows = list(rows.values())
+
+        with connection:
+            # other processes wait until the size is updated
+            connection.execute('BEGIN IMMEDIATE')
+            # replaced entries are subtracted from the size first
+            keys = [row[0] for row in rows]
+            replaced_size = 0
+            for batch_start in range(0, len(keys), 500):
+                batch_keys = keys[batch_start:batch_start + 500]
+                query = 'SELECT SUM(size) FROM sentences WHERE key IN (' + ','.join('?' * len(batch_keys)) + ')'
+                replaced_size += connection.execute(query, batch_keys).fetchone()[0] or 0
+
+            connection.executemany('INSERT OR REPLACE INTO sentences VALUES (?, ?, ?, ?)', rows)
+            connection.execute("UPDATE meta SET value = value + ? WHERE name = 'size'", (sum(row[2] for row in rows) - replaced_size,))
+
+        self.evict()
+
+    def size(self):
+        # bytes of the cached keys and sentence spans, without the sqlite overhead
+        return self.connect().execute("SELECT value FROM meta WHERE name = 'size'").fetchone()[0]
+
+    def disk_size(self):
+        # bytes of the database file and its write-ahead log
+        connection = self.connect()
+        page_size = connection.execute('PRAGMA page_size').fetchone()[0]
+        page_count = connection.execute('PRAGMA page_count').fetchone()[0]
+        wal_path = self.cache_path + '-wal'
+
+        return page_count * page_size + (os.path.getsize(wal_path) if os.path.exists(wal_path) else 0)
+
+    def evict(self):
+        # drops the least recently used paragraphs until the cache is 10% below its maximum size on disk. the rows, pages
+        # and indexes take more space than the keys and spans, the payload to keep is scaled by the bytes of the used
+        # pages per payload byte. deleted rows leave pages partly empty, which only the next round takes into account
+        connection = self.connect()
+        while self.disk_size() > self.max_size:
+            with connection:
+                connection.execute('BEGIN IMMEDIATE')
+                size = connection.execute("SELECT value FROM meta WHERE name = 'size'").fetchone()[0]
+                page_size = connection.execute('PRAGMA page_size').fetchone()[0]
+                used_pages = connection.execute('PRAGMA page_count').fetchone()[0] - connection.execute('PRAGMA freelist_count').fetchone()[0]
+                max_payload_size = 0.9 * self.max_size * size / (used_pages * page_size) if size > 0 else 0
+
+                evicted_size = 0
+                evicted_keys = []
+                for key, entry_size in connection.execute('SELECT key, size FROM sentences ORDER BY last_used'):
+                    if size - evicted_size <= max_payload_size:
+                        break
+                    evicted_keys.append((key,))
+                    evicted_size += entry_size
+
+                connection.executemany('DELETE FROM sentences WHERE key = ?', evicted_keys)
+                connection.execute("UPDATE meta SET value = value - ? WHERE name = 'size'", (evicted_size,))
+
+            # execute steps incremental_vacuum once, which frees a single page, executescript runs it to the end
+            connection.executescript('PRAGMA incremental_vacuum')
+            connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            if len(evicted_keys) == 0:
+                break
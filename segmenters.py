@@ -0,0 +1,103 @@
+import re
+from functools import partial
+
+# Sentence segmenters for parse_pmc_data.py. A segmenter is called like a spaCy pipeline: segmenter(text) and
+# segmenter.pipe(texts, as_tuples=..., batch_size=..., n_process=...) return docs whose sents have start_char and
+# end_char offsets into the text. New backends are added to segmenter_loaders.
+
+# pipeline components that are needed to split sentences, everything else is disabled
+segmenter_components = ('transformer', 'tok2vec', 'parser', 'senter')
+
+
+def load_spacy_segmenter(model_name, device='gpu'):
+    import spacy
+
+    if device == 'gpu':
+        spacy.require_gpu()
+
+    segmenter = spacy.load(model_name)
+    segmenter.select_pipes(enable=[pipe for pipe in segmenter.pipe_names if pipe in segmenter_components])
+
+    return segmenter
+
+
+# words before a period that do not end a sentence, compared in lower case
+abbreviations = {
+    'al', 'fig', 'figs', 'e.g', 'i.e', 'cf', 'vs', 'viz', 'approx', 'ca', 'eq', 'eqs', 'ref', 'refs', 'no', 'nos',
+    'vol', 'suppl', 'tab', 'dr', 'prof', 'sp', 'spp', 'subsp', 'var', 'st', 'resp', 'incl', 'min', 'max', 'mol', 'wt',
+    'conc', 'temp', 'mr', 'mrs', 'ms', 'jr', 'sr', 'inc', 'ltd', 'co', 'dept', 'univ', 'chem', 'biol',
+}
+
+# end of sentence punctuation with closing quotes, brackets, citations or tags behind it, then white-space and
+# something that can start a sentence
+sentence_end = re.compile(r'[.!?](?:["\')\]]|<xref[^<>]*>[^<]*</xref>|</[\w-]+>)*\s+(?=[A-Z0-9"\'(\[<])')
+last_word = re.compile(r'[\w.]*[.!?]$')
+acronym = re.compile(r'(?:[a-z]\.)+[a-z]')
+
+
+class RuleBasedSentence:
+
+    def __init__(self, start_char, end_char):
+        self.start_char = start_char
+        self.end_char = end_char
+
+
+class RuleBasedDoc:
+
+    def __init__(self, text, sents):
+        self.text = text
+        self.sents = sents
+
+
+class RuleBasedSegmenter:
+    # splits at sentence end punctuation, except after biomedical abbreviations ("et al.", "Fig.", "i.e.") and
+    # initials ("J. Smith", "E. coli"). works on plain text and on paragraph markup
+    # change the version when the rules change, it is part of the segmentation cache keys
+    segmenter_id = 'rules-1'
+
+    def __call__(self, text):
+        return RuleBasedDoc(text, self.split(text))
+
+    def pipe(self, texts, as_tuples=False, batch_size=None, n_process=1):
+        for item in texts:
+            if as_tuples:
+                text, context = item
+                yield self(text), context
+            else:
+                yield self(item)
+
+    def split(self, text):
+        sents = []
+        start = 0
+        for match in sentence_end.finditer(text):
+            word = last_word.search(text, max(start, match.start() - 20), match.start() + 1)
+            if word is not None and is_abbreviation(word.group()):
+                continue
+
+            end = match.start() + len(match.group().rstrip())
+            sents.append(RuleBasedSentence(start, end))
+            start = match.end()
+
+        end = len(text.rstrip())
+        if end > start:
+            sents.append(RuleBasedSentence(start, end))
+
+        return sents
+
+
+def is_abbreviation(word):
+    word = word.lower().strip('.!?')
+    # single letters are initials, e.g. "J. Smith" or "E. coli", letters with periods are acronyms like "U.S."
+    return word in abbreviations or (len(word) == 1 and word.isalpha()) or acronym.fullmatch(word) is not None
+
+
+segmenter_loaders = {
+    'scibert': partial(load_spacy_segmenter, 'en_core_sci_scibert'),
+    'sci_sm': partial(load_spacy_segmenter, 'en_core_sci_sm'),
+    'sci_md': partial(load_spacy_segmenter, 'en_core_sci_md'),
+    'rules': lambda device='gpu': RuleBasedSegmenter(),
+}
+
+
+def load_segmenter(name, device='gpu'):
+    return segmenter_loaders[name](device=device)
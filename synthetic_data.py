@@ -0,0 +1,300 @@
+import argparse
+import gzip
+import hashlib
+import os
+import random
+from html import escape
+
+# Synthetic but structurally realistic inputs for benchmarks, so they run offline without the PMC and PubMed dumps.
+# PMC articles are JATS xml files with a ref-list whose references cite a pmid in element-citation, mixed-citation or
+# citation-alternatives, some only have a doi or no id at all. Their paragraphs cite these references with single
+# citations, enumerations, ranges, "and"/"e.g." forms and author-year labels, mixed with fig and table xrefs.
+# MEDLINE files are gzipped PubmedArticleSet xml files with .md5 files, as in the PubMed baseline, update files also
+# delete citations. Everything is generated from a seed, the same arguments give the same files.
+
+words = (
+    'the', 'of', 'and', 'in', 'with', 'was', 'were', 'patients', 'expression', 'protein', 'cells', 'increased', 'reduced',
+    'disease', 'chronic', 'acute', 'treatment', 'response', 'models', 'mice', 'results', 'similar', 'showed', 'levels',
+    'receptor', 'signaling', 'pathway', 'clinical', 'cohort', 'risk', 'associated', 'significantly', 'higher', 'lower',
+    'infection', 'tumor', 'gene', 'mutations', 'inhibition', 'activity', 'previous', 'studies', 'reported', 'observed',
+)
+surnames = ('Smith', 'Wang', 'Garcia', 'Müller', 'Kim', 'Nguyen', 'Rossi', 'Tanaka', 'Johnson', 'Li')
+
+default_config = {
+    'min_refs': 5,
+    'max_refs': 80,
+    'min_paragraphs': 3,
+    'max_paragraphs': 20,
+    'min_sentences': 2,
+    'max_sentences': 10,
+    # share of sentences with a citation and share of citations that are enumerations or ranges
+    'citation_rate': 0.5,
+    'enumeration_rate': 0.25,
+    'max_enumeration': 6,
+    'range_rate': 0.15,
+    # share of sentences that also refer to a figure or table
+    'fig_table_rate': 0.15,
+    # share of references per variant, the rest are element-citation
+    'mixed_citation_rate': 0.3,
+    'citation_alternatives_rate': 0.1,
+    'doi_only_rate': 0.1,
+    'no_id_rate': 0.05,
+    # pmids are drawn from 1..num_pmids, the MEDLINE files hold the pmids up to corpus_share * num_pmids
+    'num_pmids': 100000,
+    'corpus_share': 0.9,
+}
+
+
+def make_words(rng, min_words, max_words):
+    return ' '.join(rng.choice(words) for _ in range(rng.randint(min_words, max_words)))
+
+
+def make_xref(ref_type, rid, label):
+    return '<xref ref-type="%s" rid="%s">%s</xref>' % (ref_type, rid, label)
+
+
+def make_citation(rng, ref_ids, config):
+    # the markup of one citation of the references, as it appears in the paragraph
+    ref_idx = rng.randrange(len(ref_ids))
+    style = rng.random()
+
+    if style < config['range_rate'] and ref_idx + 2 < len(ref_ids):
+        last_idx = min(len(ref_ids) - 1, ref_idx + rng.randint(2, 5))
+        return '[' + make_xref('bibr', ref_ids[ref_idx], ref_idx + 1) + '&#x02013;' + make_xref('bibr', ref_ids[last_idx], last_idx + 1) + ']'
+
+    if style < config['range_rate'] + config['enumeration_rate']:
+        cited = sorted(rng.sample(range(len(ref_ids)), min(len(ref_ids), rng.randint(2, config['max_enumeration']))))
+        separator = rng.choice((', ', ',', '; '))
+        xrefs = [make_xref('bibr', ref_ids[idx], idx + 1) for idx in cited]
+        if rng.random() < 0.2:
+            return '(' + separator.join(xrefs[:-1]) + ', and ' + xrefs[-1] + ')'
+        return '[' + separator.join(xrefs) + ']'
+
+    xref = make_xref('bibr', ref_ids[ref_idx], ref_idx + 1)
+    form = rng.random()
+    if form < 0.1:
+        return '(e.g., ' + xref + ')'
+    if form < 0.2:
+        return '(see ' + xref + ')'
+    if form < 0.3:
+        return '(' + make_xref('bibr', ref_ids[ref_idx], rng.choice(surnames) + ' et al., ' + str(rng.randint(1990, 2023))) + ')'
+    if form < 0.5:
+        return '(' + xref + ')'
+    return '[' + xref + ']'
+
+
+def make_sentence(rng, ref_ids, config):
+    sentence = make_words(rng, 6, 25).capitalize()
+
+    if rng.random() < config['fig_table_rate']:
+        ref_type, prefix, label = rng.choice((('fig', 'F', 'Figure'), ('table', 'T', 'Table')))
+        number = rng.randint(1, 6)
+        sentence += ' (' + make_xref(ref_type, prefix + str(number), label + ' ' + str(number) + ('A' if rng.random() < 0.3 else '')) + ')'
+
+    if len(ref_ids) > 0 and rng.random() < config['citation_rate']:
+        # the citation either ends the sentence or follows its first half
+        if rng.random() < 0.3:
+            sentence += ' ' + make_citation(rng, ref_ids, config) + ' and ' + make_words(rng, 4, 12)
+        sentence += ' ' + make_citation(rng, ref_ids, config)
+
+    return sentence + '.'
+
+
+def make_reference(rng, ref_id, pmid, config):
+    authors = ''.join('<name><surname>%s</surname><given-names>%s</given-names></name>' % (rng.choice(surnames), rng.choice('ABCDEFGHJK'))
+                      for _ in range(rng.randint(1, 4)))
+    title = escape(make_words(rng, 5, 14).capitalize())
+    details = '<person-group person-group-type="author">%s</person-group><article-title>%s</article-title><source>J Synth Biol</source>' \
+              '<year>%d</year><volume>%d</volume><fpage>%d</fpage>' % (authors, title, rng.randint(1980, 2023), rng.randint(1, 300), rng.randint(1, 2000))
+    doi = '10.%d/synth.%d' % (rng.randint(1000, 9999), pmid)
+
+    variant = rng.random()
+    if variant < config['no_id_rate']:
+        pub_ids = ''
+    elif variant < config['no_id_rate'] + config['doi_only_rate']:
+        pub_ids = '<pub-id pub-id-type="doi">%s</pub-id>' % doi
+    else:
+        pub_ids = '<pub-id pub-id-type="pmid">%d</pub-id>' % pmid
+        if rng.random() < 0.5:
+            pub_ids += '<pub-id pub-id-type="doi">%s</pub-id>' % doi
+
+    variant = rng.random()
+    if variant < config['citation_alternatives_rate']:
+        # the element-citation carries the ids, the mixed-citation is the formatted text
+        citation = '<citation-alternatives><element-citation publication-type="journal">%s%s</element-citation>' \
+                   '<mixed-citation publication-type="journal">%s</mixed-citation></citation-alternatives>' % (details, pub_ids, details)
+    elif variant < config['citation_alternatives_rate'] + config['mixed_citation_rate']:
+        citation = '<mixed-citation publication-type="journal">%s. %s</mixed-citation>' % (details, pub_ids)
+    else:
+        citation = '<element-citation publication-type="journal">%s%s</element-citation>' % (details, pub_ids)
+
+    return '<ref id="%s"><label>%s</label>%s</ref>' % (ref_id, ref_id[1:], citation)
+
+
+def generate_article(rng, pmc_id, config=default_config):
+    num_refs = rng.randint(config['min_refs'], config['max_refs'])
+    ref_ids = ['B' + str(ref_idx + 1) for ref_idx in range(num_refs)]
+
+    paragraphs = []
+    for _ in range(rng.randint(config['min_paragraphs'], config['max_paragraphs'])):
+        sentences = [make_sentence(rng, ref_ids, config) for _ in range(rng.randint(config['min_sentences'], config['max_sentences']))]
+        paragraphs.append('<p>' + ' '.join(sentences) + '</p>')
+    # a paragraph in a figure caption is read like the body paragraphs
+    paragraphs.append('<fig id="F1"><label>Figure 1</label><caption><p>' + make_sentence(rng, ref_ids, config) + '</p></caption></fig>')
+
+    references = [make_reference(rng, ref_id, rng.randint(1, config['num_pmids']), config) for ref_id in ref_ids]
+
+    return '<?xml version="1.0" ?>\n' \
+           '<!DOCTYPE article PUBLIC "-//NLM//DTD JATS (Z39.96) Journal Archiving and Interchange DTD v1.2 20190208//EN" "JATS-archivearticle1.dtd">\n' \
+           '<article xmlns:xlink="http://www.w3.org/1999/xlink" xmlns:mml="http://www.w3.org/1998/Math/MathML" article-type="research-article">' \
+           '<front><journal-meta><journal-title-group><journal-title>J Synth Biol</journal-title></journal-title-group></journal-meta>' \
+           '<article-meta><article-id pub-id-type="pmc">%s</article-id><article-id pub-id-type="doi">10.9999/synth.pmc.%s</article-id>' \
+           '<title-group><article-title>%s</article-title></title-group></article-meta></front>' \
+           '<body><sec><title>Introduction</title>%s</sec></body>' \
+           '<back><ref-list><title>References</title>%s</ref-list></back></article>\n' \
+           % (pmc_id, pmc_id, escape(make_words(rng, 5, 12).capitalize()), ''.join(paragraphs), ''.join(references))
+
+
+def write_pmc_articles(output_dir, num_articles, seed=42, config=default_config):
+    # paths of the written articles, PMC<id>.xml in output_dir
+    rng = random.Random(seed)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    paths = []
+    for article_idx in range(num_articles):
+        pmc_id = str(1000000 + article_idx)
+        path = os.path.join(output_dir, 'PMC' + pmc_id + '.xml')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(generate_article(rng, pmc_id, config))
+        paths.append(path)
+
+    return paths
+
+
+def make_medline_article(rng, pmid):
+    title = escape(make_words(rng, 5, 14).capitalize()) + '.'
+    variant = rng.random()
+    if variant < 0.1:
+        abstract = ''
+    elif variant < 0.4:
+        # structured abstract
+        abstract = '<Abstract>' + ''.join('<AbstractText Label="%s" NlmCategory="%s">%s.</AbstractText>' % (label, label, escape(make_words(rng, 15, 60).capitalize()))
+                                          for label in ('BACKGROUND', 'METHODS', 'RESULTS', 'CONCLUSIONS')) + '</Abstract>'
+    else:
+        abstract = '<Abstract><AbstractText>%s.</AbstractText></Abstract>' % escape(make_words(rng, 40, 250).capitalize())
+
+    article_ids = '<ArticleId IdType="pubmed">%d</ArticleId>' % pmid
+    if rng.random() < 0.8:
+        article_ids += '<ArticleId IdType="doi">10.%d/synth.%d</ArticleId>' % (rng.randint(1000, 9999), pmid)
+
+    return '<PubmedArticle><MedlineCitation Status="MEDLINE" Owner="NLM"><PMID Version="1">%d</PMID>' \
+           '<DateCompleted><Year>2020</Year><Month>01</Month><Day>01</Day></DateCompleted>' \
+           '<Article PubModel="Print"><Journal><ISSN IssnType="Print">0000-0000</ISSN><JournalIssue CitedMedium="Print"><Volume>%d</Volume>' \
+           '<PubDate><Year>%d</Year></PubDate></JournalIssue><Title>Journal of Synthetic Biology</Title></Journal>' \
+           '<ArticleTitle>%s</ArticleTitle>%s<AuthorList CompleteYN="Y"><Author ValidYN="Y"><LastName>%s</LastName><ForeName>A</ForeName>' \
+           '<Initials>A</Initials></Author></AuthorList><Language>eng</Language></Article><MedlineJournalInfo><Country>United States</Country>' \
+           '<MedlineTA>J Synth Biol</MedlineTA></MedlineJournalInfo></MedlineCitation><PubmedData><PublicationStatus>ppublish</PublicationStatus>' \
+           '<ArticleIdList>%s</ArticleIdList></PubmedData></PubmedArticle>\n' \
+           % (pmid, rng.randint(1, 300), rng.randint(1980, 2023), title, abstract, rng.choice(surnames), article_ids)
+
+
+def write_medline_file(path, pmids, rng, deleted_pmids=()):
+    # gzipped PubmedArticleSet with a .md5 file next to it
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE PubmedArticleSet PUBLIC "-//NLM//DTD PubMedArticle, 1st January 2024//EN" '
+                '"https://dtd.nlm.nih.gov/ncbi/pubmed/out/pubmed_240101.dtd">\n<PubmedArticleSet>\n')
+        for pmid in pmids:
+            f.write(make_medline_article(rng, pmid))
+        if len(deleted_pmids) > 0:
+            f.write('<DeleteCitation>' + ''.join('<PMID Version="1">%d</PMID>' % pmid for pmid in deleted_pmids) + '</DeleteCitation>\n')
+        f.write('</PubmedArticleSet>\n')
+
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        md5.update(f.read())
+    with open(path + '.md5', 'w') as f:
+        f.write('MD5(%s)= %s\n' % (os.path.basename(path), md5.hexdigest()))
+
+
+def write_medline_files(output_dir, num_files, seed=42, config=default_config, update=False):
+    # baseline files split the corpus pmids into num_files files, update files revise and delete a few of them
+    rng = random.Random(seed)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    corpus_pmids = list(range(1, int(config['num_pmids'] * config['corpus_share']) + 1))
+    file_size = -(-len(corpus_pmids) // num_files)
+
+    paths = []
+    for file_idx in range(num_files):
+        if update:
+            path = os.path.join(output_dir, 'pubmed24n%04d.xml.gz' % (2000 + file_idx))
+            pmids = rng.sample(range(1, config['num_pmids'] + 1), min(file_size // 10 + 1, config['num_pmids']))
+            write_medline_file(path, pmids, rng, deleted_pmids=rng.sample(corpus_pmids, min(10, len(corpus_pmids))))
+        else:
+            path = os.path.join(output_dir, 'pubmed24n%04d.xml.gz' % (file_idx + 1))
+            write_medline_file(path, corpus_pmids[file_idx * file_size:(file_idx + 1) * file_size], rng)
+        paths.append(path)
+
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        '--pmc_dir',
+        type=str,
+        help='write --num_articles PMC articles here'
+    )
+    parser.add_argument(
+        '--num_articles',
+        type=int,
+        default=1000
+    )
+    parser.add_argument(
+        '--medline_dir',
+        type=str,
+        help='write --num_medline_files MEDLINE baseline files here'
+    )
+    parser.add_argument(
+        '--update_dir',
+        type=str,
+        help='write --num_medline_files MEDLINE update files here'
+    )
+    parser.add_argument(
+        '--num_medline_files',
+        type=int,
+        default=4
+    )
+    parser.add_argument(
+        '--file_list_path',
+        type=str,
+        help='also write the paths of the PMC articles, one per line, e.g. as random_file_samples_50k for parse_pmc_data.py'
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=42
+    )
+    for name, value in default_config.items():
+        parser.add_argument('--' + name, type=type(value), default=value)
+
+    args = parser.parse_args()
+    config = {name: getattr(args, name) for name in default_config}
+
+    if args.pmc_dir is not None:
+        paths = write_pmc_articles(args.pmc_dir, args.num_articles, seed=args.seed, config=config)
+        print('num articles', len(paths))
+        if args.file_list_path is not None:
+            with open(args.file_list_path, 'w') as f:
+                f.write('\n'.join(paths))
+
+    if args.medline_dir is not None:
+        paths = write_medline_files(args.medline_dir, args.num_medline_files, seed=args.seed, config=config)
+        print('num baseline files', len(paths))
+
+    if args.update_dir is not None:
+        paths = write_medline_files(args.update_dir, args.num_medline_files, seed=args.seed + 1, config=config, update=True)
+        print('num update files', len(paths))
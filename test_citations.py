@@ -0,0 +1,86 @@
+import json
+import os
+import pytest
+from lxml import etree
+from citations import cleanse_sentence, split_sentence_at_citations, split_citations, parse_xref_attrib
+
+# The single pass citation tokenizer and the xref tag parser must give the same results as split_sentence_at_citations
+# and etree.fromstring. test_data/citation_sentences.jsonl holds sentences with the citation markup variants of PMC
+# articles and sentences of synthetic_data.py articles, benchmark_citations.py --sentences_path reads it as well.
+
+sentences_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_data', 'citation_sentences.jsonl')
+
+xref_tags = [
+    '<xref ref-type="bibr" rid="B1">1</xref>',
+    '<xref rid="B2" ref-type="bibr">Smith et al., 2001</xref>',
+    "<xref ref-type='bibr' rid='B3'>3</xref>",
+    '<xref  ref-type = "bibr"   rid="B4" >4</xref>',
+    '<xref ref-type="bibr">5</xref>',
+    '<xref ref-type="bibr" rid="B6"/>',
+    '<xref ref-type="bibr" rid="B7&amp;B8">7</xref>',
+    '<xref ref-type="bibr" rid="B9">9 &#x02013; 10</xref>',
+    '<xref ref-type="fig" rid="F1">Figure 1</xref>',
+    '<xref ref-type="bibr" rid="B11"><sup>11</sup></xref>',
+]
+# tags lxml rejects, parse_xref_attrib has to raise the same error
+invalid_xref_tags = [
+    '<xref ref-type="bibr" rid="B1" rid="B2">1</xref>',
+    '<xref ref-type="bibr" rid="B3" xlink:href="#B3">3</xref>',
+    '<xref ref-type="bibr" rid="B4">4',
+    '<xref ref-type="bibr" rid="B5">5 & 6</xref>',
+    '<xref ref-type="bibr" rid="B7">7</xref> and text',
+    '<xref ref-type="bibr" rid="B8>8</xref>',
+    '<xref ref-type="bibr" rid="B9">9]]></xref>',
+    '<xref ref-type="bibr" rid="B10">10</xref',
+    '',
+]
+
+
+def read_sentences():
+    with open(sentences_path, 'r') as f:
+        return [cleanse_sentence(json.loads(line)) for line in f]
+
+
+def citations_of(split_text):
+    # the single citations handle_split_text parses, an enumeration part holds several
+    citations = []
+    for part in split_text:
+        if '</xref>' in part:
+            citations.extend(part.split(',') if '</xref>,<xref' in part else [part])
+
+    return citations
+
+
+def parse_result(parse, citation):
+    # the attributes or the exception, exceptions are compared by their repr
+    try:
+        return dict(parse(citation))
+    except Exception as e:
+        return repr(e)
+
+
+@pytest.mark.parametrize('sent', read_sentences())
+def test_split_citations(sent):
+    assert split_citations(sent) == [part for part in split_sentence_at_citations(sent) if part]
+
+
+@pytest.mark.parametrize('sent', read_sentences())
+def test_sentence_xref_attrib(sent):
+    for citation in citations_of(split_citations(sent)):
+        assert parse_result(parse_xref_attrib, citation) == parse_result(lambda c: etree.fromstring(c).attrib, citation)
+
+
+@pytest.mark.parametrize('citation', xref_tags)
+def test_parse_xref_attrib(citation):
+    assert parse_xref_attrib(citation) == dict(etree.fromstring(citation).attrib)
+    # the second call is answered from the cache
+    assert parse_xref_attrib(citation) == dict(etree.fromstring(citation).attrib)
+
+
+@pytest.mark.parametrize('citation', invalid_xref_tags)
+def test_parse_xref_attrib_errors(citation):
+    with pytest.raises(etree.XMLSyntaxError) as expected:
+        etree.fromstring(citation)
+    with pytest.raises(etree.XMLSyntaxError) as raised:
+        parse_xref_attrib(citation)
+    assert repr(raised.value) == repr(expected.value)
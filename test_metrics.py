@@ -0,0 +1,51 @@
+import json
+import os
+import pytest
+import parse_pmc_data
+from synthetic_data import default_config, write_pmc_articles
+
+# The metrics.json of every extract method counts the pairs of that method, the methods of a run share the parsing and
+# segmentation but write their own train.jsonl. Runs serial and with two workers on synthetic_data.py articles with
+# the rule-based segmenter.
+
+methods = ['iterative', 'total']
+
+
+@pytest.fixture(scope='module')
+def articles(tmp_path_factory):
+    config = dict(default_config, num_pmids=2000)
+    file_paths = write_pmc_articles(str(tmp_path_factory.mktemp('pmc')), 30, seed=3, config=config)
+    pmid2info = {str(pmid): None for pmid in range(1, int(config['num_pmids'] * config['corpus_share']) + 1)}
+
+    return file_paths, pmid2info
+
+
+def count_lines(path):
+    with open(path, 'r') as f:
+        return sum(1 for _ in f)
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_num_pairs_per_method(articles, tmp_path, monkeypatch, workers):
+    file_paths, pmid2info = articles
+    monkeypatch.setattr(parse_pmc_data, 'segmenter_name', 'rules')
+    monkeypatch.setattr(parse_pmc_data, 'device', 'cpu')
+    monkeypatch.setattr(parse_pmc_data, 'file_batch_size', 4)
+    monkeypatch.setattr(parse_pmc_data, 'pmid2info', pmid2info)
+
+    output_dir = str(tmp_path)
+    if workers == 1:
+        parse_pmc_data.run_extraction(file_paths, output_dir, methods)
+    else:
+        parse_pmc_data.run_parallel_extraction(file_paths, output_dir, methods, workers)
+
+    num_pairs_per_method = {}
+    for method in methods:
+        with open(os.path.join(output_dir, method, 'metrics.json'), 'r') as f:
+            metrics = json.load(f)
+        num_pairs_per_method[method] = metrics['num_pairs']
+        assert metrics['num_files'] == len(file_paths)
+        assert metrics['num_pairs'] == count_lines(os.path.join(output_dir, method, 'train.jsonl'))
+
+    # the fixture has to tell the methods apart
+    assert num_pairs_per_method['iterative'] != num_pairs_per_method['total']
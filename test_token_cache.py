@@ -0,0 +1,54 @@
+import pytest
+import token_cache
+from token_cache import truncate_pair, encode_entries
+
+# The cached documents have to be the model inputs the tokenizer gives for title and abstract with longest_first
+# truncation. Checked against the tokenizers backend with a word level vocabulary, so no model has to be downloaded.
+
+tokenizers = pytest.importorskip('tokenizers')
+
+num_words = 24
+max_lengths = range(3, 30)
+
+
+def make_backend():
+    vocab = {'[UNK]': 0, '[CLS]': 1, '[SEP]': 2}
+    vocab.update({'w%d' % i: i + 3 for i in range(num_words)})
+    backend = tokenizers.Tokenizer(tokenizers.models.WordLevel(vocab, unk_token='[UNK]'))
+    backend.pre_tokenizer = tokenizers.pre_tokenizers.Whitespace()
+    backend.post_processor = tokenizers.processors.TemplateProcessing(single='[CLS] $A [SEP]', pair='[CLS] $A [SEP] $B [SEP]',
+                                                                      special_tokens=[('[CLS]', 1), ('[SEP]', 2)])
+    return backend
+
+
+def make_text(num_tokens):
+    return ' '.join('w%d' % i for i in range(num_tokens))
+
+
+@pytest.mark.parametrize('max_length', max_lengths)
+def test_truncate_pair(max_length):
+    backend = make_backend()
+    backend.enable_truncation(max_length, strategy='longest_first')
+    lengths = [(num_first, num_second) for num_first in range(num_words) for num_second in range(num_words)]
+    encodings = backend.encode_batch([(make_text(num_first), make_text(num_second)) for num_first, num_second in lengths])
+    for (num_first, num_second), encoding in zip(lengths, encodings):
+        expected = (encoding.sequence_ids.count(0), encoding.sequence_ids.count(1))
+        assert truncate_pair(num_first, num_second, max_length - 3) == expected, (num_first, num_second)
+
+
+@pytest.mark.parametrize('max_length', [8, 9, 16, 17])
+def test_encode_entries(monkeypatch, max_length):
+    transformers = pytest.importorskip('transformers')
+    tokenizer = transformers.PreTrainedTokenizerFast(tokenizer_object=make_backend(), unk_token='[UNK]', cls_token='[CLS]', sep_token='[SEP]')
+    monkeypatch.setattr(token_cache, 'cache_tokenizer', tokenizer, raising=False)
+    monkeypatch.setattr(token_cache, 'cache_max_length', max_length, raising=False)
+
+    # the tokenizer takes an empty text for a missing pair, the entries of the cache always have title and abstract
+    texts_per_entry = [(make_text(num_title), make_text(num_abstract)) for num_title in range(1, 20, 3) for num_abstract in range(1, 20, 2)]
+    token_ids, entry_lengths, _ = encode_entries(texts_per_entry)
+
+    start = 0
+    for (title, abstract), entry_length in zip(texts_per_entry, entry_lengths):
+        expected = tokenizer(title, abstract, truncation='longest_first', max_length=max_length)['input_ids']
+        assert list(token_ids[start:start + entry_length]) == expected, (title, abstract)
+        start += entry_length
@@ -0,0 +1,304 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import numpy as np
+from array import array
+from itertools import islice
+from tqdm import tqdm
+from corpus_store import load_pmid2info
+
+# A token cache is a directory with
+#   tokens.bin     token ids of all entries one after the other, uint16 if the vocabulary fits and uint32 otherwise
+#   offsets.bin    uint64 per entry and one more, start of every entry in tokens.bin
+#   keys.bin       uint64 qid or pmid of every entry, in the order of qid2info.json or pmid2info
+#   key_order.bin  int64 positions that sort keys.bin, used to look up entries by qid or pmid
+#   lengths.bin    uint32 per entry and text, number of tokens of the query or of title and abstract without special
+#                  tokens and before truncation
+#   meta.json      tokenizer, max_length, number of entries and texts per entry, number of truncated entries, the
+#                  token dtype and the byte order
+# Queries are stored as [CLS] query [SEP] and documents as [CLS] title [SEP] abstract [SEP], truncated to max_length
+# the same way the tokenizer truncates them, so training reads model inputs without tokenizing again.
+
+default_tokenizer_name = 'microsoft/BiomedNLP-PubMedBERT-base-uncased-abstract-fulltext'
+
+
+def batched(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+
+    if len(batch) > 0:
+        yield batch
+
+
+def truncate_pair(num_first, num_second, budget):
+    # number of tokens kept of both texts with the longest_first strategy of the tokenizers backend, which keeps at most
+    # half of the budget of the shorter text and the rest of the longer one. the first text counts as the shorter one
+    # if both have the same length, so an odd token left over goes to the longer text or to the second one on a tie.
+    # the slow python tokenizers give it to the first text instead
+    if num_first + num_second <= budget:
+        return num_first, num_second
+
+    if num_first <= num_second:
+        num_first = min(num_first, budget // 2)
+        return num_first, budget - num_first
+
+    num_second = min(num_second, budget // 2)
+    return budget - num_second, num_second
+
+
+def encode_entries(texts_per_entry):
+    # token ids of a batch of entries, their stored lengths and the lengths of their texts before truncation
+    backend = cache_tokenizer.backend_tokenizer
+    num_texts = len(texts_per_entry[0])
+    encodings = backend.encode_batch([text for texts in texts_per_entry for text in texts], add_special_tokens=False)
+
+    token_ids = array('I')
+    entry_lengths = array('I')
+    text_lengths = array('I')
+    for entry_idx in range(len(texts_per_entry)):
+        ids = [encodings[entry_idx * num_texts + text_idx].ids for text_idx in range(num_texts)]
+        text_lengths.extend(len(text_ids) for text_ids in ids)
+
+        if num_texts == 1:
+            ids = [ids[0][:max(cache_max_length - 2, 0)]]
+        else:
+            num_first, num_second = truncate_pair(len(ids[0]), len(ids[1]), max(cache_max_length - 3, 0))
+            ids = [ids[0][:num_first], ids[1][:num_second]]
+
+        num_tokens = len(token_ids)
+        token_ids.append(cache_tokenizer.cls_token_id)
+        for text_ids in ids:
+            token_ids.extend(text_ids)
+            token_ids.append(cache_tokenizer.sep_token_id)
+        entry_lengths.append(len(token_ids) - num_tokens)
+
+    return token_ids, entry_lengths, text_lengths
+
+
+def build_token_cache(entries, num_entries, cache_dir, tokenizer, max_length, workers=1, batch_size=1024):
+    # entries: (qid or pmid, texts) in the order they are stored. with workers > 1 the batches are encoded in forked
+    # processes, only workers * 4 batches are read ahead of the results
+    global cache_tokenizer, cache_max_length
+
+    cache_tokenizer = tokenizer
+    cache_max_length = max_length
+    backend = tokenizer.backend_tokenizer
+    backend.no_truncation()
+    backend.no_padding()
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    if os.path.exists(os.path.join(cache_dir, 'meta.json')):
+        os.remove(os.path.join(cache_dir, 'meta.json'))
+
+    token_typecode = 'H' if len(tokenizer) <= 2 ** 16 else 'I'
+    keys = array('Q')
+    offsets = array('Q', [0])
+    lengths = array('I')
+    num_texts = None
+    num_truncated = 0
+
+    def add_batch(batch_keys, token_ids, entry_lengths, text_lengths):
+        nonlocal num_truncated
+
+        array(token_typecode, token_ids).tofile(tokens_file)
+        keys.extend(batch_keys)
+        for entry_length in entry_lengths:
+            offsets.append(offsets[-1] + entry_length)
+        lengths.extend(text_lengths)
+        # an entry is truncated if it stores fewer tokens than its texts and special tokens have
+        for entry_idx, entry_length in enumerate(entry_lengths):
+            if entry_length < sum(text_lengths[entry_idx * num_texts:(entry_idx + 1) * num_texts]) + num_texts + 1:
+                num_truncated += 1
+        progress.update(len(batch_keys))
+
+    progress = tqdm(total=num_entries, position=0, leave=True)
+    with open(os.path.join(cache_dir, 'tokens.bin.tmp'), 'wb') as tokens_file:
+        batches = batched(entries, batch_size)
+        if workers == 1:
+            for batch in batches:
+                num_texts = len(batch[0][1])
+                add_batch([int(key) for key, _ in batch], *encode_entries([texts for _, texts in batch]))
+        else:
+            # every worker encodes on one core, the rust thread pool does not work in forked processes
+            os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+            with multiprocessing.get_context('fork').Pool(workers) as pool:
+                while True:
+                    window = list(islice(batches, workers * 4))
+                    if len(window) == 0:
+                        break
+
+                    num_texts = len(window[0][0][1])
+                    encoded = pool.imap(encode_entries, [[texts for _, texts in batch] for batch in window])
+                    for batch, batch_encoded in zip(window, encoded):
+                        add_batch([int(key) for key, _ in batch], *batch_encoded)
+    progress.close()
+    os.replace(os.path.join(cache_dir, 'tokens.bin.tmp'), os.path.join(cache_dir, 'tokens.bin'))
+
+    key_order = array('q', np.argsort(np.frombuffer(keys, dtype=np.uint64), kind='stable').astype(np.int64).tobytes())
+    for name, values in [('keys.bin', keys), ('key_order.bin', key_order), ('offsets.bin', offsets), ('lengths.bin', lengths)]:
+        with open(os.path.join(cache_dir, name + '.tmp'), 'wb') as f:
+            values.tofile(f)
+        os.replace(os.path.join(cache_dir, name + '.tmp'), os.path.join(cache_dir, name))
+
+    # meta.json is written last, a cache without it is incomplete
+    meta = {'tokenizer': tokenizer.name_or_path, 'max_length': max_length, 'num_entries': len(keys), 'num_texts': num_texts or 1,
+            'num_truncated': num_truncated, 'token_dtype': 'uint16' if token_typecode == 'H' else 'uint32', 'byteorder': sys.byteorder}
+    with open(os.path.join(cache_dir, 'meta.json.tmp'), 'w') as f:
+        json.dump(meta, f, indent=4)
+    os.replace(os.path.join(cache_dir, 'meta.json.tmp'), os.path.join(cache_dir, 'meta.json'))
+
+    return meta
+
+
+def map_array(path, dtype):
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+class TokenCache:
+    # read-only view of a token cache: cache[qid or pmid] -> token ids, the arrays are memory-mapped
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+        with open(os.path.join(cache_dir, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        if self.meta['byteorder'] != sys.byteorder:
+            raise ValueError('token cache was written with byte order ' + self.meta['byteorder'])
+
+        self.tokens = map_array(os.path.join(cache_dir, 'tokens.bin'), self.meta['token_dtype'])
+        self.offsets = map_array(os.path.join(cache_dir, 'offsets.bin'), np.uint64)
+        self.keys = map_array(os.path.join(cache_dir, 'keys.bin'), np.uint64)
+        self.key_order = map_array(os.path.join(cache_dir, 'key_order.bin'), np.intp)
+        self.text_lengths = map_array(os.path.join(cache_dir, 'lengths.bin'), np.uint32).reshape(-1, self.meta['num_texts'])
+
+    def __len__(self):
+        return self.meta['num_entries']
+
+    def entry_idx(self, key):
+        position = np.searchsorted(self.keys, int(key), sorter=self.key_order)
+        if position == len(self.keys) or self.keys[self.key_order[position]] != int(key):
+            return -1
+
+        return int(self.key_order[position])
+
+    def __contains__(self, key):
+        return self.entry_idx(key) >= 0
+
+    def __getitem__(self, key):
+        entry_idx = self.entry_idx(key)
+        if entry_idx < 0:
+            raise KeyError(key)
+
+        return self.token_ids(entry_idx)
+
+    def token_ids(self, entry_idx):
+        return self.tokens[self.offsets[entry_idx]:self.offsets[entry_idx + 1]]
+
+    def entry_lengths(self):
+        # number of stored tokens of every entry, including special tokens
+        return np.diff(self.offsets)
+
+    def full_lengths(self):
+        # number of tokens of every entry with its texts encoded separately and not truncated, i.e. the sum of
+        # len(tokenizer.encode(text)) over its texts, the lengths utils.analyze_data reports
+        return self.text_lengths.sum(axis=1, dtype=np.int64) + 2 * self.meta['num_texts']
+
+    def truncated(self):
+        return self.entry_lengths() < self.text_lengths.sum(axis=1, dtype=np.int64) + self.meta['num_texts'] + 1
+
+    def batches(self, keys, batch_size, pad_token_id=0):
+        # padded int64 input ids and attention masks of the entries of keys, in the order of keys
+        for batch_keys in batched(keys, batch_size):
+            batch_ids = [self[key] for key in batch_keys]
+            input_ids = np.full((len(batch_ids), max(len(ids) for ids in batch_ids)), pad_token_id, dtype=np.int64)
+            attention_mask = np.zeros(input_ids.shape, dtype=np.int64)
+            for row, ids in enumerate(batch_ids):
+                input_ids[row, :len(ids)] = ids
+                attention_mask[row, :len(ids)] = 1
+
+            yield batch_keys, input_ids, attention_mask
+
+
+def query_entries(qid2info):
+    for qid, query in qid2info.items():
+        yield qid, (query,)
+
+
+def doc_entries(pmid2info):
+    for pmid, (title, abstract) in pmid2info.items():
+        yield pmid, (title, abstract)
+
+
+if __name__ == '__main__':
+    from transformers import AutoTokenizer
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        '--qid2info_path',
+        type=str,
+        help='qid2info.json written by parse_pmc_data.py, its queries are cached in <output_dir>/query_tokens'
+    )
+    parser.add_argument(
+        '--pmid2info_path',
+        type=str,
+        help='pmid2info.json or a corpus store directory, its titles and abstracts are cached in <output_dir>/doc_tokens'
+    )
+    parser.add_argument(
+        '--output_dir',
+        type=str,
+        required=True
+    )
+    parser.add_argument(
+        '--tokenizer',
+        type=str,
+        default=default_tokenizer_name
+    )
+    parser.add_argument(
+        '--query_max_length',
+        type=int,
+        default=64
+    )
+    parser.add_argument(
+        '--doc_max_length',
+        type=int,
+        default=512
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='number of processes that encode batches'
+    )
+    parser.add_argument(
+        '--batch_size',
+        type=int,
+        default=1024
+    )
+
+    args = parser.parse_args()
+
+    # the fast tokenizer is required for batched encoding
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer, use_fast=True)
+
+    if args.qid2info_path is not None:
+        with open(args.qid2info_path, 'r') as f:
+            qid2info = json.load(f)
+        meta = build_token_cache(query_entries(qid2info), len(qid2info), os.path.join(args.output_dir, 'query_tokens'), tokenizer,
+                                 args.query_max_length, workers=args.workers, batch_size=args.batch_size)
+        print('num queries', meta['num_entries'], 'truncated', meta['num_truncated'])
+
+    if args.pmid2info_path is not None:
+        pmid2info = load_pmid2info(args.pmid2info_path)
+        meta = build_token_cache(doc_entries(pmid2info), len(pmid2info), os.path.join(args.output_dir, 'doc_tokens'), tokenizer,
+                                 args.doc_max_length, workers=args.workers, batch_size=args.batch_size)
+        print('num documents', meta['num_entries'], 'truncated', meta['num_truncated'])
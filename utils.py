@@ -1,10 +1,15 @@
 import os
 import random
-import hashlib
 import json
-import transformers
+import argparse
+import multiprocessing
+import numpy as np
+from itertools import islice
 from tqdm import tqdm
-from transformers import AutoTokenizer
+from corpus_store import load_pmid2info
+from file_verification import verify_files
+from pmc_manifest import refresh_manifest, sample_articles
+from token_cache import TokenCache, batched, default_tokenizer_name
 
 
 random.seed(42)
@@ -50,124 +55,156 @@ pmid2info_path = '/vol/tmp/lethanhd/data_parser/pmid2info.json'
 stats_dir = '/vol/tmp/lethanhd/data_parser/analysis_stats/50k_iterative_improved'
 
 
-def verify_pubmed_files(pubmed_dir):
-    correct = 0
-    corrupted = 0
-    files = os.listdir(pubmed_dir)
-    for file in tqdm(files):
-        file_path = os.path.join(pubmed_dir, file)
-        if file_path.endswith('.gz'):
-            with open(file_path, "rb") as f:
-                readable_hash = hashlib.md5(bytes).hexdigest()
-
-            with open(file_path + '.md5', 'r') as f:
-                md5sum = f.read().split()[-1]
-
-            if readable_hash == md5sum:
-                correct += 1
-            else:
-                corrupted += 1
+def verify_pubmed_files(pubmed_dir, manifest_path=None, threads=8):
+    # with a manifest path, files that were verified before and did not change are not hashed again
+    files = [os.path.join(pubmed_dir, file) for file in os.listdir(pubmed_dir) if file.endswith('.gz')]
+    statuses = verify_files(files, manifest_path=manifest_path, threads=threads)
 
+    correct = sum(1 for status in statuses.values() if status == 'correct')
     print('num correct files:', correct)
-    print('num corrupted files:', corrupted)
+    print('num corrupted files:', len(statuses) - correct)
 
 
-def random_sample_pmc_files(num_samples=30000):
-    files = []
-    for pmc_dir in tqdm(pmc_dirs):
-        files.extend([os.path.join(pmc_dir, file) for file in os.listdir(pmc_dir)])
+def random_sample_pmc_files(num_samples=30000, manifest_dir=None, stratified=False):
+    # the pmc_dirs are listed into a manifest once, later calls only list directories that changed
+    if manifest_dir is None:
+        manifest_dir = os.path.join(stats_dir, 'pmc_manifest')
+    refresh_manifest(manifest_dir, pmc_dirs)
 
-    random_samples = random.sample(range(len(files)), k=num_samples)
+    random_samples = sample_articles(manifest_dir, num_samples, stratified=stratified, seed=42)
 
     with open(os.path.join(stats_dir, 'random_file_samples_10k'), 'w') as f:
-        f.write('\n'.join([files[sample] for sample in random_samples]))
+        f.write('\n'.join(random_samples))
+
+
+# token length thresholds the analysis counts queries and documents below
+query_length_thresholds = (64, 128, 192, 256)
+doc_length_thresholds = (512, 768, 1024, 1280)
+
+# transformers takes seconds to import, the tokenizer is loaded on first use and kept for the lifetime of the process
+analysis_tokenizer = None
+
+
+def get_tokenizer():
+    global analysis_tokenizer
+
+    if analysis_tokenizer is None:
+        from transformers import AutoTokenizer
+
+        # the fast tokenizer is required for the batched length computation
+        analysis_tokenizer = AutoTokenizer.from_pretrained(default_tokenizer_name, use_fast=True)
+
+    return analysis_tokenizer
+
+
+def encode_lengths(texts):
+    # number of tokens of every text including [CLS] and [SEP], the same as len(tokenizer.encode(text)), but the rust
+    # tokenizer encodes the whole batch and no python lists of token ids are built
+    backend = length_tokenizer.backend_tokenizer
+    # encode_batch_fast skips the character offsets, older tokenizers versions only have encode_batch
+    encode_batch = getattr(backend, 'encode_batch_fast', backend.encode_batch)
+
+    return np.fromiter((len(encoding) for encoding in encode_batch(texts, add_special_tokens=True)), dtype=np.int32, count=len(texts))
+
 
+def get_token_lengths(texts, tokenizer, num_texts=None, workers=1, batch_size=1024):
+    # token lengths of an iterable of texts in their order. with workers > 1 the batches are encoded in forked processes,
+    # only workers * 4 batches are read ahead of the results
+    global length_tokenizer
 
-def analyze_qid2info(qid2info_path, tokenizer, stats_dir):
+    length_tokenizer = tokenizer
+    backend = tokenizer.backend_tokenizer
+    backend.no_truncation()
+    backend.no_padding()
 
-    with open(qid2info_path, 'r') as f:
-        qid2info = json.load(f)
+    batches = batched(texts, batch_size)
+    lengths = []
+    progress = tqdm(total=num_texts, position=0, leave=True)
+    if workers == 1:
+        for batch in batches:
+            lengths.append(encode_lengths(batch))
+            progress.update(len(batch))
+    else:
+        # every worker encodes on one core, the rust thread pool does not work in forked processes
+        os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            while True:
+                window = list(islice(batches, workers * 4))
+                if len(window) == 0:
+                    break
 
-    query_lengths = {}
-    leq_64 = 0
-    leq_128 = 0
-    leq_192 = 0
-    leq_256 = 0
-    for entry in tqdm(qid2info, position=0, leave=True):
-        query = qid2info[entry]
-        len_query_toks = len(tokenizer.encode(query))
+                for batch_lengths in pool.imap(encode_lengths, window):
+                    lengths.append(batch_lengths)
+                    progress.update(len(batch_lengths))
+    progress.close()
 
-        if len_query_toks in query_lengths:
-            query_lengths[len_query_toks] += 1
-        else:
-            query_lengths[len_query_toks] = 1
+    if len(lengths) == 0:
+        return np.zeros(0, dtype=np.int32)
+    return np.concatenate(lengths)
 
-        if len_query_toks < 65:
-            leq_64 += 1
-        if len_query_toks < 129:
-            leq_128 += 1
-        if len_query_toks < 193:
-            leq_192 += 1
-        if len_query_toks < 257:
-            leq_256 += 1
+
+def length_histogram(lengths):
+    # {token length: number of texts} of the lengths that occur
+    counts = np.bincount(lengths)
+    return {int(length): int(counts[length]) for length in np.flatnonzero(counts)}
+
+
+def threshold_lines(lengths, thresholds, description):
+    num_leq = np.searchsorted(np.sort(lengths), thresholds, side='right')
+
+    return [description + ' less equal than ' + str(threshold) + ': ' + '{} ({})'.format(str(round(int(count) / len(lengths), 4)), int(count))
+            for threshold, count in zip(thresholds, num_leq)]
+
+
+def analyze_qid2info(qid2info_path, tokenizer, stats_dir, thresholds=query_length_thresholds, workers=1, batch_size=1024, token_cache_dir=None):
+
+    if token_cache_dir is not None:
+        # lengths of the pre-tokenized queries written by token_cache.py
+        query_lengths = TokenCache(token_cache_dir).full_lengths()
+    else:
+        with open(qid2info_path, 'r') as f:
+            qid2info = json.load(f)
+
+        query_lengths = get_token_lengths(qid2info.values(), tokenizer, num_texts=len(qid2info), workers=workers, batch_size=batch_size)
 
     with open(os.path.join(stats_dir, 'query_lengths'), 'w') as f:
-        json.dump(query_lengths, f, indent=4)
+        json.dump(length_histogram(query_lengths), f, indent=4)
 
     return [
         'path: ' + str(qid2info_path),
-        'num queries: ' + str(len(qid2info)),
-        'query tokenizations less equal than 64: ' + '{} ({})'.format(str(round(leq_64/len(qid2info), 4)), leq_64),
-        'query tokenizations less equal than 128: ' + '{} ({})'.format(str(round(leq_128/len(qid2info), 4)), leq_128),
-        'query tokenizations less equal than 192: ' + '{} ({})'.format(str(round(leq_192/len(qid2info), 4)), leq_192),
-        'query tokenizations less equal than 256: ' + '{} ({})'.format(str(round(leq_256/len(qid2info), 4)), leq_256),
-    ]
-
-
-def analyze_pmid2info(pmid2info_path, tokenizer, stats_dir):
-
-    with open(pmid2info_path, 'r') as f:
-        pmid2info = json.load(f)
-
-    abstract_lengths = {}
-    leq_512 = 0
-    leq_768 = 0
-    leq_1024 = 0
-    leq_1280 = 0
-    for entry in tqdm(pmid2info, position=0, leave=True):
-        abstract = pmid2info[entry][1]
-        title = pmid2info[entry][0]
-        len_doc_tokens = len(tokenizer.encode(abstract)) + len(tokenizer.encode(title))
-        
-        if len_doc_tokens in abstract_lengths:
-            abstract_lengths[len_doc_tokens] += 1
-        else:
-            abstract_lengths[len_doc_tokens] = 1
-        
-        if len_doc_tokens < 513:
-            leq_512 += 1
-        if len_doc_tokens < 769:
-            leq_768 += 1
-        if len_doc_tokens < 1025:
-            leq_1024 += 1
-        if len_doc_tokens < 1281:
-            leq_1280 += 1
+        'num queries: ' + str(len(query_lengths)),
+    ] + threshold_lines(query_lengths, thresholds, 'query tokenizations')
+
+
+def analyze_pmid2info(pmid2info_path, tokenizer, stats_dir, thresholds=doc_length_thresholds, workers=1, batch_size=1024, token_cache_dir=None):
+
+    if token_cache_dir is not None:
+        # lengths of the pre-tokenized documents written by token_cache.py
+        doc_lengths = TokenCache(token_cache_dir).full_lengths()
+    else:
+        pmid2info = load_pmid2info(pmid2info_path)
+
+        # title and abstract are encoded separately, so a document has the [CLS] and [SEP] tokens of both
+        texts = (text for _, (title, abstract) in pmid2info.items() for text in (title, abstract))
+        text_lengths = get_token_lengths(texts, tokenizer, num_texts=2 * len(pmid2info), workers=workers, batch_size=batch_size)
+        doc_lengths = text_lengths[0::2] + text_lengths[1::2]
 
     with open(os.path.join(stats_dir, 'doc_infos'), 'w') as f:
-        json.dump(abstract_lengths, f, indent=4)
+        json.dump(length_histogram(doc_lengths), f, indent=4)
 
     return [
         'path: ' + str(pmid2info_path),
-        'num abstracts: ' + str(len(pmid2info)),
-        'abstract+title tokenizations less equal than 512: ' + '{} ({})'.format(str(round(leq_512 / len(pmid2info), 4)), leq_512),
-        'abstract+title tokenizations less equal than 768: ' + '{} ({})'.format(str(round(leq_768 / len(pmid2info), 4)), leq_768),
-        'abstract+title tokenizations less equal than 1024: ' + '{} ({})'.format(str(round(leq_1024 / len(pmid2info), 4)), leq_1024),
-        'abstract+title tokenizations less equal than 1280: ' + '{} ({})'.format(str(round(leq_1280 / len(pmid2info), 4)), leq_1280),
-    ]
+        'num abstracts: ' + str(len(doc_lengths)),
+    ] + threshold_lines(doc_lengths, thresholds, 'abstract+title tokenizations')
 
 
-def analyze_data(qid2info_path, pmid2info_path, stats_dir, do_analyze_qid2info=False, do_analyze_pmid2info=False):
-    tokenizer = AutoTokenizer.from_pretrained('microsoft/BiomedNLP-PubMedBERT-base-uncased-abstract-fulltext')
+def analyze_data(qid2info_path, pmid2info_path, stats_dir, do_analyze_qid2info=False, do_analyze_pmid2info=False,
+                 query_thresholds=query_length_thresholds, doc_thresholds=doc_length_thresholds, workers=1, batch_size=1024,
+                 query_token_cache_dir=None, doc_token_cache_dir=None):
+    # with token caches from token_cache.py the lengths are read from them and nothing is tokenized
+    tokenizer = None
+    if (do_analyze_qid2info and query_token_cache_dir is None) or (do_analyze_pmid2info and doc_token_cache_dir is None):
+        tokenizer = get_tokenizer()
 
     if not os.path.exists(stats_dir):
         os.makedirs(stats_dir)
@@ -175,10 +212,12 @@ def analyze_data(qid2info_path, pmid2info_path, stats_dir, do_analyze_qid2info=F
     output_lines = []
 
     if do_analyze_qid2info:
-        output_lines.extend(analyze_qid2info(qid2info_path, tokenizer, stats_dir))
+        output_lines.extend(analyze_qid2info(qid2info_path, tokenizer, stats_dir, thresholds=query_thresholds, workers=workers, batch_size=batch_size,
+                                             token_cache_dir=query_token_cache_dir))
 
     if do_analyze_pmid2info:
-        output_lines.extend(analyze_pmid2info(pmid2info_path, tokenizer, stats_dir))
+        output_lines.extend(analyze_pmid2info(pmid2info_path, tokenizer, stats_dir, thresholds=doc_thresholds, workers=workers, batch_size=batch_size,
+                                              token_cache_dir=doc_token_cache_dir))
 
     with open(os.path.join(stats_dir, 'tokenization_lengths'), 'w') as f:
         f.write('\n'.join(output_lines))
@@ -190,3 +229,43 @@ def analyze_data(qid2info_path, pmid2info_path, stats_dir, do_analyze_qid2info=F
 
 # analyze_data(qid2info_path='/vol/tmp/lethanhd/data_parser/50k_iterative_improved/qid2info.json', pmid2info_path=pmid2info_path, stats_dir = '/vol/tmp/lethanhd/data_parser/analysis_stats/50k_iterative_improved')
 
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    verify_parser = subparsers.add_parser('verify', help='check the pubmed files against their .md5 files')
+    verify_parser.add_argument('--pubmed_dir', type=str, default=pubmed_dir)
+    verify_parser.add_argument('--manifest_path', type=str, help='md5 sums of verified files, unchanged files are not hashed again')
+    verify_parser.add_argument('--threads', type=int, default=8)
+
+    sample_parser = subparsers.add_parser('sample', help='write a random sample of the pmc_dirs articles to <stats_dir>/random_file_samples_10k')
+    sample_parser.add_argument('--num_samples', type=int, default=30000)
+    sample_parser.add_argument('--manifest_dir', type=str, help='pmc manifest, <stats_dir>/pmc_manifest by default')
+    sample_parser.add_argument('--stratified', action='store_true')
+
+    analyze_parser = subparsers.add_parser('analyze', help='token length statistics of queries and documents')
+    analyze_parser.add_argument('--qid2info_path', type=str, default=qid2info_path)
+    analyze_parser.add_argument('--pmid2info_path', type=str, default=pmid2info_path)
+    analyze_parser.add_argument('--stats_dir', type=str, default=stats_dir)
+    analyze_parser.add_argument('--queries', action='store_true', help='analyze the queries of qid2info')
+    analyze_parser.add_argument('--documents', action='store_true', help='analyze the titles and abstracts of pmid2info')
+    analyze_parser.add_argument('--workers', type=int, default=1)
+    analyze_parser.add_argument('--batch_size', type=int, default=1024)
+    analyze_parser.add_argument('--query_token_cache_dir', type=str, help='token cache written by token_cache.py, nothing is tokenized with it')
+    analyze_parser.add_argument('--doc_token_cache_dir', type=str, help='token cache written by token_cache.py, nothing is tokenized with it')
+
+    args = parser.parse_args()
+
+    if args.command == 'verify':
+        verify_pubmed_files(args.pubmed_dir, manifest_path=args.manifest_path, threads=args.threads)
+    elif args.command == 'sample':
+        random_sample_pmc_files(args.num_samples, manifest_dir=args.manifest_dir, stratified=args.stratified)
+    else:
+        analyze_data(args.qid2info_path, args.pmid2info_path, args.stats_dir, do_analyze_qid2info=args.queries, do_analyze_pmid2info=args.documents,
+                     workers=args.workers, batch_size=args.batch_size, query_token_cache_dir=args.query_token_cache_dir,
+                     doc_token_cache_dir=args.doc_token_cache_dir)
+
+
+if __name__ == '__main__':
+    main()